@@ -2,11 +2,82 @@
 mergeNWI
 ========
 mergeNWI is an example of how to merge NWI given a geodatabase and wildcard
+
+The class of each table is taken from its name and added as a CLASS column while the rows are copied, so the source tables are never rewritten.  Tables
+are read in OBJECTID ranges by a pool of workers and streamed into one insert cursor on the merged table, so only a few chunks of rows are held in memory
+at a time.  Nulls are copied as nulls.
 """
 
-import os, sys, getopt, datetime, logging, arcpy, re
-import waterfowlmodel.mergeTable as mergeTable
+import os, sys, getopt, datetime, logging, arcpy, re, multiprocessing
+
+# Field types that aren't copied
+SKIP_TYPES = ['OID', 'Geometry', 'Blob', 'Raster']
+# AddField types of the copied field types
+ADD_TYPES = {'SmallInteger': 'SHORT', 'Integer': 'LONG', 'BigInteger': 'BIGINTEGER', 'Single': 'FLOAT', 'Double': 'DOUBLE', 'String': 'TEXT', 'Date': 'DATE',
+             'DateOnly': 'DATEONLY', 'TimeOnly': 'TIMEONLY', 'TimestampOffset': 'TIMESTAMPOFFSET', 'GUID': 'GUID', 'GlobalID': 'GUID'}
+# Numeric field types from narrowest to widest
+NUMERIC_TYPES = ['SmallInteger', 'Integer', 'BigInteger', 'Single', 'Double']
+# Rows read by a worker at a time
+CHUNK_SIZE = 100000
+
+def promoteType(a, b):
+    '''Helper function returning a field type that holds the values of two field types'''
+    if a == b:
+        return a
+    if a in NUMERIC_TYPES and b in NUMERIC_TYPES:
+        wider = max(a, b, key=NUMERIC_TYPES.index)
+        # Integers don't fit a single precision float
+        return 'Double' if wider == 'Single' else wider
+    return 'String'
+
+def mergedFields(tables):
+    """
+    Returns the fields of the merged table.  Fields with the same name are merged and their type is promoted when it differs between tables.
+
+    :param tables: Table locations
+    :type tables: list
+    :return: [name, type, length] of every field in the order they're first seen
+    :rtype: list
+    """
+    fields = {}
+    for inTable in tables:
+        for f in arcpy.ListFields(inTable):
+            if f.type in SKIP_TYPES or f.name.upper() == 'CLASS':
+                continue
+            ftype = 'GUID' if f.type == 'GlobalID' else f.type
+            known = fields.setdefault(f.name.upper(), [f.name, ftype, f.length])
+            known[1] = promoteType(known[1], ftype)
+            known[2] = max(known[2], f.length)
+    for field in fields.values():
+        if field[1] == 'String':
+            field[2] = max(field[2], 255)
+    return list(fields.values())
+
+def readChunk(args):
+    '''Helper function returning the rows of one OBJECTID range of a table in the order of the merged fields, with None for missing fields and the class last'''
+    inTable, columns, toText, toClass, where = args
+    read = [c for c in columns if c]
+    rows = []
+    with arcpy.da.SearchCursor(inTable, read, where) as cursor:
+        for row in cursor:
+            values = iter(row)
+            row = [next(values) if c else None for c in columns]
+            for i in toText:
+                if row[i] is not None:
+                    row[i] = str(row[i])
+            rows.append(tuple(row) + (toClass,))
+    return rows
 
+def chunkTasks(inTable, fields, toClass, chunkSize=CHUNK_SIZE):
+    '''Helper function returning the readChunk arguments for every OBJECTID range of a table'''
+    present = {f.name.upper(): f for f in arcpy.ListFields(inTable)}
+    columns = [present[name.upper()].name if name.upper() in present else None for name, ftype, length in fields]
+    # Fields promoted to text in the merged table
+    toText = [i for i, (name, ftype, length) in enumerate(fields) if ftype == 'String' and name.upper() in present and present[name.upper()].type != 'String']
+    oidField = arcpy.Describe(inTable).OIDFieldName
+    with arcpy.da.SearchCursor(inTable, ['OID@'], sql_clause=(None, 'ORDER BY {} DESC'.format(oidField))) as cursor:
+        last = next(iter(cursor), [0])[0]
+    return [(inTable, columns, toText, toClass, '{0} >= {1} AND {0} < {2}'.format(oidField, lo, lo + chunkSize)) for lo in range(0, last + 1, chunkSize)]
 
 def main(argv):
     """
@@ -15,34 +86,59 @@ def main(argv):
     :param geodatabase: Geodatabase with tables.
     :type workspace: str
     :param wildcard: Wildcard all tables to be merged start with
-    :type geodatabase: str 
+    :type geodatabase: str
+    :param output: Merged table name in the geodatabase.  Defaults to MergedNWI.
+    :type output: str
+    :param workers: Number of processes reading the tables.  Defaults to the number of CPUs.
+    :type workers: str
     """
-    opts, args = getopt.getopt(argv,"g:w:",["geodatabase=", "wildcard="])
+    opts, args = getopt.getopt(argv,"g:w:o:j:",["geodatabase=", "wildcard=", "output=", "workers="])
+    gdb = ''
+    output = 'MergedNWI'
+    workers = multiprocessing.cpu_count()
     for opt, arg in opts:
       if opt in ('-g', '--geodatabase'):
          gdb = arg
          arcpy.env.workspace = gdb
       elif opt in ("-w", "--wildcard"):
           wld = arg
+      elif opt in ("-o", "--output"):
+          output = arg
+      elif opt in ("-j", "--workers"):
+          workers = int(arg)
 
     # Get and print a list of tables
-    tables = arcpy.ListTables(wld)
-    tblarr = []
+    tables = [t for t in arcpy.ListTables(wld) if t != output]
+    start = datetime.datetime.now()
+    classes = {table: re.split("\w\w\w\w", table, 1)[1] for table in tables}
+    fields = mergedFields([os.path.join(gdb, table) for table in tables])
+
+    outTable = os.path.join(gdb, output)
+    if arcpy.Exists(outTable):
+        arcpy.Delete_management(outTable)
+    arcpy.CreateTable_management(gdb, output)
+    for name, ftype, length in fields:
+        arcpy.AddField_management(outTable, name, ADD_TYPES[ftype], field_length=length)
+    arcpy.AddField_management(outTable, 'CLASS', 'TEXT', field_length=max([len(c) for c in classes.values()] + [1]))
+
+    tasks = []
     for table in tables:
-        print(table)
-        tblarr.append(table)
-        if arcpy.ListFields(table, "CLASS"):  
-            print("Field exists")
-        else:  
-            print("Field doesn't exist")
-            arcpy.AddField_management(table, "CLASS", "TEXT")
-        toClass = re.split("\w\w\w\w", table, 1)[1]
-        arcpy.CalculateFields_management(table, "PYTHON3", [["CLASS", '"' + toClass+'"']])
-
-    arcpy.Merge_management(tblarr, "MergedNWI")
+        print(table, classes[table])
+        tasks += chunkTasks(os.path.join(gdb, table), fields, classes[table])
+    count = 0
+    # Chunks are requested a few at a time so rows read faster than they're inserted don't pile up in memory
+    window = max(1, workers) * 2
+    with multiprocessing.Pool(max(1, min(workers, len(tasks)))) as pool:
+        with arcpy.da.InsertCursor(outTable, [f[0] for f in fields] + ['CLASS']) as cursor:
+            for i in range(0, len(tasks), window):
+                for rows in pool.imap(readChunk, tasks[i:i + window]):
+                    for row in rows:
+                        cursor.insertRow(row)
+                    count += len(rows)
+    print('Merged {} rows from {} tables into {} in {}'.format(count, len(tables), outTable, datetime.datetime.now() - start))
     print('Done')
 
 if __name__ == "__main__":
     print('\nRunning merge')
     print('#####################################\n')
-    main(sys.argv[1:])    
\ No newline at end of file
+    main(sys.argv[1:])
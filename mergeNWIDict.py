@@ -3,9 +3,50 @@ mergeNWIDict
 ===============
 mergeNWIDict combines multiple geodatabase tables, saves them to a dictionary, and outputs a JSON file for use in the Waterfowl model.  This was created to
 handle NWI crossover tables generated by USGS.
+
+The ATTRIBUTE column of every table is read in bulk by a pool of workers and the codes are deduplicated per class.  Besides the JSON file a compact
+aoiWetland.npz lookup is written (class names, and code and class index arrays sorted by code) that the crosswalk loader reads directly.  Codes assigned
+to more than one class are listed in aoiWetlandConflicts.csv.
 """
 
-import os, sys, getopt, datetime, logging, arcpy, re, json
+import os, sys, getopt, datetime, logging, arcpy, re, json, csv, multiprocessing
+import numpy as np
+
+def readCodes(args):
+    '''Helper function returning the class of a table and its distinct ATTRIBUTE codes'''
+    gdb, table = args
+    toClass = re.split("\w\w\w\w", table, 1)[1]
+    values = arcpy.da.TableToNumPyArray(os.path.join(gdb, table), ['ATTRIBUTE'], skip_nulls=True)['ATTRIBUTE']
+    return table, toClass, np.unique(values.astype(str))
+
+def buildLookup(results):
+    """
+    Combines the codes of every table into one crosswalk.
+
+    :param results: (table, class, codes) for every table, in table order
+    :type results: list
+    :return: Codes by class and the classes of every code assigned to more than one class
+    :rtype: tuple
+    """
+    tblDict = {}
+    for table, toClass, codes in results:
+        tblDict[toClass] = np.union1d(tblDict[toClass], codes) if toClass in tblDict else codes
+    classes = list(tblDict)
+    codes = np.concatenate([tblDict[c] for c in classes]) if classes else np.zeros(0, dtype=str)
+    classIndex = np.repeat(np.arange(len(classes)), [len(tblDict[c]) for c in classes])
+    order = np.argsort(codes, kind='stable')
+    codes, classIndex = codes[order], classIndex[order]
+    conflicts = {}
+    if len(codes):
+        repeated = np.flatnonzero(codes[1:] == codes[:-1])
+        for code in np.unique(codes[repeated]).tolist():
+            conflicts[code] = [classes[i] for i in classIndex[codes == code]]
+    return tblDict, classes, codes, classIndex, conflicts
+
+def writeLookup(path, classes, codes, classIndex):
+    '''Helper function writing the binary crosswalk read by waterfowlmodel.dataset.readCrosswalk'''
+    np.savez_compressed(path, classes=np.array(classes, dtype=str), codes=codes.astype(str), classIndex=classIndex.astype(np.int16))
+    return path
 
 def main(argv):
     """
@@ -14,36 +55,48 @@ def main(argv):
     :param geodatabase: Geodatabase with tables.
     :type workspace: str
     :param wildcard: Wildcard is the beginning of all tables to be merged.  Example tables: [Q01, Q02, Q03]. Set wildcard to "Q*"
-    :type geodatabase: str 
+    :type geodatabase: str
+    :param workers: Number of tables read at the same time.  Defaults to the number of CPUs.
+    :type workers: str
     """
-    opts, args = getopt.getopt(argv,"g:w:",["geodatabase=", "wildcard="])
+    opts, args = getopt.getopt(argv,"g:w:j:",["geodatabase=", "wildcard=", "workers="])
     gdb = ''
+    workers = multiprocessing.cpu_count()
     for opt, arg in opts:
       if opt in ('-g', '--geodatabase'):
          gdb = arg
          arcpy.env.workspace = gdb
       elif opt in ("-w", "--wildcard"):
           wld = arg
+      elif opt in ("-j", "--workers"):
+          workers = int(arg)
 
     # Get and print a list of tables
     tables = arcpy.ListTables(wld)
     print(tables)
-    tblDict = {}
-    for table in tables:
-        print(table)
-        toClass = re.split("\w\w\w\w", table, 1)[1]
-        if toClass not in tblDict:
-            tblDict[toClass] = []
-        cursor = arcpy.SearchCursor(table, fields='ATTRIBUTE')
-        for row in cursor:
-            tblDict[toClass].append(row.getValue('ATTRIBUTE'))
+    start = datetime.datetime.now()
+    with multiprocessing.Pool(max(1, min(workers, len(tables)))) as pool:
+        results = pool.map(readCodes, [(gdb, table) for table in tables])
+    for table, toClass, codes in results:
+        print(table, toClass, len(codes))
+    tblDict, classes, codes, classIndex, conflicts = buildLookup(results)
 
     print(tblDict.keys())
-    json.dump( tblDict, open(os.path.join(os.path.dirname(gdb),"aoiWetland.json"), 'w' ))
+    outFolder = os.path.dirname(gdb)
+    json.dump({k: v.tolist() for k, v in tblDict.items()}, open(os.path.join(outFolder,"aoiWetland.json"), 'w' ))
+    writeLookup(os.path.join(outFolder, "aoiWetland.npz"), classes, codes, classIndex)
+    with open(os.path.join(outFolder, "aoiWetlandConflicts.csv"), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['ATTRIBUTE', 'CLASSES'])
+        for code, codeClasses in conflicts.items():
+            writer.writerow([code, ','.join(codeClasses)])
+    if conflicts:
+        print('{} codes are assigned to more than one class.  See aoiWetlandConflicts.csv'.format(len(conflicts)))
+    print('{} codes in {} classes from {} tables in {}'.format(len(np.unique(codes)), len(classes), len(tables), datetime.datetime.now() - start))
 
     print('Done')
 
 if __name__ == "__main__":
     print('\nRunning merge')
     print('#####################################\n')
-    main(sys.argv[1:])    
\ No newline at end of file
+    main(sys.argv[1:])
@@ -10,13 +10,27 @@ import waterfowlmodel.base as waterfowl
 import waterfowlmodel.dataset
 import waterfowlmodel.publicland
 import waterfowlmodel.zipup
+import waterfowlmodel.partition
+import waterfowlmodel.projection
+import waterfowlmodel.validity
+import waterfowlmodel.fingerprint
+import waterfowlmodel.scheduler
+import waterfowlmodel.tiling
+import waterfowlmodel.checkpoint
+import waterfowlmodel.stages
+import waterfowlmodel.profiling
+import waterfowlmodel.logqueue
+import waterfowlmodel.columnstore
+import waterfowlmodel.scratchstore
+import waterfowlmodel.compactgeom
+import waterfowlmodel.spatialindex
+import waterfowlmodel.scenario
 import numpy as np
 from functools import partial
 from contextlib import contextmanager
 from pyproj.crs import CRS
 import geopandas as gpd
 from multiprocessing import Pool
-#from multiprocessing_logging import install_mp_handler
 
 def printlog(txt, var):
    print(txt + ':', var)
@@ -35,10 +49,16 @@ def report_time(func):
 
 @contextmanager
 def poolcontext(*args, **kwargs):
-    pool = multiprocessing.Pool(*args, **kwargs)
+    pool = multiprocessing.Pool(*args, **dict(waterfowlmodel.logqueue.poolArgs(), **kwargs))
     yield pool
     pool.terminate()
 
+def initWorker(storeFolder, logArgs):
+   '''Pool initializer sending worker logs to the log writer and attaching the shared national inputs'''
+   if logArgs:
+      waterfowlmodel.logqueue.install(*logArgs)
+   waterfowlmodel.columnstore.attach(storeFolder)
+
 @report_time
 def main(argv):
    """
@@ -68,9 +88,33 @@ def main(argv):
    :type aoi: str
    :param fieldTable: Table to standardize field names and aliases, this csv: ModelOutputFieldDictionary.csv
    :type fieldTable: str
-   :param cleanRun: Check for and delete intermediate data
+   :param cleanRun: Rebuild all intermediate data.  Otherwise intermediate data is only rebuilt when its inputs, parameters, or the model code change.
    :type cleanRun: str      
-   :param debug: Run sections of code for debugging.  1 = run code and 0 = don't run code section.  Defaults to run everything if not specified. [Energy supply, Energy demand, Species proportion, protected lands, habitat proportion, urban, full model output, data check, merge all, zip]
+   :param partition: Partition the national layers to every area of interest in a single pass before the per area of interest pool runs.  1 = partition and 0 = clip within each worker.
+   :type partition: str
+   :param tiles: Split areas of interest that would take longer than an even share of the run into at most this many tiles along bin boundaries.  Only used when every stage is run.
+   :type tiles: str
+   :param resume: Continue an interrupted run.  Finished areas of interest and stages are skipped.
+   :type resume: str
+   :param retries: Number of times a failed area of interest is retried.  Defaults to 2.
+   :type retries: str
+   :param profile: Record wall time, CPU time, peak memory, feature counts and bytes written for every stage and Waterfowlmodel method.  Written to a Chrome trace and a CSV summary in the _profile folder of the AOI workspace.
+   :type profile: str
+   :param zipCache: Keep the compressed output files in the _zipcache folder of the AOI workspace so the next zip only compresses the files that changed.
+   :type zipCache: str
+   :param scratchFormat: Scratch storage the geopandas steps read and write.  gdb reads the scratch geodatabase directly.  parquet also keeps spatially sorted GeoParquet copies of scratch layers for column and bbox reads (needs pyarrow).  compact keeps quantized, delta encoded copies instead.  Defaults to gdb.
+   :type scratchFormat: str
+   :param scratchGrid: Grid cell size in meters the compact scratch format snaps coordinates to.  The area change and error bound of every compact layer are printed and logged.  Defaults to 0.01.
+   :type scratchGrid: str
+   :param scenarios: Alternative kcal tables in the same format as kcalTable.  The bin by habitat class hectares of the run are kept and every table is evaluated on them without rerunning the overlays.  Results are written to the _scenarios folder of the AOI workspace.
+   :type scenarios: str
+   :param memory: Memory budget in gigabytes.  An area of interest only starts when its estimated peak memory fits.  Defaults to 80% of physical memory when psutil is installed.
+   :type memory: str
+   :param workers: Number of areas of interest run at the same time.  Defaults to 8.
+   :type workers: str
+   :param stages: Stages to run by name.  Stages they depend on are run as well.  Defaults to every stage.  [supply, merge, demand, species, public, protected, habitat, urban, unavailable, model, check, scenario, web, zip]
+   :type stages: str
+   :param debug: Run sections of code for debugging.  1 = run code and 0 = don't run code section.  Kept for older scripts and mapped to stages. [Energy supply, Energy demand, Species proportion, protected lands, habitat proportion, urban, full model output, data check, merge all, zip]
    :type debug: str 
 
    """
@@ -105,7 +149,20 @@ def main(argv):
    parser.add_argument('--urban', '-r', nargs=1, type=str, default=[], help="Specify urban layer name raster. NLCD")
    parser.add_argument('--aoi', '-a', nargs=2, type=str, default=[], help="Specify area of interest layer name and field name for unique separation")
    parser.add_argument('--fieldTable', '-f', nargs="*", type=str, default=[], help='Specify crosswalk to standardize field names and aliases.')
-   parser.add_argument('--cleanRun', '-c', nargs=1, type=int, default=[], help='Specify crosswalk to standardize field names and aliases.')
+   parser.add_argument('--cleanRun', '-c', nargs=1, type=int, default=[], help='Rebuild all intermediate data instead of only out of date data.  1 or 0')
+   parser.add_argument('--partition', '-x', nargs=1, type=int, default=[], help='Partition national layers to all areas of interest in one pass.  1 or 0')
+   parser.add_argument('--tiles', '-t', nargs=1, type=int, default=[], help='Split large areas of interest into at most this many tiles along bin boundaries')
+   parser.add_argument('--resume', action='store_true', help='Continue an interrupted run, skipping finished areas of interest and stages')
+   parser.add_argument('--retries', nargs=1, type=int, default=[], help='Number of times a failed area of interest is retried.  Defaults to 2')
+   parser.add_argument('--profile', action='store_true', help='Profile every stage and Waterfowlmodel method.  Writes trace.json and summary.csv to the _profile folder')
+   parser.add_argument('--zipCache', action='store_true', help='Keep the compressed output files in the _zipcache folder so the next zip only compresses the files that changed')
+   parser.add_argument('--scratchFormat', nargs=1, type=str, default=['gdb'], choices=waterfowlmodel.scratchstore.BACKENDS, help='Scratch storage the geopandas steps read and write.  gdb, parquet or compact.  Defaults to gdb')
+   parser.add_argument('--scratchGrid', nargs=1, type=float, default=[waterfowlmodel.compactgeom.GRID], help='Grid cell size in meters for the compact scratch format.  The area error of every compact layer is reported.  Defaults to 0.01')
+   parser.add_argument('--scenarios', nargs="*", type=str, default=[], help='Alternative kcal tables evaluated on the bin by habitat class hectares of the run.  Written to the _scenarios folder')
+   parser.add_argument('--memory', '-m', nargs=1, type=float, default=[], help='Memory budget in gigabytes for the areas of interest running at the same time')
+   parser.add_argument('--workers', '-j', nargs=1, type=int, default=[], help='Number of areas of interest run at the same time.  Defaults to 8')
+   parser.add_argument('--stageWorkers', nargs=1, type=int, default=[1], help='Number of independent stages (supply, public lands, urban and unavailable) of an area of interest run at the same time in their own processes.  Each adds to the memory an area of interest uses.  Defaults to 1')
+   parser.add_argument('--stages', '-s', nargs="*", type=str, default=[], help="Run specific stages and the stages they depend on.  Any of [supply, merge, demand, species, public, protected, habitat, urban, unavailable, model, check, scenario, web, zip]")
    parser.add_argument('--debug', '-z', nargs=10, type=int,default=[], help="Run specific sections of code.  1 or 0 for [Energy supply, Energy demand, Species proportion, protected lands, habitat proportion, urban, full model, data check, merge all, zip]")
    
    #gpd.options.use_pygeos = True
@@ -157,6 +214,11 @@ def main(argv):
          print("Number of extra habitat datasets does not equal crossover tables")
       else:
          extra = {i:[os.path.join(geodatabase,args.extra[i]), os.path.join(workspace,args.extra[i + 1])] for i in range(0, len(args.extra), 2)}
+   for i, scenario in enumerate(args.scenarios):
+      args.scenarios[i] = os.path.join(workspace, scenario)
+      if not os.path.isfile(args.scenarios[i]):
+         print("Scenario kcal table doesn't exist.", args.scenarios[i])
+         sys.exit(2)
    if len(args.fieldTable) > 0:
       fieldTable = os.path.join(workspace, args.fieldTable[0])
       if not os.path.isfile(fieldTable):
@@ -165,7 +227,7 @@ def main(argv):
    else:
       fieldTable = ''
    if args.cleanRun:
-      cleanRun = args.cleanRun
+      cleanRun = args.cleanRun[0]
    else:
       cleanRun = 0
    binIt = os.path.join(geodatabase,args.binIt[0])
@@ -203,18 +265,47 @@ def main(argv):
    if not (arcpy.Exists(aoi)):
             print("aoi layer doesn't exist.")
             sys.exit(2)
-   if args.debug:
-      debug = args.debug
+   if args.partition:
+      partition = args.partition[0]
+   else:
+      partition = 0
+   if args.workers:
+      workers = args.workers[0]
+   else:
+      workers = 8
+   resume = args.resume
+   if args.retries:
+      retries = args.retries[0]
+   else:
+      retries = 2
+   budget = waterfowlmodel.scheduler.memoryBudget(args.memory[0] if args.memory else None)
+   if args.tiles:
+      tiles = args.tiles[0]
+   else:
+      tiles = 0
+   if args.stages:
+      stages = [s for s in args.stages if s != 'zip']
+      zipit = 'zip' in args.stages
+   elif args.debug:
+      stages = [s for on, names in zip(args.debug, DEBUG_STAGES) if on for s in names]
+      zipit = args.debug[9]
    else:
-      debug = [1, 1, 1, 1, 1, 1, 1, 1, 1, 1]
-   if debug[2] == 1 and fieldTable == '':
+      stages = None
+      zipit = 1
+   try:
+      runStages = modelStages().resolve(stages)
+   except ValueError as e:
+      print(e)
+      sys.exit(2)
+   if 'species' in runStages and fieldTable == '':
       print('Field table not defined but option is enabled')
       sys.exit(2)
    
    print('#####################################')
    print("Current date and time: ", datetime.datetime.now().strftime('%H:%M:%S on %A, %B the %dth, %Y'))
    comparetime = datetime.datetime.now()
-   logging.basicConfig(filename=os.path.join(workspace,"Waterfowl_" + aoiname + "_" + datetime.datetime.now().strftime("%m_%d_%Y")+ ".log"), filemode='w', level=logging.INFO)
+   # Every process logs through one writer process.  Records for each area of interest also go to <AOI workspace>/_logs/<aoi>.log
+   logwriter = waterfowlmodel.logqueue.start(os.path.join(workspace,"Waterfowl_" + aoiname + "_" + datetime.datetime.now().strftime("%m_%d_%Y")+ ".log"), os.path.join(aoiworkspace, '_logs'))
    wetland = waterfowlmodel.dataset.Dataset(wetland, scratchgdb, wetlandX, wetlandCol)
    demand = waterfowlmodel.dataset.Dataset(demand, scratchgdb)
    urban = waterfowlmodel.dataset.Dataset(urban, scratchgdb)
@@ -247,14 +338,61 @@ def main(argv):
    printlog('\tScratch gdb', scratchgdb)
    printlog('\tOutput gdb', outputgdb)
    printlog('\tClean run', str(cleanRun))
-   printlog('\tDebugging', ' '.join(map(str, list(debug))))
+   printlog('\tPartition', str(partition))
+   printlog('\tWorkers', str(workers))
+   printlog('\tMemory budget (MB)', str(budget >> 20) if budget else 'None')
+   printlog('\tTiles', str(tiles))
+   printlog('\tResume', str(resume))
+   printlog('\tRetries', str(retries))
+   printlog('\tProfile', str(args.profile))
+   printlog('\tZip cache', str(args.zipCache))
+   printlog('\tScratch format', args.scratchFormat[0] + (' ({} m grid)'.format(args.scratchGrid[0]) if args.scratchFormat[0] == 'compact' else ''))
+   printlog('\tKcal scenarios', ' '.join(args.scenarios) if args.scenarios else 'None')
+   printlog('\tStages', ' '.join(runStages + (['zip'] if zipit else [])))
    print('#####################################')
    arcpy.env.overwriteOutput = True
+
+   # Project national layers once per source version into a cache every area of interest reads from
+   print('\n#### Projecting national layers ####')
+   projcache = waterfowlmodel.projection.ProjectionCache(os.path.join(workspace, 'ProjectedInputs.gdb'))
+   wetland.inData = projcache.project(wetland.inData, 'wetland')
+   demand.inData = projcache.project(demand.inData, 'demand')
+   padus.inData = projcache.project(padus.inData, 'padus')
+   if nced:
+      nced.inData = projcache.project(nced.inData, 'nced')
+   binIt = projcache.project(binIt, 'bin')
+   for k in extra.keys():
+      extra[k][0] = projcache.project(extra[k][0], 'extra' + str(k))
+
+   # Repair invalid geometry once up front instead of after a failed overlay.  Layers with invalid geometry are replaced by a repaired copy in the projection
+   # cache so the source data is never changed.  Unchanged layers are skipped by fingerprint.
+   print('\n#### Validating national layers ####')
+   validgdb = projcache.cachegdb
+   wetland.inData = waterfowlmodel.validity.ensureValid(wetland.inData, os.path.join(validgdb, 'wetland_valid'), workers=workers)
+   demand.inData = waterfowlmodel.validity.ensureValid(demand.inData, os.path.join(validgdb, 'demand_valid'), workers=workers)
+   padus.inData = waterfowlmodel.validity.ensureValid(padus.inData, os.path.join(validgdb, 'padus_valid'), workers=workers)
+   if nced:
+      nced.inData = waterfowlmodel.validity.ensureValid(nced.inData, os.path.join(validgdb, 'nced_valid'), workers=workers)
+   binIt = waterfowlmodel.validity.ensureValid(binIt, os.path.join(validgdb, 'bin_valid'), workers=workers)
+   for k in extra.keys():
+      extra[k][0] = waterfowlmodel.validity.ensureValid(extra[k][0], os.path.join(validgdb, 'extra' + str(k) + '_valid'), workers=workers)
+   # Lookup tables, and the bin and demand layers every area of interest clips, are written once as memory mapped columns that every worker shares
+   # instead of reading its own copy.  Partitioned runs read their own partitions of the layers instead.
+   print('\n#### Storing shared national inputs ####')
+   storeFolder = waterfowlmodel.columnstore.prepare(os.path.join(aoiworkspace, '_store'), [wetland.crosswalk, kcalTable] + [extra[k][1] for k in extra.keys()],
+                                                    [kcalTable, (fieldTable, {'encoding': 'unicode_escape'})], [] if partition else [binIt, demand.inData])
+   waterfowlmodel.columnstore.attach(storeFolder)
+   if not partition:
+      # Every area of interest clips the national layers itself.  A packed R-tree built once per source version lets each one read only its candidates.
+      print('\n#### Indexing national layers ####')
+      for inFeature in [wetland.inData, padus.inData] + ([nced.inData] if nced else []) + [extra[k][0] for k in extra.keys()]:
+         waterfowlmodel.spatialindex.buildIndex(inFeature)
+
    # Setup all the variables required for waterfowl.Waterfowlmodel then map to calc
 
    # Use aoi and aoifield to create list of unique elements.  Create list of waterfowlmodel init params for each unique aoi
    dstList = []
-   unique_values = set(row[0] for row in arcpy.da.SearchCursor(aoi, aoifield))
+   unique_values = sorted(set(row[0] for row in arcpy.da.SearchCursor(aoi, aoifield)))
    #unique_values = {'MO', 'MN', 'WI'} # Overwriting the state selection here.
    for oneAOI in unique_values:
       scratchgdb = os.path.join(workspace, args.aoi[0], str(oneAOI) + "_scratch.gdb")
@@ -265,11 +403,94 @@ def main(argv):
       arcpy.CopyFeatures_management(uniqueAOI, os.path.join(workspace, args.aoi[0], oneAOI + "_scratch.gdb", 'stateAOI'))
       dstList.append([os.path.join(workspace, args.aoi[0], oneAOI + "_scratch.gdb", 'stateAOI'), oneAOI, wetland.inData, kcalTable, wetland.crosswalk, demand.inData, urban.inData, binIt, binUnique, extra, fieldTable, scratchgdb, wetland.classAttr])
 
+   runlog = waterfowlmodel.checkpoint.RunManifest(os.path.join(aoiworkspace, '_run'))
+   if not resume:
+      runlog.reset()
+      waterfowlmodel.profiling.reset(os.path.join(aoiworkspace, '_profile'))
+   if partition and resume and runlog.isDone('_national', 'partition'):
+      print('\n#### National layers already partitioned ####')
+   elif partition:
+      # Read each national layer once and write every area of interest's clip up front.  Waterfowlmodel and PublicLand pick these up instead of clipping.
+      print('\n#### Partitioning national layers ####')
+      outputs = {dstinfo[1]: dstinfo[11] for dstinfo in dstList}
+      aoiFeatures = {dstinfo[1]: dstinfo[0] for dstinfo in dstList}
+      partitioner = waterfowlmodel.partition.Partitioner(aoi, aoifield, workers=workers)
+      partitioner.partition(binIt, 'bin', outputs, aoiFeatures=aoiFeatures)
+      partitioner.partition(wetland.inData, 'wetland', outputs, aoiFeatures=aoiFeatures)
+      partitioner.partition(demand.inData, 'demand', outputs, waterfowlmodel.partition.DEMAND_RATIO_FIELDS, aoiFeatures)
+      for a, k in enumerate(extra.keys()):
+         partitioner.partition(extra[k][0], 'extra' + str(a), outputs, aoiFeatures=aoiFeatures)
+      partitioner.partition(padus.inData, 'padus', outputs, aoiFeatures=aoiFeatures)
+      if nced:
+         partitioner.partition(nced.inData, 'nced', outputs, aoiFeatures=aoiFeatures)
+      runlog.markDone('_national', 'partition')
+
+   # Start the most expensive areas of interest first so a large state doesn't start last while the other workers sit idle
+   print('\n#### Estimating area of interest cost ####')
+   costs = waterfowlmodel.scheduler.estimateCosts(dstList)
+   dstList = waterfowlmodel.scheduler.longestFirst(dstList, costs)
+   printlog('\tRun order', ' '.join(dstinfo[1] for dstinfo in dstList))
+   # Areas of interest that would take longer than an even share of the whole run on one worker are split into tiles
+   tiled = []
+   if tiles and stages is None:
+      tiled = [dstinfo for dstinfo in dstList if costs[dstinfo[1]] > sum(costs.values()) / workers]
+      printlog('\tTiled', ' '.join(dstinfo[1] for dstinfo in tiled))
+
    # Setup pool and map
    print("Creating pool")
-   with poolcontext(processes=8) as pool:
-      results = pool.map(partial(calc, debug=debug, args=args, outputgdb=outputgdb, nced=nced, padus=padus, aoiname=aoiname, aoiworkspace=aoiworkspace, cleanRun=cleanRun, fieldTable=fieldTable), dstList)
+   runCalc = partial(retryCalc, func=partial(calc, stages=stages, args=args, outputgdb=outputgdb, nced=nced, padus=padus, aoiname=aoiname, aoiworkspace=aoiworkspace, cleanRun=cleanRun, fieldTable=fieldTable), retries=retries, resume=resume)
+   # Pool workers are daemons and can't start the processes of separate stages unless the pool is made with the host context
+   poolKwargs = {'context': waterfowlmodel.stages.HostContext()} if args.stageWorkers[0] > 1 else {}
+   with poolcontext(processes=workers, initializer=initWorker, initargs=(storeFolder, waterfowlmodel.logqueue.poolArgs().get('initargs')), **poolKwargs) as pool:
+      jobs = []
+      tileSets = {}
+      if tiled:
+         print('\n#### Splitting large areas of interest into tiles ####')
+         tileSets = dict(waterfowlmodel.scheduler.runAdmitted(pool, partial(prepareTiles, ntiles=tiles, cleanRun=cleanRun, runlog=runlog), tiled, workers, budget))
+         # Energy supply for every tile first.  Demand needs the county energy totals of the whole area of interest.
+         allTiles = [tile + [{'stages': ['merge'], 'cleanRun': cleanRun}] for name in tileSets if tileSets[name] for tile in tileSets[name]]
+         waterfowlmodel.scheduler.runAdmitted(pool, runCalc, allTiles, workers, budget)
+         for dstinfo in tiled:
+            if not tileSets[dstinfo[1]] or any(runlog.status(tile[1]) == 'failed' for tile in tileSets[dstinfo[1]]):
+               # Fall back to running the whole area of interest on one worker
+               print(' !! Tiling failed for {}.  Running it without tiles'.format(dstinfo[1]))
+               tileSets.pop(dstinfo[1])
+               continue
+            fipsum = waterfowlmodel.tiling.fipsTotals(tileSets[dstinfo[1]], os.path.join(dstinfo[11], 'tilefipsum'))
+            jobs += [tile + [{'stages': waterfowlmodel.tiling.TILE_STAGES, 'cleanRun': 0, 'fipsum': fipsum}] for tile in tileSets[dstinfo[1]]]
+      jobs += [dstinfo for dstinfo in dstList if dstinfo[1] not in tileSets]
+      results = waterfowlmodel.scheduler.runAdmitted(pool, runCalc, jobs, workers, budget)
+      if tileSets:
+         # Concatenate the per-bin tile results then run the stages that need the whole area of interest
+         merged = []
+         for dstinfo in tiled:
+            if dstinfo[1] not in tileSets:
+               continue
+            failed = [tile[1] for tile in tileSets[dstinfo[1]] if runlog.status(tile[1]) == 'failed']
+            if failed:
+               runlog.failed(dstinfo[1], 'Tiles failed: ' + ', '.join(failed))
+               continue
+            merged.append(dstinfo + [dict(waterfowlmodel.tiling.mergeTiles(dstinfo, tileSets[dstinfo[1]], outputgdb), stages=['web'], cleanRun=0)])
+         results += waterfowlmodel.scheduler.runAdmitted(pool, runCalc, merged, workers, budget)
+   failed = [dstinfo[1] for dstinfo in dstList if runlog.status(dstinfo[1]) == 'failed']
+   if failed:
+      printlog('\t !! Failed areas of interest.  Rerun with --resume to retry them', ' '.join(failed))
    printlog('\t Returning results', ' '.join(results))
+   if args.profile:
+      tracePath, summaryPath = waterfowlmodel.profiling.export(os.path.join(aoiworkspace, '_profile'))
+      printlog('\tProfile trace', tracePath)
+      printlog('\tProfile summary', summaryPath)
+
+   if args.scenarios:
+      # Matrices of every area of interest and tile of this run are evaluated together so the summary covers the whole run.  They're taken from the run
+      # manifest so folders left by earlier runs in _scenarios aren't counted.
+      print('\n#### Evaluating kcal scenarios ####')
+      names = []
+      for dstinfo in dstList:
+         names += [tile[1] for tile in tileSets[dstinfo[1]]] if dstinfo[1] in tileSets else [dstinfo[1]]
+      matrices = sorted(filter(None, (runlog.completedStages(name).get('scenario', {}).get('scenarioMatrix') for name in names)))
+      if matrices:
+         printlog('\tScenario summary', waterfowlmodel.scenario.runScenarios(matrices, [kcalTable] + args.scenarios, os.path.join(aoiworkspace, '_scenarios')))
 
    if arcpy.Exists(os.path.join(outputgdb, 'ReadyForWeb')):
       arcpy.Delete_management(os.path.join(outputgdb, 'ReadyForWeb'))
@@ -279,11 +500,11 @@ def main(argv):
 
    waterfowl.calculateStandardizedABDU(os.path.join(outputgdb, 'ReadyForWeb'), binUnique)
    arcpy.env.workspace = outputgdb
-   if debug[9]: #Zip it
+   if zipit: #Zip it
       print('\n#### Zip data ####')
       arcpy.ClearWorkspaceCache_management()
       try:
-         waterfowlmodel.zipup.zipUp(os.path.join(os.path.join(workspace, args.aoi[0])), outputFolder)
+         waterfowlmodel.zipup.zipUp(os.path.join(os.path.join(workspace, args.aoi[0])), outputFolder, workers, args.zipCache)
       except Exception as e:
          print(e)
          errors = True
@@ -291,270 +512,390 @@ def main(argv):
    print('#####################################')
    print("Started a: ", comparetime.strftime('%H:%M:%S on %A, %B the %dth, %Y'))
    print("Finalized at: ", datetime.datetime.now().strftime('%H:%M:%S on %A, %B the %dth, %Y'))
+   waterfowlmodel.logqueue.stop(logwriter)
    sys.exit()
 
-def calc(dstinfo, debug, args, outputgdb, nced, padus, aoiname, aoiworkspace, cleanRun, fieldTable):
+def supplyStage(ctx):
+   """Energy supply.  Classifies habitat, calculates available energy, and bins it."""
+   dst, dstinfo, args = ctx['dst'], ctx['dstinfo'], ctx['args']
+   printlog('\n#### ENERGY SUPPLY for ', dstinfo[1])
+   print('\tWetland crossclass')
+   dst.wetland = dst.supaCrossClass(dst.wetland, dst.crossTbl, dst.classAttr)
+   for i in dst.extra.keys():
+      dst.crossClass(dst.extra[i][0], dst.extra[i][1])
+   print('\tJoin supply habitats')
+   print(dst.wetland)
+   if int(len(args.extra)/2) > 0:
+      dst.mergedenergy = dst.joinEnergy(dst.wetland, dst.extra, dst.mergedenergy)
+   elif not waterfowlmodel.fingerprint.isCurrent(dst.mergedenergy, [dst.wetland]):
+      arcpy.CopyFeatures_management(dst.wetland, dst.mergedenergy)
+      waterfowlmodel.fingerprint.record(dst.mergedenergy, [dst.wetland])
+   printlog('\tPrep supply Energy for ', dstinfo[1])
+   # Rebuilding the selection every run would change it and the energy calculated from it would never be reused
+   if not waterfowlmodel.fingerprint.isCurrent(dst.mergedenergy + 'Selection', [dst.mergedenergy]):
+      allEnergy = arcpy.SelectLayerByAttribute_management(in_layer_or_view=dst.mergedenergy, selection_type="NEW_SELECTION", where_clause="CLASS IS NOT NULL")
+      if arcpy.Exists(dst.mergedenergy + 'Selection'):
+         arcpy.Delete_management(dst.mergedenergy + 'Selection')
+      arcpy.CopyFeatures_management(allEnergy, dst.mergedenergy + 'Selection')
+      waterfowlmodel.fingerprint.record(dst.mergedenergy + 'Selection', [dst.mergedenergy])
+   dst.mergedenergy = dst.mergedenergy + 'Selection' 
+   # The wetland coordinate system is set when the clean copy is made, before it's fingerprinted
+   coord_sys = arcpy.Describe(dst.wetland).spatialReference
+   dst.mergedenergy = dst.prepEnergyFast(dst.mergedenergy, dst.kcalTbl, coord_sys)
+   print('\tMerge supply Energy for ', dstinfo[1])
+   dst.energysupply = dst.aggproportion(dst.binIt, dst.mergedenergy, "OBJECTID", ["avalNrgy", "CalcHA"], dst.binUnique, dst.scratch, "supplyenergy")
+   if not len(arcpy.ListFields(dst.energysupply,'THabNrg'))>0:
+      arcpy.AlterField_management(dst.energysupply, 'SUM_avalNrgy', 'THabNrg', 'TotalHabitatEnergy')
+   if not len(arcpy.ListFields(dst.energysupply,'THabHA'))>0:
+      arcpy.AlterField_management(dst.energysupply, 'SUM_CalcHA', 'THabHA', 'TotalHabitatHA')
+   return {'mergedenergy': dst.mergedenergy, 'energysupply': dst.energysupply}
+
+def mergeStage(ctx):
+   """Energy demand inputs.  Unions the NAWCA stepdown demand for all species with the bins and the energy supply."""
+   dst, dstinfo = ctx['dst'], ctx['dstinfo']
+   printlog('\n#### ENERGY DEMAND for ', dstinfo[1])
+   print('\n dst.demand', dst.demand)
+   mergedAll, wtmarray = None, None
+   demandSelected = os.path.join(dst.scratch, 'EnergyDemandSelected')
+   selectDemand = arcpy.SelectLayerByAttribute_management(in_layer_or_view=dst.demand, selection_type="NEW_SELECTION", where_clause="species = 'All'")
+   if arcpy.management.GetCount(selectDemand)[0] > "0":
+      arcpy.CopyFeatures_management(selectDemand, demandSelected)
+      mergedAll, wtmarray = dst.prepnpTables(demandSelected, dst.binIt, ctx['mergedenergy'], dst.scratch)
+   elif arcpy.management.GetCount(selectDemand)[0] == "0":
+      print('No records with "All" species. Not calculated')
+   return {'demandSelected': demandSelected, 'mergedAll': mergedAll, 'wtmarray': wtmarray}
+
+def demandStage(ctx):
+   """Energy demand.  Proportions NAWCA stepdown demand to bins by available energy."""
+   dst = ctx['dst']
+   if ctx['mergedAll']:
+      dst.demand = dst.aggByField(ctx['mergedAll'], dst.scratch, ctx['demandSelected'], dst.binIt, 'energydemand', ctx.get('fipsum'))
+      print('finished agg by field')
+      dst.weightedMean(dst.demand, ctx['wtmarray'])
+   return {'demand': dst.demand}
+
+def speciesStage(ctx):
+   """Species proportion.  Uses the original demand layer, and not the derived demand layer that only includes summed values for all species."""
+   dst, dstinfo = ctx['dst'], ctx['dstinfo']
+   printlog('\n#### ENERGY DEMAND BY SPECIES for ', dstinfo[1])
+   dst.summarizebySpecies(dst.origDemand, dst.scratch, dst.binIt, dst.binUnique, ctx['mergedAll'], ctx['fieldTable'])
+   outSpecies = dst.energyBySpecies(dst.origDemand, dst.scratch, dst.binIt, ctx['mergedAll'])
+   return {'species': outSpecies}
+
+def publicStage(ctx):
+   """Public lands.  Clips and merges PADUS and NCED then bins protected hectares."""
+   dst, dstinfo, nced, padus = ctx['dst'], ctx['dstinfo'], ctx['nced'], ctx['padus']
+   printlog('\n#### PUBLIC LANDS for ', dstinfo[1])
+   if nced:
+      nced = waterfowlmodel.publicland.PublicLand(dst.aoi, nced.inData, 'nced', dst.binIt, dst.scratch)
+   padus = waterfowlmodel.publicland.PublicLand(dst.aoi, padus.inData, 'padus', dst.binIt, dst.scratch)
+   print('\tPublic lands ready. Analyzing')
+   if nced:
+      dst.protectedMerge, protdiff = dst.pandasMerge(padus.land, nced.land, os.path.join(dst.scratch, "Protected" + dst.aoiname))
+   else:
+      if not len(arcpy.ListFields(padus.land,'CalcHA'))>0:
+         arcpy.AddField_management(padus.land, 'CalcHA', "DOUBLE", 9, 2, "", "Hectares")
+      dst.protectedMerge = dst.gpdToGDB(padus.land, ['NAME_E'], 'CalcHA', 'padfix')
+      coord_sys = arcpy.Describe(dst.binIt).spatialReference
+      arcpy.DefineProjection_management(dst.protectedMerge, coord_sys)
+   protectedbin = dst.aggproportion(dst.binIt, dst.protectedMerge, "OBJECTID", ["CalcHA"], [dst.binUnique], dst.scratch, "protectedbin")
+   if not len(arcpy.ListFields(protectedbin,'ProtHA'))>0:
+      if len(arcpy.ListFields(protectedbin,'SUM_CalcHA'))>0:
+         arcpy.AlterField_management(protectedbin, 'SUM_CalcHA', 'ProtHA', 'ProtectedHectares')
+      else:
+         arcpy.AlterField_management(protectedbin, 'CalcHA', 'ProtHA', 'ProtectedHectares')
+   return {'protectedMerge': dst.protectedMerge, 'protectedbin': protectedbin}
+
+def protectedEnergyStage(ctx):
+   """Protected habitat.  Calculates and bins protected habitat energy and hectares."""
+   dst = ctx['dst']
+   print('\tCalculate and bin protected habitat energy and hectares')
+   dst.calcProtected(ctx['mergedenergy'], ctx['protectedMerge'], dst.protectedEnergy)
+   dst.protectedEnergy = dst.aggproportion(dst.binIt, dst.protectedEnergy, "OBJECTID", ["CalcHA", "avalNrgy"], [dst.binUnique], dst.scratch, "protectedEnergy")
+   if not len(arcpy.ListFields(dst.protectedEnergy,'ProtHabHA'))>0:
+      if len(arcpy.ListFields(dst.protectedEnergy,'SUM_CalcHA'))>0:
+         arcpy.AlterField_management(dst.protectedEnergy, 'SUM_CalcHA', 'ProtHabHA', 'ProtectedHabitatHectares')
+      else:
+         arcpy.AlterField_management(dst.protectedEnergy, 'CalcHA', 'ProtHabHA', 'ProtectedHabitatHectares')
+   if not len(arcpy.ListFields(dst.protectedEnergy,'ProtHabNrg'))>0:
+      if len(arcpy.ListFields(dst.protectedEnergy,'SUM_avalNrgy'))>0:   
+         arcpy.AlterField_management(dst.protectedEnergy, 'SUM_avalNrgy', 'ProtHabNrg', 'ProtectedHabitatEnergy')
+      else:
+         arcpy.AlterField_management(dst.protectedEnergy, 'avalNrgy', 'ProtHabNrg', 'ProtectedHabitatEnergy')
+   return {'protectedEnergy': dst.protectedEnergy}
+
+def habitatStage(ctx):
+   """Habitat proportions by bin."""
+   dst, dstinfo = ctx['dst'], ctx['dstinfo']
+   printlog('\n#### HABITAT PERCENTAGE for ', dstinfo[1])
+   return {'habitat': dst.pctHabitatType(dst.binUnique[0], ctx['wtmarray'])}
+
+def urbanStage(ctx):
+   """Urban hectares by bin from the NLCD developed classes."""
+   dst, dstinfo, aoiname = ctx['dst'], ctx['dstinfo'], ctx['dst'].aoiname
+   printlog('\n#### Calculate Urban HA for ', dstinfo[1])
+   desc = arcpy.Describe(dst.aoi)
+   xmin = desc.extent.XMin
+   xmax = desc.extent.XMax
+   ymin = desc.extent.YMin
+   ymax = desc.extent.YMax
+   rectangle = str(xmin) + ' ' + str(ymin) + ' ' + str(xmax) + ' ' + str(ymax)
+   if not arcpy.Exists(os.path.join(dst.scratch, 'urbanclip' + aoiname)):
+      print(dst.urban, rectangle)
+      print(dst.scratch)
+      urbanClip = arcpy.management.Clip(dst.urban, rectangle, os.path.join(dst.scratch, 'urbanclip' + aoiname), dstinfo[0], '', "ClippingGeometry", "NO_MAINTAIN_EXTENT")
+   else:
+      print('Urbanclip exists.  Using that')
+      urbanClip = os.path.join(dst.scratch, 'urbanclip' + aoiname)
+   urbanExtract = arcpy.sa.ExtractByAttributes(urbanClip, "VALUE > 20 AND VALUE < 30")
+   urbanExtract.save(os.path.join(dst.scratch, 'urbanready' + aoiname))
+   arcpy.RasterToPolygon_conversion(os.path.join(dst.scratch, 'urbanready' + aoiname), os.path.join(dst.scratch, 'urbanPoly' + aoiname), "SIMPLIFY", "VALUE")
+   dst.urban = os.path.join(dst.scratch, 'urbanPoly' + aoiname)
+   cleanMe = waterfowlmodel.scratchstore.readFrame(dst.urban)
+   cleanMe['CalcHA'] = cleanMe.geometry.area/10000 #/10,000 for Hectares
+   try:
+      cleanMe = cleanMe.fillna('')
+   except:
+      print('not cleaning up cleanMe for', dst.aoiname)
+      pass
+   if arcpy.Exists(os.path.join(dst.scratch, 'urbanCleaned' + aoiname)):
+      arcpy.Delete_management(os.path.join(dst.scratch, 'urbanCleaned' + aoiname))
+   dst.urban = waterfowlmodel.scratchstore.writeFrame(cleanMe, os.path.join(dst.scratch, 'urbanCleaned' + aoiname))
+   dst.urban = dst.aggproportion(dst.binIt, dst.urban, "OBJECTID", ["CalcHA"], [dst.binUnique], dst.scratch, "urban")
+   if len(arcpy.ListFields(dst.urban,'SUM_CalcHA'))>0:
+      arcpy.AlterField_management(dst.urban, 'SUM_CalcHA', 'UrbanHA', 'Urban Hectares')
+   printlog('Urban done for', dstinfo[1])
+   return {'urban': dst.urban, 'urbanRaster': os.path.join(dst.scratch, 'urbanready' + aoiname)}
+
+def unavailableStage(ctx):
+   """Unavailable hectares by bin from urban and protected lands."""
+   return {'unavail': ctx['dst'].calcAvailable(ctx['urbanRaster'], ctx['protectedMerge'])}
+
+def modelStage(ctx):
+   """Full model.  Merges every binned dataset and calculates the restoration and protection goals."""
+   dst, dstinfo = ctx['dst'], ctx['dstinfo']
+   printlog('\n#### Merging all the data for output for ', dstinfo[1])
+   print('Energy supply', ctx['energysupply'])
+   print('Energy demand', ctx['demand'])
+   print('protected energy', ctx['protectedEnergy'])
+   print('Urban', ctx['urban'])
+   print('Unavailable ', ctx['unavail'])
+   mergebin = []
+   mergebin.append(dst.unionEnergy(ctx['energysupply'], ctx['demand'])) #Energy supply and demand
+   mergebin.append(ctx['protectedbin']) #Protected acres
+   mergebin.append(ctx['protectedEnergy']) #Protected energy
+   mergebin.append(ctx['urban']) #Urban - available HA
+   mergebin.append(ctx['unavail'])
+   return {'outData': dst.dstOutput(mergebin, ctx['outputgdb'])}
+
+def checkStage(ctx):
+   """Data check.  Compares model output totals with input totals."""
+   dst, dstinfo = ctx['dst'], ctx['dstinfo']
+   outData, demandSelected = ctx['outData'], ctx['demandSelected']
+   np.set_printoptions(suppress=True)
+   printlog('\n#### Checking data for ', dstinfo[1])
+   print('outData', outData)
+   print('mergedenergy', ctx['mergedenergy'])
+   print('demand selected', demandSelected)
+   print('protected', ctx['protectedMerge'])
+   if arcpy.Exists(os.path.join(dst.scratch, 'outputStats')):
+      arcpy.Delete_management(os.path.join(dst.scratch, 'outputStats'))
+   if arcpy.Exists(os.path.join(dst.scratch, 'demandStats')):
+      arcpy.Delete_management(os.path.join(dst.scratch, 'demandStats'))            
+   arcpy.Statistics_analysis(in_table=outData, out_table=os.path.join(dst.scratch, 'outputStats'), statistics_fields="tothabitat_kcal SUM; demand_lta_kcal SUM; dud_lta SUM; protected_ha SUM")
+   arcpy.Statistics_analysis(in_table=demandSelected, out_table=os.path.join(dst.scratch, 'demandStats'), statistics_fields="LTADemand SUM; LTADUD SUM")
+   outputStats = arcpy.da.TableToNumPyArray(os.path.join(dst.scratch, 'outputStats'), ['SUM_tothabitat_kcal', 'SUM_demand_lta_kcal', 'SUM_dud_lta','SUM_protected_ha'])
+   # The energy and protected lands layers are written by geopandas, so their sums are read from the scratch store
+   inenergystats = [[waterfowlmodel.scratchstore.readTable(ctx['mergedenergy'], ['avalNrgy'])['avalNrgy'].sum()]]
+   indemandstats = arcpy.da.TableToNumPyArray(os.path.join(dst.scratch, 'demandStats'), ['SUM_LTADemand', 'SUM_LTADUD'])
+   inprotstats = [[waterfowlmodel.scratchstore.readTable(ctx['protectedMerge'], ['CalcHA'])['CalcHA'].sum()]]
+   with open(os.path.join(os.path.dirname(dst.scratch),dstinfo[1]+'_OutputCheck.txt'), 'w') as f:
+      f.write('\nOutput energy : {}\nInput energy: {}'.format(outputStats[0][0], inenergystats[0][0]))
+      f.write('tEnergy difference %: {}'.format(int((outputStats[0][0] - inenergystats[0][0])/(outputStats[0][0] + inenergystats[0][0])*100)))
+      f.write('\nOutput demand: {}\nInput demand: {}'.format(outputStats[0][1], indemandstats[0][0]))
+      f.write('\tDemand  difference %: {}'.format(int((outputStats[0][1] - indemandstats[0][0])/(outputStats[0][1] + indemandstats[0][0])*100)))
+      f.write('\nOutput DUD: {}\nInput DUD: {}'.format(outputStats[0][2], indemandstats[0][1]))
+      f.write('\tDUD  difference %: {}'.format(int((outputStats[0][2] - indemandstats[0][1])/(outputStats[0][2] + indemandstats[0][1])*100)))
+      f.write('\nOutput Protection HA: {}\nInput HA: {}'.format(outputStats[0][3], inprotstats[0][0]))
+      f.write('\tProtection  difference %: {}'.format(int((outputStats[0][3] - inprotstats[0][0])/(outputStats[0][3] + inprotstats[0][0])*100)))
+   print('Stats  for ', dstinfo[1])
+   print('\nOutput energy: {}\nInput energy: {}'.format(outputStats[0][0], inenergystats[0][0]))
+   print('\tEnergy difference %: {}'.format(int((outputStats[0][0] - inenergystats[0][0])/(outputStats[0][0] + inenergystats[0][0])*100)))
+   print('\nOutput demand: {}\nInput demand: {}'.format(outputStats[0][1], indemandstats[0][0]))
+   print('\tDemand  difference %: {}'.format(int((outputStats[0][1] - indemandstats[0][0])/(outputStats[0][1] + indemandstats[0][0])*100)))
+   print('\nOutput DUD: {}\nInput DUD: {}'.format(outputStats[0][2], indemandstats[0][1]))
+   print('\tDUD  difference %: {}'.format(int((outputStats[0][2] - indemandstats[0][1])/(outputStats[0][2] + indemandstats[0][1])*100)))
+   print('\nOutput Protection HA: {}\nInput HA: {}'.format(outputStats[0][3], inprotstats[0][0]))
+   print('\tProtection  difference %: {}'.format(int((outputStats[0][3] - inprotstats[0][0])/(outputStats[0][3] + inprotstats[0][0])*100)))
+   return {'check': os.path.join(os.path.dirname(dst.scratch),dstinfo[1]+'_OutputCheck.txt')}
+
+def scenarioStage(ctx):
+   """Kcal scenarios.  Keeps the bin by habitat class hectares of the run and evaluates the alternative kcal tables on them."""
+   dst, args = ctx['dst'], ctx['args']
+   if not args.scenarios:
+      return {'scenarios': None, 'scenarioMatrix': None}
+   printlog('\n#### Kcal scenarios for ', dst.aoiname)
+   folder = os.path.join(ctx['aoiworkspace'], '_scenarios', dst.aoiname)
+   # The protectedEnergy output is binned.  The clip to protected lands it was made from keeps the habitat classes.
+   matrix = waterfowlmodel.scenario.buildMatrix(dst.binIt, dst.binUnique[0], ctx['mergedenergy'], os.path.join(dst.scratch, 'protectedEnergy'), ctx['outData'], folder)
+   return {'scenarios': waterfowlmodel.scenario.runScenarios([matrix], [dst.kcalTbl] + args.scenarios, folder), 'scenarioMatrix': matrix}
+
+def webStage(ctx):
+   """Merge for web.  Joins species demand and habitat percentages to the model output."""
+   dst = ctx['dst']
+   try:
+      print('\n#### Merging for Web pipeline for ' + dst.aoiname+ ' ####')
+      webReady = dst.mergeForWeb(ctx['outData'], ctx['species'], ctx['habitat'], ctx['outputgdb'])
+   except Exception as e:
+      print(e)
+      raise NameError(' !! Error {} for {}'.format(e, dst.aoiname))
+   return {'webReady': webReady}
+
+def modelStages():
+   """
+   Builds the stage graph for one area of interest.  Stages run one at a time in dependency order.  With --stageWorkers above 1 the stages that don't need
+   anything from other stages (supply, public lands and urban) and the unavailable stage run in their own processes next to the rest.
+
+   :return: Stage graph
+   :rtype: waterfowlmodel.stages.StageGraph
+   """
+   graph = waterfowlmodel.stages.StageGraph()
+   graph.add('supply', supplyStage, [], ['mergedenergy', 'energysupply'], separate=True)
+   graph.add('merge', mergeStage, ['mergedenergy'], ['demandSelected', 'mergedAll', 'wtmarray'])
+   graph.add('demand', demandStage, ['demandSelected', 'mergedAll', 'wtmarray'], ['demand'])
+   graph.add('species', speciesStage, ['mergedAll', 'fieldTable'], ['species'])
+   graph.add('public', publicStage, [], ['protectedMerge', 'protectedbin'], separate=True)
+   graph.add('protected', protectedEnergyStage, ['mergedenergy', 'protectedMerge'], ['protectedEnergy'])
+   graph.add('habitat', habitatStage, ['demand', 'wtmarray'], ['habitat'])
+   graph.add('urban', urbanStage, [], ['urban', 'urbanRaster'], separate=True)
+   graph.add('unavailable', unavailableStage, ['urbanRaster', 'protectedMerge'], ['unavail'], separate=True)
+   graph.add('model', modelStage, ['energysupply', 'demand', 'protectedbin', 'protectedEnergy', 'urban', 'unavail'], ['outData'])
+   graph.add('check', checkStage, ['outData', 'mergedenergy', 'demandSelected', 'protectedMerge'], ['check'])
+   graph.add('scenario', scenarioStage, ['outData', 'mergedenergy', 'protectedEnergy'], ['scenarios', 'scenarioMatrix'])
+   graph.add('web', webStage, ['outData', 'species', 'habitat'], ['webReady'])
+   return graph
+
+# Stages switched on by each position of the old --debug mask.  The last position (zip) is handled by main.
+DEBUG_STAGES = [['supply'], ['merge', 'demand'], ['species'], ['public', 'protected'], ['habitat'], ['urban', 'unavailable'], ['model'], ['check'], ['web']]
+
+def initStage(logArgs, storeFolder, aoiname, scratch, args, aoiworkspace):
+   """
+   Sets up a process running separate stages of an area of interest the same way calc sets up the pool worker running the area of interest.
+
+   :param logArgs: Log queue and level of the pool worker.  The queue is None when the log writer isn't running
+   :type logArgs: tuple
+   :param storeFolder: Shared national inputs the pool worker is attached to
+   :type storeFolder: str
+   :param aoiname: Area of interest name
+   :type aoiname: str
+   :param scratch: Scratch geodatabase of the area of interest
+   :type scratch: str
+   :param args: Command line arguments
+   :type args: argparse.Namespace
+   :param aoiworkspace: Workspace of the run
+   :type aoiworkspace: str
+   """
+   if logArgs[0] is not None:
+      waterfowlmodel.logqueue.install(*logArgs)
+   waterfowlmodel.logqueue.setAOI(aoiname)
+   waterfowlmodel.columnstore.attach(storeFolder)
+   waterfowlmodel.scratchstore.setBackend(args.scratchFormat[0], args.scratchGrid[0])
+   if args.profile:
+      waterfowlmodel.profiling.enable(os.path.join(aoiworkspace, '_profile'), aoiname, scratch)
+   arcpy.env.workspace = scratch
+   arcpy.env.overwriteOutput = True
+
+def calc(dstinfo, stages, args, outputgdb, nced, padus, aoiname, aoiworkspace, cleanRun, fieldTable, resume=False):
+   aoiname = dstinfo[1]
+   waterfowlmodel.logqueue.setAOI(aoiname)
+   runlog = waterfowlmodel.checkpoint.RunManifest(os.path.join(aoiworkspace, '_run'))
    try:
-      errors = False
-      startT = time.perf_counter()
       print('\n#### Create waterfowl object for ', dstinfo[1])   
-      aoiname = dstinfo[1]
+      # Tiles and merged tiles carry their own stages and context values after the Waterfowlmodel parameters
+      options = dict(dstinfo[13]) if len(dstinfo) > 13 else {}
+      stages = options.pop('stages', stages)
+      cleanRun = options.pop('cleanRun', cleanRun)
+      graph = modelStages()
+      key = ','.join(graph.resolve(stages, list(options)))
+      if resume:
+         result = runlog.result(aoiname, key)
+         if result is not None:
+            print('\tAlready finished {}.  Skipping'.format(aoiname))
+            return result
+         # Finished stages are provided from the run manifest instead of being run again
+         completed = runlog.completedStages(aoiname)
+         stages = [s for s in key.split(',') if s not in completed]
+         for s in completed:
+            options.update(completed[s])
+         printlog('\tResuming after', ' '.join(completed))
+      elif cleanRun:
+         # Dropping the manifests makes every intermediate out of date
+         waterfowlmodel.fingerprint.clearManifests(dstinfo[11])
+      waterfowlmodel.scratchstore.setBackend(args.scratchFormat[0], args.scratchGrid[0])
+      if args.profile:
+         waterfowlmodel.profiling.enable(os.path.join(aoiworkspace, '_profile'), aoiname, dstinfo[11])
       dst = waterfowl.Waterfowlmodel(dstinfo[0], dstinfo[1],dstinfo[2],dstinfo[3],dstinfo[4],dstinfo[5],dstinfo[6],dstinfo[7],dstinfo[8],dstinfo[9],dstinfo[10], dstinfo[11], dstinfo[12])
       print('#####################################')   
       printlog('\tRegion of interest', dst.aoiname)
       printlog('\tScratch gdb', dst.scratch)
       printlog('\tOutput gdb', outputgdb)
+      printlog('\tStages', ' '.join(graph.resolve(stages, list(options))))
       print('#####################################')
-      #logging.basicConfig(filename=os.path.join(aoiworkspace,"Waterfowl_" + aoiname + "_" + datetime.datetime.now().strftime("%m_%d_%Y")+ ".log"), filemode='w', level=logging.INFO)
-      #print(os.path.join(aoiworkspace,"Waterfowl_" + aoiname + "_" + datetime.datetime.now().strftime("%m_%d_%Y")+ ".log"))
       logging.info('Wetland layer '.join(map(str, list(dst.__dict__))))
-      if debug[0]: #Energy supply
-         printlog('\n#### ENERGY SUPPLY for ', dstinfo[1])
-         print('\tWetland crossclass')
-         dst.wetland = dst.supaCrossClass(dst.wetland, dst.crossTbl, dst.classAttr)
-         for i in dst.extra.keys():
-            dst.crossClass(dst.extra[i][0], dst.extra[i][1])
-         print('\tJoin supply habitats')
-         print(dst.wetland)
-         if cleanRun and arcpy.Exists(dst.mergedenergy):
-            arcpy.Delete_management(dst.mergedenergy)
-         if int(len(args.extra)/2) > 0:
-            dst.mergedenergy = dst.joinEnergy(dst.wetland, dst.extra, dst.mergedenergy)
-         else:
-            dst.mergedenergy = arcpy.CopyFeatures_management(dst.wetland, dst.mergedenergy)
-         printlog('\tPrep supply Energy for ', dstinfo[1])
-         allEnergy = arcpy.SelectLayerByAttribute_management(in_layer_or_view=dst.mergedenergy, selection_type="NEW_SELECTION", where_clause="CLASS IS NOT NULL")
-         if arcpy.Exists(dst.mergedenergy + 'Selection'):
-            arcpy.Delete_management(dst.mergedenergy + 'Selection')
-         arcpy.CopyFeatures_management(allEnergy, dst.mergedenergy + 'Selection')
-         dst.mergedenergy = dst.mergedenergy + 'Selection' 
-         dst.mergedenergy = dst.prepEnergyFast(dst.mergedenergy, dst.kcalTbl)
-         coord_sys = arcpy.Describe(dst.wetland).spatialReference
-         arcpy.DefineProjection_management(dst.mergedenergy, coord_sys)
-         print('\tMerge supply Energy for ', dstinfo[1])
-         dst.energysupply = dst.aggproportion(dst.binIt, dst.mergedenergy, "OBJECTID", ["avalNrgy", "CalcHA"], dst.binUnique, dst.scratch, "supplyenergy")
-         if not len(arcpy.ListFields(dst.energysupply,'THabNrg'))>0:
-            arcpy.AlterField_management(dst.energysupply, 'SUM_avalNrgy', 'THabNrg', 'TotalHabitatEnergy')
-         if not len(arcpy.ListFields(dst.energysupply,'THabHA'))>0:
-            arcpy.AlterField_management(dst.energysupply, 'SUM_CalcHA', 'THabHA', 'TotalHabitatHA')
-      else:
-         if arcpy.Exists(os.path.join(dst.scratch, 'aggtosupplyenergy')):
-            dst.energysupply = os.path.join(dst.scratch, 'aggtosupplyenergy')
-         else:
-            print(' !! Energy needs to be run.  no aggtosupplyenergy. {}'.format(dst.aoiname))
-            raise('No aggtosupply for {}'.format(dst.aoiname))
-         #toSHP = os.path.join(os.path.dirname(os.path.dirname(dst.mergedenergy)), 'test'+dst.aoiname+'.shp')         
-         if arcpy.Exists(os.path.join(dst.scratch,'MergedEnergySelectionclean')):
-            dst.mergedenergy = "MergedEnergySelectionclean"
-            #dst.mergedenergy = os.path.join(dst.scratch,'Wetland_projectedSelectionclean')
-         else:
-            print(' !! Energy needs to be run. no mergedenergy {}'.format(dst.aoiname))
-            raise('No mergedenergy for {}'.format(dst.aoiname))
-      if debug[1]: #Energy demand
-         printlog('\n#### ENERGY DEMAND for ', dstinfo[1])
-         print('\n dst.demand', dst.demand)
-         selectDemand = arcpy.SelectLayerByAttribute_management(in_layer_or_view=dst.demand, selection_type="NEW_SELECTION", where_clause="species = 'All'")
-         if arcpy.management.GetCount(selectDemand)[0] > "0":
-            arcpy.CopyFeatures_management(selectDemand, os.path.join(dst.scratch, 'EnergyDemandSelected'))
-            demandSelected = os.path.join(dst.scratch, 'EnergyDemandSelected')
-            # Debug commented out these two lines below
-            mergedAll, wtmarray = dst.prepnpTables(demandSelected, dst.binIt, dst.mergedenergy, dst.scratch)
-            #mergedAll = arcpy.SelectLayerByAttribute_management(in_layer_or_view=mergedAll, selection_type="NEW_SELECTION", where_clause=dst.binUnique[0]+ " <> ''")
-            # Debug added line
-            #mergedAll = os.path.join(dst.scratch, 'MergeAll')
-            dst.demand = dst.aggByField(mergedAll, dst.scratch, demandSelected, dst.binIt, 'energydemand')
-            print('finished agg by field')
-            dst.weightedMean(dst.demand, wtmarray)
-         elif arcpy.management.GetCount(selectDemand)[0] == "0":
-            print('No records with "All" species. Not calculated')
-      else:
-         demandSelected = os.path.join(dst.scratch, 'EnergyDemandSelected')
-         dst.demand = os.path.join(dst.scratch, 'aggByFieldenergydemanddissolveHUC')
-         #mergedAll, wtmarray = dst.prepnpTables(dst.demand, dst.binIt, dst.mergedenergy, dst.scratch)
-         #dst.weightedMean(dst.demand, wtmarray)
-         #dst.origDemand = dst.demand.inData
-
-      if debug[2]: # Species proportion,use the original demand layer, and not the derived demand layer that only includes summed values for all species.
-         printlog('\n#### ENERGY DEMAND BY SPECIES for ', dstinfo[1])
-         dst.summarizebySpecies(dst.origDemand, dst.scratch, dst.binIt, dst.binUnique, os.path.join(dst.scratch, 'MergeAll'), fieldTable)
-         outSpecies = dst.energyBySpecies(dst.origDemand, dst.scratch, dst.binIt, os.path.join(dst.scratch, 'MergeAll'))
-
-      if debug[3]: #Public lands
-         printlog('\n#### PUBLIC LANDS for ', dstinfo[1])
-         if nced:
-            nced = waterfowlmodel.publicland.PublicLand(dst.aoi, nced.inData, 'nced', dst.binIt, dst.scratch)
-         padus = waterfowlmodel.publicland.PublicLand(dst.aoi, padus.inData, 'padus', dst.binIt, dst.scratch)
-         print('\tPublic lands ready. Analyzing')
-         #dst.prepProtected([nced.land, padus.land])
-         if nced:
-            dst.protectedMerge, protdiff = dst.pandasMerge(padus.land, nced.land, os.path.join(aoiworkspace, "Protected" + aoiname + ".shp"))
-         else:
-            #dst.protectedMerge = padus.land
-            if not len(arcpy.ListFields(padus.land,'CalcHA'))>0:
-               arcpy.AddField_management(padus.land, 'CalcHA', "DOUBLE", 9, 2, "", "Hectares")
-            dst.protectedMerge, protdiff = dst.gpdToGDB(padus.land, ['NAME_E'], 'CalcHA', 'padfix')
-            coord_sys = arcpy.Describe(dst.wetland).spatialReference
-            arcpy.DefineProjection_management(dst.protectedMerge, coord_sys)
-         protectedbin = dst.aggproportion(dst.binIt, dst.protectedMerge, "OBJECTID", ["CalcHA"], [dst.binUnique], dst.scratch, "protectedbin")
-         if not len(arcpy.ListFields(protectedbin,'ProtHA'))>0:
-            if len(arcpy.ListFields(protectedbin,'SUM_CalcHA'))>0:
-               arcpy.AlterField_management(protectedbin, 'SUM_CalcHA', 'ProtHA', 'ProtectedHectares')
-            else:
-               arcpy.AlterField_management(protectedbin, 'CalcHA', 'ProtHA', 'ProtectedHectares')
-         print('\tCalculate and bin protected habitat energy and hectares')
-         dst.calcProtected(dst.mergedenergy, dst.protectedMerge, dst.protectedEnergy)
-         dst.protectedEnergy = dst.aggproportion(dst.binIt, dst.protectedEnergy, "OBJECTID", ["CalcHA", "avalNrgy"], [dst.binUnique], dst.scratch, "protectedEnergy")
-         if not len(arcpy.ListFields(dst.protectedEnergy,'ProtHabHA'))>0:
-            if len(arcpy.ListFields(dst.protectedEnergy,'SUM_CalcHA'))>0:
-               arcpy.AlterField_management(dst.protectedEnergy, 'SUM_CalcHA', 'ProtHabHA', 'ProtectedHabitatHectares')
-            else:
-               arcpy.AlterField_management(dst.protectedEnergy, 'CalcHA', 'ProtHabHA', 'ProtectedHabitatHectares')
-         if not len(arcpy.ListFields(dst.protectedEnergy,'ProtHabNrg'))>0:
-            if len(arcpy.ListFields(dst.protectedEnergy,'SUM_avalNrgy'))>0:   
-               arcpy.AlterField_management(dst.protectedEnergy, 'SUM_avalNrgy', 'ProtHabNrg', 'ProtectedHabitatEnergy')
-            else:
-               arcpy.AlterField_management(dst.protectedEnergy, 'avalNrgy', 'ProtHabNrg', 'ProtectedHabitatEnergy')
-      else:
-         dst.protectedEnergy = os.path.join(dst.scratch, 'aggToprotectedEnergy')
-         if nced:
-            dst.protectedMerge = os.path.join(aoiworkspace, "Protected" + aoiname + ".shp")
-            #pad = gpd.read_file(os.path.dirname(padus.land), layer=os.path.basename(padus.land), driver='FileGDB')
-            #nced = gpd.read_file(os.path.dirname(nced.land), layer=os.path.basename(nced.land), driver='FileGDB')
-            #protdiff = gpd.overlay(pad, nced, how='union')
-         else:   
-            dst.protectedMerge = os.path.join(dst.scratch, 'protectedEnergy')
-            #protdiff = gpd.read_file(os.path.dirname(padus.land), layer=os.path.basename(padus.land), driver='FileGDB')
-      
-      if debug[4]: #Habitat proportions
-         printlog('\n#### HABITAT PERCENTAGE for ', dstinfo[1])
-         if not debug[1]:
-            mergedAll, wtmarray = dst.prepnpTables(dst.demand, dst.binIt, dst.mergedenergy, dst.scratch)
-         dst.pctHabitatType(dst.binUnique[0], wtmarray)
-         
-      if debug[5]: #Urban calculations
-         printlog('\n#### Calculate Urban HA for ', dstinfo[1])
-         desc = arcpy.Describe(dst.aoi)
-         xmin = desc.extent.XMin
-         xmax = desc.extent.XMax
-         ymin = desc.extent.YMin
-         ymax = desc.extent.YMax
-         rectangle = str(xmin) + ' ' + str(ymin) + ' ' + str(xmax) + ' ' + str(ymax)
-         if not arcpy.Exists(os.path.join(dst.scratch, 'urbanclip' + aoiname)):
-            print(dst.urban, rectangle)
-            print(dst.scratch)
-            urbanClip = arcpy.management.Clip(dst.urban, rectangle, os.path.join(dst.scratch, 'urbanclip' + aoiname), dstinfo[0], '', "ClippingGeometry", "NO_MAINTAIN_EXTENT")
-         else:
-            print('Urbanclip exists.  Using that')
-            urbanClip = os.path.join(dst.scratch, 'urbanclip' + aoiname)
-         urbanExtract = arcpy.sa.ExtractByAttributes(urbanClip, "VALUE > 20 AND VALUE < 30")
-         urbanExtract.save(os.path.join(dst.scratch, 'urbanready' + aoiname))
-         arcpy.RasterToPolygon_conversion(os.path.join(dst.scratch, 'urbanready' + aoiname), os.path.join(dst.scratch, 'urbanPoly' + aoiname), "SIMPLIFY", "VALUE")
-         dst.urban = os.path.join(dst.scratch, 'urbanPoly' + aoiname)
-         toSHP = os.path.join(os.path.dirname(os.path.dirname(dst.urban)), 'urban'+aoiname+'.shp')
-         cleanMe = gpd.read_file(os.path.dirname(dst.urban), layer=os.path.basename(dst.urban), driver='FileGDB')
-         cc = CRS('PROJCS["North_America_Albers_Equal_Area_Conic",GEOGCS["GCS_North_American_1983",DATUM["North_American_Datum_1983",SPHEROID["GRS_1980",6378137.0,298.257222101]],PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433],AUTHORITY["EPSG","4269"]],PROJECTION["Albers_Conic_Equal_Area"],PARAMETER["False_Easting",0.0],PARAMETER["False_Northing",0.0],PARAMETER["longitude_of_center",-96.0],PARAMETER["Standard_Parallel_1",20.0],PARAMETER["Standard_Parallel_2",60.0],PARAMETER["latitude_of_center",40.0],UNIT["Meter",1.0],AUTHORITY["Esri","102008"]]')
-         cleanMe['CalcHA'] = cleanMe.geometry.area/10000 #/10,000 for Hectares
-         try:
-            cleanMe = cleanMe.fillna('')
-         except:
-            print('not cleaning up cleanMe for', dst.aoiname)
-            pass
-         cleanMe.to_file(os.path.join(os.path.dirname(toSHP), 'urbanCleaned'+aoiname+'.shp'))
-         dst.urban = os.path.join(os.path.dirname(toSHP), 'urbanCleaned'+aoiname+'.shp')      
-         dst.urban = dst.aggproportion(dst.binIt, dst.urban, "OBJECTID", ["CalcHA"], [dst.binUnique], dst.scratch, "urban")
-         if len(arcpy.ListFields(dst.urban,'SUM_CalcHA'))>0:
-            arcpy.AlterField_management(dst.urban, 'SUM_CalcHA', 'UrbanHA', 'Urban Hectares')
-         printlog('Urban done for', dstinfo[1])
-         unavail = dst.calcAvailable(os.path.join(dst.scratch, 'urbanready' + aoiname), dst.protectedMerge)
-
-      else:      
-         dst.urban = os.path.join(dst.scratch, 'aggtourban')
-         mergeUrban = os.path.join(os.path.dirname(os.path.dirname(dst.urban)), 'urbanCleaned'+aoiname+'.shp')
-         if arcpy.Exists(os.path.join(dst.scratch, 'unavailableBin')):
-            unavail = os.path.join(dst.scratch, 'unavailableBin')
-         else: 
-            unavail = dst.calcAvailable(os.path.join(dst.scratch, 'urbanready' + aoiname), dst.protectedMerge)
-      
-      mergebin = []
-      if debug[6]: #full model
-         printlog('\n#### Merging all the data for output for ', dstinfo[1])
-         print('Energy supply', dst.energysupply)
-         print('Energy demand', dst.demand)
-         print('protected energy', dst.protectedEnergy)
-         print('Urban', dst.urban)
-         print('Unavailable ', unavail)
-         mergebin.append(dst.unionEnergy(dst.energysupply, dst.demand)) #Energy supply and demand
-         mergebin.append(os.path.join(dst.scratch, 'aggtoprotectedbin')) #Protected acres
-         mergebin.append(dst.protectedEnergy) #Protected energy
-         mergebin.append(dst.urban) #Urban - available HA
-         mergebin.append(unavail)
-         outData = dst.dstOutput(mergebin, outputgdb)
-      else:
-         outData = os.path.join(dst.scratch, dst.aoiname+'_Output')
-
-      if debug[7]: #Data check
-         np.set_printoptions(suppress=True)
-         printlog('\n#### Checking data for ', dstinfo[1])
-         print('outData', outData)
-         print('mergedenergy', dst.mergedenergy)
-         print('demand selected', demandSelected)
-         print('protected', dst.protectedMerge)
-         if arcpy.Exists(os.path.join(dst.scratch, 'outputStats')):
-            arcpy.Delete_management(os.path.join(dst.scratch, 'outputStats'))
-         if arcpy.Exists(os.path.join(dst.scratch, 'mergedEnergyStats')):
-            arcpy.Delete_management(os.path.join(dst.scratch, 'mergedEnergyStats'))
-         if arcpy.Exists(os.path.join(dst.scratch, 'demandStats')):
-            arcpy.Delete_management(os.path.join(dst.scratch, 'demandStats'))            
-         if arcpy.Exists(os.path.join(dst.scratch, 'protStats')):
-            arcpy.Delete_management(os.path.join(dst.scratch, 'protStats'))                  
-         arcpy.Statistics_analysis(in_table=outData, out_table=os.path.join(dst.scratch, 'outputStats'), statistics_fields="tothabitat_kcal SUM; demand_lta_kcal SUM; dud_lta SUM; protected_ha SUM")
-         arcpy.Statistics_analysis(in_table=dst.mergedenergy, out_table=os.path.join(dst.scratch, 'mergedEnergyStats'), statistics_fields="avalNrgy SUM")
-         arcpy.Statistics_analysis(in_table=demandSelected, out_table=os.path.join(dst.scratch, 'demandStats'), statistics_fields="LTADemand SUM; LTADUD SUM")
-         arcpy.Statistics_analysis(in_table=dst.protectedMerge, out_table=os.path.join(dst.scratch, 'protStats'), statistics_fields="CalcHA SUM")
-         outputStats = arcpy.da.TableToNumPyArray(os.path.join(dst.scratch, 'outputStats'), ['SUM_tothabitat_kcal', 'SUM_demand_lta_kcal', 'SUM_dud_lta','SUM_protected_ha'])
-         inenergystats = arcpy.da.TableToNumPyArray(os.path.join(dst.scratch, 'mergedEnergyStats'), ['SUM_avalNrgy'])
-         indemandstats = arcpy.da.TableToNumPyArray(os.path.join(dst.scratch, 'demandStats'), ['SUM_LTADemand', 'SUM_LTADUD'])
-         inprotstats = arcpy.da.TableToNumPyArray(os.path.join(dst.scratch, 'protStats'), ['SUM_CalcHA'])
-         with open(os.path.join(os.path.dirname(dst.scratch),dstinfo[1]+'_OutputCheck.txt'), 'w') as f:
-            f.write('\nOutput energy : {}\nInput energy: {}'.format(outputStats[0][0], inenergystats[0][0]))
-            f.write('tEnergy difference %: {}'.format(int((outputStats[0][0] - inenergystats[0][0])/(outputStats[0][0] + inenergystats[0][0])*100)))
-            f.write('\nOutput demand: {}\nInput demand: {}'.format(outputStats[0][1], indemandstats[0][0]))
-            f.write('\tDemand  difference %: {}'.format(int((outputStats[0][1] - indemandstats[0][0])/(outputStats[0][1] + indemandstats[0][0])*100)))
-            f.write('\nOutput DUD: {}\nInput DUD: {}'.format(outputStats[0][2], indemandstats[0][1]))
-            f.write('\tDUD  difference %: {}'.format(int((outputStats[0][2] - indemandstats[0][1])/(outputStats[0][2] + indemandstats[0][1])*100)))
-            f.write('\nOutput Protection HA: {}\nInput HA: {}'.format(outputStats[0][3], inprotstats[0][0]))
-            f.write('\tProtection  difference %: {}'.format(int((outputStats[0][3] - inprotstats[0][0])/(outputStats[0][3] + inprotstats[0][0])*100)))
-         print('Stats  for ', dstinfo[1])
-         print('\nOutput energy: {}\nInput energy: {}'.format(outputStats[0][0], inenergystats[0][0]))
-         print('\tEnergy difference %: {}'.format(int((outputStats[0][0] - inenergystats[0][0])/(outputStats[0][0] + inenergystats[0][0])*100)))
-         print('\nOutput demand: {}\nInput demand: {}'.format(outputStats[0][1], indemandstats[0][0]))
-         print('\tDemand  difference %: {}'.format(int((outputStats[0][1] - indemandstats[0][0])/(outputStats[0][1] + indemandstats[0][0])*100)))
-         print('\nOutput DUD: {}\nInput DUD: {}'.format(outputStats[0][2], indemandstats[0][1]))
-         print('\tDUD  difference %: {}'.format(int((outputStats[0][2] - indemandstats[0][1])/(outputStats[0][2] + indemandstats[0][1])*100)))
-         print('\nOutput Protection HA: {}\nInput HA: {}'.format(outputStats[0][3], inprotstats[0][0]))
-         print('\tProtection  difference %: {}'.format(int((outputStats[0][3] - inprotstats[0][0])/(outputStats[0][3] + inprotstats[0][0])*100)))
-      
-      webReady = ""
-      if debug[8]: #Merge for web
-         try:
-            print('\n#### Merging for Web pipeline for ' + dst.aoiname+ ' ####')
-            webReady = dst.mergeForWeb(outData, outSpecies if debug[2] else os.path.join(dst.scratch, 'DemandBySpecies'), os.path.join(dst.scratch, 'HabitatProportion'), outputgdb)
-         except Exception as e:
-            print(e)
-            errors = True
-            raise NameError(' !! Error {} for {}'.format(e, dst.aoiname))
-      else:
+      ctx = {'dst': dst, 'dstinfo': dstinfo, 'args': args, 'outputgdb': outputgdb, 'nced': nced, 'padus': padus, 'aoiworkspace': aoiworkspace, 'cleanRun': cleanRun, 'fieldTable': fieldTable}
+      ctx.update(options)
+      logArgs = (waterfowlmodel.logqueue.context['queue'], waterfowlmodel.logqueue.context['level'])
+      graph.run(ctx, stages, args.stageWorkers[0], callback=lambda name, result: runlog.stageDone(aoiname, name, result), initializer=initStage, initargs=(logArgs, waterfowlmodel.columnstore.state['folder'], aoiname, dst.scratch, args, aoiworkspace))
+      webReady = ctx.get('webReady', '')
+      if not webReady and arcpy.Exists(os.path.join(outputgdb, dst.aoiname+'_WebReady')):
          webReady = os.path.join(outputgdb, dst.aoiname+'_WebReady')
-
-      if errors:
-         print("\n ** Complete run for: "+dst.aoiname +" with errors")
-      else:
-         print("\n ** Complete run for: "+dst.aoiname+ " successfully")         
+      runlog.finished(aoiname, key, webReady)
+      print("\n ** Complete run for: "+dst.aoiname+ " successfully")         
       print('#####################################\n')
       return webReady
    except Exception as e:
-      print(' !! Error {} in {}'.format(e, dst.aoiname))
-      raise NameError('Error {} for {}'.format(e, dst.aoiname))
+      print(' !! Error {} in {}'.format(e, aoiname))
+      runlog.failed(aoiname, e)
+      raise NameError('Error {} for {}'.format(e, aoiname))
+
+# Seconds to wait before the first retry of a failed area of interest.  Doubled for every following retry.
+RETRY_BACKOFF = 30
+
+def retryCalc(dstinfo, func, retries, resume=False):
+   """
+   Runs calc for one area of interest and retries it with backoff when it fails.  Retries resume from the last finished stage.  Errors are recorded in the
+   run manifest instead of being raised so one failed area of interest doesn't stop the pool.
+
+   :param dstinfo: Waterfowlmodel parameters for the area of interest
+   :type dstinfo: list
+   :param func: calc with every other parameter set
+   :type func: function
+   :param retries: Number of retries
+   :type retries: int
+   :param resume: Resume from the run manifest on the first attempt
+   :type resume: bool
+   :return: Web ready output location or an empty string
+   :rtype: str
+   """
+   for attempt in range(retries + 1):
+      try:
+         return func(dstinfo, resume=resume or attempt > 0)
+      except Exception as e:
+         if attempt == retries:
+            print(' !! Giving up on {} after {} attempts'.format(dstinfo[1], attempt + 1))
+            return ''
+         wait = RETRY_BACKOFF * 2 ** attempt
+         print(' !! Retrying {} in {} seconds'.format(dstinfo[1], wait))
+         time.sleep(wait)
+
+def prepareTiles(dstinfo, ntiles, cleanRun, runlog):
+   """Splits an area of interest into tiles.  Failures are recorded in the run manifest and the area of interest runs without tiles."""
+   try:
+      return waterfowlmodel.tiling.prepareTiles(dstinfo, ntiles, cleanRun)
+   except Exception as e:
+      print(' !! Error {} tiling {}'.format(e, dstinfo[1]))
+      runlog.failed(dstinfo[1], e)
+      return dstinfo[1], None
 
 if __name__ == "__main__":
    print('\nRunning model')
@@ -0,0 +1,63 @@
+import os, json
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import pytest
+import waterfowlmodel.columnstore as columnstore
+
+CRS = 'EPSG:5070'
+
+@pytest.fixture
+def store(tmp_path, monkeypatch):
+  '''Store folder keyed by file content instead of arcpy properties'''
+  monkeypatch.setattr(columnstore.fingerprint, 'datasetKey', lambda inData: open(inData).read() if os.path.isfile(inData) else inData)
+  monkeypatch.setattr(columnstore.arcpy, 'Exists', lambda inData: True, raising=False)
+  yield str(tmp_path / '_store')
+  columnstore.attach(None)
+
+def test_tables(store, tmp_path):
+  kcal = tmp_path / 'kcal.csv'
+  kcal.write_text('habitatType,kcal\nMarsh,3100\nOpen Water,900\nShrub,\n')
+  crosswalk = tmp_path / 'crosswalk.csv'
+  crosswalk.write_text('Marsh,"PEM1A,PEM1C"\nOpen_Water,PUBH\n')
+  xjson = tmp_path / 'crosswalk.json'
+  xjson.write_text(json.dumps({'Forested': ['PFO1A'], 'Marsh': ['PEM1A', 'PEM1F']}))
+  columnstore.prepare(store, [str(crosswalk), str(xjson), str(kcal)], [str(kcal)])
+  columnstore.attach(store)
+  for path in [crosswalk, xjson, kcal]:
+    assert columnstore.crosswalk(str(path)) == columnstore.dataset.readCrosswalk(str(path))
+  # Stored columns are memory mapped
+  assert isinstance(columnstore.read(str(kcal), 'csv')[0]['habitatType'], np.memmap)
+  pd.testing.assert_frame_equal(columnstore.frame(str(kcal)), pd.read_csv(kcal), check_dtype=False)
+  # A changed source isn't read from the store
+  kcal.write_text('habitatType,kcal\nMarsh,2000\n')
+  columnstore.attach(store)
+  assert columnstore.frame(str(kcal))['kcal'].tolist() == [2000]
+
+def test_features(store, monkeypatch):
+  '''Clipping a stored layer returns the same features as reading the layer within the mask'''
+  rng = np.random.default_rng(38)
+  x, y = rng.uniform(0, 100000, 500), rng.uniform(0, 100000, 500)
+  geoms = list(shapely.box(x, y, x + 1000, y + 1000)) + [None]
+  layer = gpd.GeoDataFrame({'huc12': ['{:012d}'.format(i) for i in range(len(geoms))], 'name': ['Bin {}'.format(i) if i % 7 else None for i in range(len(geoms))],
+                            'LTADUD': rng.uniform(0, 1000, len(geoms))}, geometry=geoms, crs=CRS)
+  def iterFeatures(inFeature, chunkSize, mask=None, index=None):
+    for start in range(0, len(layer), chunkSize):
+      yield layer.iloc[start:start + chunkSize]
+  monkeypatch.setattr(columnstore.dataset, 'iterFeatures', iterFeatures)
+  inFeature = 'national.gdb/bins'
+  assert columnstore.features(inFeature, 100, None) is None
+  columnstore.prepare(store, layers=[inFeature])
+  columnstore.attach(store)
+  mask = gpd.GeoDataFrame(geometry=[shapely.box(20000, 30000, 45000, 60000)], crs=CRS).to_crs('EPSG:4326')
+  chunks = list(columnstore.features(inFeature, 40, mask))
+  assert max(len(c) for c in chunks) == 40
+  out = pd.concat(chunks, ignore_index=True)
+  box = mask.to_crs(CRS).total_bounds
+  expected = layer[layer.geometry.notna() & layer.geometry.intersects(shapely.box(*box))].reset_index(drop=True)
+  assert out['huc12'].tolist() == expected['huc12'].tolist()
+  assert out['name'].where(out['name'].notna(), None).tolist() == expected['name'].tolist()
+  assert np.allclose(out['LTADUD'], expected['LTADUD'])
+  assert shapely.equals(np.asarray(out.geometry.values), np.asarray(expected.geometry.values)).all()
+  assert out.crs == layer.crs
@@ -0,0 +1,111 @@
+import datetime
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import pytest
+import waterfowlmodel.compactgeom as compactgeom
+
+GRID = 0.01
+
+def snapped(geoms, grid=GRID):
+  '''Helper function returning geometries snapped to the grid the way encode does'''
+  coords = shapely.get_coordinates(geoms[~shapely.is_missing(geoms)])
+  origin = coords.min(axis=0) if len(coords) else np.zeros(2)
+  return np.array([None if g is None else shapely.transform(g, lambda c: np.round((c - origin) / grid) * grid + origin) for g in geoms], dtype=object)
+
+def assertSameGeoms(result, expected):
+  '''Helper function checking geometries match exactly, including their type and missing geometries'''
+  assert len(result) == len(expected)
+  for r, e in zip(result, expected):
+    if e is None:
+      assert r is None
+    else:
+      assert r.geom_type == e.geom_type
+      assert shapely.equals_exact(r, e, tolerance=1e-9)
+
+def polygons():
+  '''Helper function returning polygons with holes, multi part polygons, empty and missing geometries'''
+  square = shapely.box(1000, 2000, 1010.004, 2010.006)
+  holed = shapely.Polygon([(0, 0), (50, 0), (50, 50), (0, 50)], [[(10, 10), (20, 10), (20, 20), (10, 20)], [(30, 30), (40, 30), (40, 40)]])
+  multi = shapely.MultiPolygon([shapely.box(-500, -500, -499, -499), shapely.box(-400, -400, -390.123, -395.456)])
+  return np.array([square, None, holed, multi, shapely.Polygon(), shapely.MultiPolygon([shapely.box(5, 5, 6, 6)])], dtype=object)
+
+@pytest.mark.parametrize('geoms', [
+  polygons(),
+  np.array([shapely.box(0, 0, 1, 1), shapely.box(3, 3, 4, 4)], dtype=object),
+  np.array([shapely.LineString([(0, 0), (1.234, 5.678), (9, 9)]), None, shapely.MultiLineString([[(1, 1), (2, 2)], [(3, 3), (4, 5)]])], dtype=object),
+  np.array([shapely.Point(1.005, 2.004), shapely.Point(-3, 4), None], dtype=object),
+  np.array([None, None], dtype=object),
+  np.array([], dtype=object),
+])
+def test_roundTrip(geoms):
+  arrays = compactgeom.encode(geoms, GRID)
+  assertSameGeoms(compactgeom.decode(arrays), snapped(geoms))
+
+def test_decodeSubset():
+  geoms = polygons()
+  arrays = compactgeom.encode(geoms, GRID)
+  expected = snapped(geoms)
+  for keep in [[0], [2, 3], [1, 5], [5, 0, 2], [], list(range(len(geoms)))]:
+    assertSameGeoms(compactgeom.decode(arrays, np.array(keep, dtype=np.int64)), expected[keep])
+
+def test_snappingStaysWithinBound():
+  rng = np.random.default_rng(1)
+  geoms = np.array([shapely.Polygon(rng.uniform(0, 100, (3, 2)) + i * 200).convex_hull for i in range(50)], dtype=object)
+  decoded = compactgeom.decode(compactgeom.encode(geoms, 0.5))
+  error = np.abs(shapely.area(decoded) - shapely.area(geoms)).sum()
+  assert error <= compactgeom.areaErrorBound(geoms, 0.5)
+  assert np.abs(shapely.get_coordinates(decoded) - shapely.get_coordinates(geoms)).max() <= 0.25 + 1e-9
+
+@pytest.fixture
+def layer():
+  '''Helper layer with every column type the scratch layers use, nulls in each, and a missing geometry'''
+  return gpd.GeoDataFrame({
+    'CLASS': pd.Series(['Marsh', None, 'Open Water', 'Marsh', 'Forest', 'Marsh'], dtype=object),
+    'name': pd.Series(['a', 'b', None, 'd', 'e', 'f'], dtype='str'),
+    'count': pd.Series([1, 2, None, 4, 5, 6], dtype='Int64'),
+    'kcal': [1.5, np.nan, 3.25, 4.0, 5.0, 6.0],
+    'huc': np.arange(6, dtype=np.int32),
+    'flag': pd.Series([True, None, False, True, True, False], dtype=object),
+    'code': pd.Series([10, None, 30, 40, 50, 60], dtype=object),
+    'when': pd.Series([datetime.datetime(2020, 1, 2, 3, 4, 5), None, datetime.datetime(2021, 6, 7), None, datetime.datetime(2022, 1, 1), datetime.datetime(2023, 1, 1)], dtype=object),
+    'stamp': pd.to_datetime(['2020-01-01', None, '2020-01-03', '2020-01-04', '2020-01-05', '2020-01-06']),
+  }, geometry=polygons(), crs='EPSG:5070')
+
+def test_writeReadColumns(tmp_path, layer):
+  path = str(tmp_path / 'layer.npz')
+  compactgeom.writeCompact(layer, path, GRID)
+  result = compactgeom.readCompact(path)
+  assert result.crs == layer.crs
+  pd.testing.assert_frame_equal(pd.DataFrame(result.drop(columns='geometry')), pd.DataFrame(layer.drop(columns='geometry')))
+  assertSameGeoms(result.geometry.values, snapped(np.asarray(layer.geometry.values, dtype=object)))
+  assert result.geometry.values[0].geom_type == 'Polygon' and result.geometry.values[3].geom_type == 'MultiPolygon'
+
+def test_readColumnsAndBbox(tmp_path, layer):
+  path = str(tmp_path / 'layer.npz')
+  compactgeom.writeCompact(layer, path, GRID)
+  result = compactgeom.readCompact(path, ['CLASS', 'count'], bbox=(-10, -10, 60, 60))
+  assert list(result.columns) == ['CLASS', 'count', 'geometry']
+  # The holed polygon and the small multi polygon, not the missing or empty geometry
+  assert result['CLASS'].tolist() == ['Open Water', 'Marsh']
+  assert result['count'].dtype == 'Int64' and result['count'].isna().tolist() == [True, False]
+  assertSameGeoms(result.geometry.values, snapped(np.asarray(layer.geometry.values, dtype=object))[[2, 5]])
+
+def test_areaReportSkipsMissingGeometries(tmp_path, layer):
+  report = compactgeom.writeCompact(layer, str(tmp_path / 'layer.npz'), GRID)
+  expected = shapely.area(np.asarray(layer.geometry.values[[0, 2, 3, 4, 5]], dtype=object)).sum()
+  assert report['area'] == pytest.approx(expected)
+  assert np.isfinite([report['bound'], report['error'], report['relativeBound']]).all()
+  assert report['error'] <= report['bound']
+  assert compactgeom.report(str(tmp_path / 'layer.npz')) == {k: report[k] for k in ['area', 'bound', 'error']}
+
+def test_bboxFindsFeaturesOnTheEdge(tmp_path):
+  '''Bounds that float32 can't hold are rounded outward, so a box touching a feature still finds it'''
+  geoms = np.array([shapely.box(1234567.891, 2345678.912, 1234600.123, 2345700.456)], dtype=object)
+  layer = gpd.GeoDataFrame({'id': [1]}, geometry=geoms, crs='EPSG:5070')
+  path = str(tmp_path / 'layer.npz')
+  compactgeom.writeCompact(layer, path, GRID)
+  xmin, ymin, xmax, ymax = shapely.bounds(compactgeom.readCompact(path).geometry.values[0])
+  for box in [(xmax, ymax, xmax + 10, ymax + 10), (xmin - 10, ymin - 10, xmin, ymin)]:
+    assert len(compactgeom.readCompact(path, bbox=box)) == 1
@@ -0,0 +1,71 @@
+import os, types
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import pytest
+import waterfowlmodel.jvclip as jvclip
+
+CRS = 'EPSG:5070'
+
+@pytest.fixture
+def clipPolygon():
+  '''Two Joint Ventures sharing an edge with a hole, larger than a few grid cells'''
+  west = shapely.Polygon([(0, 0), (60000, 0), (60000, 100000), (0, 100000)], [[(20000, 20000), (30000, 20000), (30000, 30000), (20000, 30000)]])
+  east = shapely.box(60000, 0, 130000, 70000)
+  return shapely.union_all([west, east])
+
+@pytest.fixture
+def wetlands():
+  '''Random boxes inside, outside and across the clip polygon, a point, a line and a missing geometry'''
+  rng = np.random.default_rng(49)
+  x, y = rng.uniform(-20000, 150000, 300), rng.uniform(-20000, 120000, 300)
+  size = rng.uniform(100, 15000, 300)
+  geoms = list(shapely.box(x, y, x + size, y + size)) + [shapely.Point(10000, 10000), shapely.LineString([(50000, 50000), (90000, 90000)]), None]
+  return gpd.GeoDataFrame({'ATTRIBUTE': ['W{}'.format(i) for i in range(len(geoms))]}, geometry=geoms, crs=CRS)
+
+def test_clip(clipPolygon, wetlands):
+  index = jvclip.ClipIndex(clipPolygon, CRS, 10000)
+  out = index.clip(wetlands)
+  expected = wetlands[wetlands.geometry.notna()].copy()
+  expected['geometry'] = shapely.intersection(np.asarray(expected.geometry.values), clipPolygon)
+  expected = expected[~expected.geometry.is_empty].set_index('ATTRIBUTE')
+  assert sorted(out['ATTRIBUTE']) == sorted(expected.index)
+  out = out.set_index('ATTRIBUTE').loc[expected.index]
+  assert np.allclose(out.geometry.area, expected.geometry.area)
+  assert np.allclose(out.geometry.length, expected.geometry.length)
+  assert shapely.covered_by(np.asarray(out.geometry.values), clipPolygon.buffer(1e-6)).all()
+
+def test_clipWorkspace(clipPolygon, wetlands, tmp_path, monkeypatch):
+  '''Dispatches the layers to the pool and skips them on the second run'''
+  layers = {'AWetlands': wetlands, 'BWetlands': wetlands.iloc[:50]}
+  recorded = {}
+  def iterFeatures(inFeature, chunkSize, mask=None, index=None):
+    gdf = layers[os.path.basename(inFeature)]
+    for start in range(0, len(gdf), chunkSize):
+      yield gdf.iloc[start:start + chunkSize]
+  def gdfToFeatureClass(gdf, outfc, template=None, spatialReference=None):
+    if os.path.exists(outfc):
+      gdf = pd.concat([pd.read_pickle(outfc), gdf])
+    gdf.to_pickle(outfc)
+  monkeypatch.setattr(jvclip.arcpy, 'env', types.SimpleNamespace(), raising=False)
+  monkeypatch.setattr(jvclip.arcpy, 'ListFeatureClasses', lambda wildcard=None: list(layers), raising=False)
+  monkeypatch.setattr(jvclip.arcpy, 'Exists', os.path.exists, raising=False)
+  monkeypatch.setattr(jvclip.arcpy, 'Delete_management', os.remove, raising=False)
+  monkeypatch.setattr(jvclip.dataset, 'iterFeatures', iterFeatures)
+  monkeypatch.setattr(jvclip.dataset, 'gdfToFeatureClass', gdfToFeatureClass)
+  monkeypatch.setattr(jvclip.fingerprint, 'isCurrent', lambda outData, sources, params=None: recorded.get(outData) == (sources, params))
+  monkeypatch.setattr(jvclip.fingerprint, 'record', lambda outData, sources, params=None: recorded.__setitem__(outData, (sources, params)))
+  monkeypatch.setattr(jvclip, 'buildIndex', lambda clipFeature, cellSize: jvclip.ClipIndex(clipPolygon, CRS, cellSize))
+  clipFeature = str(tmp_path / 'JointVenture.gdb' / 'JVs')
+  outputs = jvclip.clipWorkspace(str(tmp_path / 'in.gdb'), clipFeature, str(tmp_path), cellSize=10000, workers=2, chunkSize=40)
+  assert outputs == [str(tmp_path / 'AWetlands_clipped'), str(tmp_path / 'BWetlands_clipped')]
+  expected = jvclip.ClipIndex(clipPolygon, CRS, 10000)
+  for fc, outFeature in zip(layers, outputs):
+    out = pd.read_pickle(outFeature)
+    assert sorted(out['ATTRIBUTE']) == sorted(expected.clip(layers[fc])['ATTRIBUTE'])
+    assert recorded[outFeature] == ([str(tmp_path / 'in.gdb' / fc), clipFeature], {'cellSize': 10000})
+  stamps = [os.path.getmtime(o) for o in outputs]
+  monkeypatch.setattr(jvclip, 'Pool', None)
+  assert jvclip.clipWorkspace(str(tmp_path / 'in.gdb'), clipFeature, str(tmp_path), cellSize=10000) == outputs
+  assert [os.path.getmtime(o) for o in outputs] == stamps
@@ -0,0 +1,78 @@
+import os, types
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import pytest
+import waterfowlmodel.partition as partition
+
+CRS = 'EPSG:5070'
+
+@pytest.fixture
+def aois():
+  '''Two areas of interest sharing an edge'''
+  return gpd.GeoDataFrame({'st': ['A', 'B']}, geometry=[shapely.box(0, 0, 100, 100), shapely.box(100, 0, 200, 100)], crs=CRS)
+
+@pytest.fixture
+def demand():
+  '''Features inside each area of interest, crossing their shared edge, crossing the outer edge and outside both'''
+  geoms = [shapely.box(10, 10, 30, 30), shapely.box(150, 50, 170, 70), shapely.box(80, 10, 130, 30), shapely.box(-20, 40, 20, 60), shapely.box(300, 0, 320, 20)]
+  values = np.array([100.0, 200.0, 500.0, 400.0, 50.0])
+  gdf = gpd.GeoDataFrame({'ID': ['in A', 'in B', 'across', 'edge', 'out']}, geometry=geoms, crs=CRS)
+  for field in partition.DEMAND_RATIO_FIELDS:
+    gdf[field] = values
+  return gdf
+
+def test_clipToPolygon(aois, demand):
+  out = partition.clipToPolygon(demand, aois.geometry[0], partition.DEMAND_RATIO_FIELDS).set_index('ID')
+  assert sorted(out.index) == ['across', 'edge', 'in A']
+  # Features inside are kept as they are
+  assert out.geometry['in A'].equals(demand.geometry[0])
+  assert out.geometry['across'].area == pytest.approx(20 * 20)
+  for field in partition.DEMAND_RATIO_FIELDS:
+    assert out.loc['in A', field] == 100
+    assert out.loc['across', field] == pytest.approx(500 * 20 / 50)
+    assert out.loc['edge', field] == pytest.approx(400 / 2)
+
+def test_partition(aois, demand, tmp_path, monkeypatch):
+  '''Routes each feature to every area of interest it intersects and splits the demand of features crossing an edge by area'''
+  def iterFeatures(inFeature, chunkSize, mask=None, index=None):
+    for start in range(0, len(demand), chunkSize):
+      yield demand.iloc[start:start + chunkSize]
+  def gdfToFeatureClass(gdf, outfc, template=None, spatialReference=None):
+    if os.path.exists(outfc):
+      gdf = pd.concat([pd.read_pickle(outfc), gdf])
+    gdf.to_pickle(outfc)
+  def record(outData, sources, params=None):
+    pd.to_pickle(sources, outData + '.manifest')
+  monkeypatch.setattr(partition.arcpy, 'Exists', os.path.exists, raising=False)
+  monkeypatch.setattr(partition.arcpy, 'Delete_management', os.remove, raising=False)
+  monkeypatch.setattr(partition.arcpy, 'Describe', lambda template: types.SimpleNamespace(shapeType='Polygon', spatialReference=None), raising=False)
+  monkeypatch.setattr(partition.arcpy, 'CreateFeatureclass_management', lambda path, name, *args, **kwargs: demand.iloc[:0].to_pickle(os.path.join(path, name)), raising=False)
+  monkeypatch.setattr(partition.dataset, 'iterFeatures', iterFeatures)
+  monkeypatch.setattr(partition.dataset, 'gdfToFeatureClass', gdfToFeatureClass)
+  monkeypatch.setattr(partition.fingerprint, 'isCurrent', lambda outData, sources, params=None: os.path.exists(outData + '.manifest') and pd.read_pickle(outData + '.manifest') == sources)
+  monkeypatch.setattr(partition.fingerprint, 'record', record)
+  partitioner = partition.Partitioner.__new__(partition.Partitioner)
+  partitioner.aoifield, partitioner.workers, partitioner.chunkSize, partitioner.aois = 'st', 2, 2, aois
+  outputs = {k: str(tmp_path / k) for k in ['A', 'B']}
+  for folder in outputs.values():
+    os.mkdir(folder)
+  outfcs = partitioner.partition('national/demand', 'demand', outputs, partition.DEMAND_RATIO_FIELDS)
+  assert outfcs == {k: os.path.join(v, 'demandclip') for k, v in outputs.items()}
+  parts = {k: pd.read_pickle(v).set_index('ID') for k, v in outfcs.items()}
+  assert sorted(parts['A'].index) == ['across', 'edge', 'in A']
+  assert sorted(parts['B'].index) == ['across', 'in B']
+  for field in partition.DEMAND_RATIO_FIELDS:
+    # The demand of the feature crossing both areas of interest is split by area and adds up to the original
+    assert parts['A'].loc['across', field] == pytest.approx(500 * 20 / 50)
+    assert parts['B'].loc['across', field] == pytest.approx(500 * 30 / 50)
+    assert parts['A'].loc['edge', field] == pytest.approx(200)
+    assert parts['B'].loc['in B', field] == 200
+  for k, outfc in outfcs.items():
+    assert pd.read_pickle(outfc + '.manifest') == ['national/demand', os.path.join(outputs[k], 'stateAOI')]
+  # Current partitions aren't written again
+  stamps = [os.path.getmtime(o) for o in outfcs.values()]
+  monkeypatch.setattr(partition, 'Pool', None)
+  assert partitioner.partition('national/demand', 'demand', outputs, partition.DEMAND_RATIO_FIELDS) == outfcs
+  assert [os.path.getmtime(o) for o in outfcs.values()] == stamps
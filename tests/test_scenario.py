@@ -0,0 +1,109 @@
+import re
+import numpy as np
+import pandas as pd
+import pytest
+import waterfowlmodel.scenario as scenario
+
+CLASSES = np.array(['Agriculture', 'Forested', 'Marsh', 'Open Water', 'Shrub'])
+
+# Field calculations of Waterfowlmodel.dstOutput and Waterfowlmodel.prepEnergySurplusDeficit in the order they run
+CALCULATIONS = [
+  ('surpdef_lta_kcal', '!tothabitat_kcal! - !demand_lta_kcal!'),
+  ('surpdef_80th_kcal', '!tothabitat_kcal! - !demand_80th_kcal!'),
+  ('nrgprot_lta_kcal', '!demand_lta_kcal! - !protected_kcal! if !demand_lta_kcal! - !protected_kcal! > 0 else 0'),
+  ('nrgprot_80th_kcal', '!demand_80th_kcal! - !protected_kcal! if !demand_80th_kcal! - !protected_kcal! > 0 else 0'),
+  ('restoregoal_lta_ha', 'abs(!surpdef_lta_kcal!/!wtMean_kcal_per_ha!) if !surpdef_lta_kcal! < 0 else 0'),
+  ('restoregoal_80th_ha', 'abs(!surpdef_80th_kcal!/!wtMean_kcal_per_ha!) if !surpdef_80th_kcal! < 0 else 0'),
+  ('restoregoal_lta_ha', '!available_ha! if !restoregoal_lta_ha! > !available_ha! else !restoregoal_lta_ha!'),
+  ('restoregoal_80th_ha', '!available_ha! if !restoregoal_80th_ha! > !available_ha! else !restoregoal_80th_ha!'),
+  ('protectgoal_lta_ha', '(!nrgprot_lta_kcal!/!wtMean_kcal_per_ha!) if !nrgprot_lta_kcal! > 0 else 0'),
+  ('protectgoal_80th_ha', '(!nrgprot_80th_kcal!/!wtMean_kcal_per_ha!) if !nrgprot_80th_kcal! > 0 else 0'),
+  ('protectgoal_lta_ha', '!available_ha! if !protectgoal_lta_ha! > !available_ha! else !protectgoal_lta_ha!'),
+  ('protectgoal_80th_ha', '!available_ha! if !protectgoal_80th_ha! > !available_ha! else !protectgoal_80th_ha!'),
+]
+
+def calculateField(row, expression):
+  '''Helper function evaluating a field calculation on one row.  A failed calculation leaves the field empty'''
+  try:
+    return eval(re.sub(r'!(\w+)!', lambda m: 'row[{!r}]'.format(m.group(1)), expression))
+  except (ZeroDivisionError, TypeError):
+    return None
+
+def dstOutput(habitat, protected, base, kcal):
+  '''Helper function returning the output fields of one bin the way the geometric run calculates them'''
+  energy = habitat * kcal
+  row = {'tothabitat_kcal': energy.sum(), 'protected_kcal': (protected * kcal).sum(), 'demand_lta_kcal': base[0], 'demand_80th_kcal': base[1], 'available_ha': base[2]}
+  # Waterfowlmodel.weightedMean, kcal of each class weighted by its share of the bin's energy
+  row['wtMean_kcal_per_ha'] = (kcal * energy / energy.sum()).sum() if energy.sum() > 0 else 0
+  # The field calculator sees Python floats, so dividing by zero raises instead of giving inf
+  row = {field: float(value) for field, value in row.items()}
+  for field, expression in CALCULATIONS:
+    row[field] = calculateField(row, expression)
+  return row
+
+@pytest.fixture
+def matrix():
+  '''Bins with a surplus, a deficit, no habitat, no demand and goals larger than the available hectares'''
+  rng = np.random.default_rng(50)
+  n = 40
+  habitat = rng.exponential(50, (n, len(CLASSES))) * (rng.random((n, len(CLASSES))) < 0.7)
+  protected = habitat * rng.random((n, len(CLASSES))) * (rng.random((n, len(CLASSES))) < 0.5)
+  base = np.column_stack([rng.exponential(100000, n), rng.exponential(200000, n), rng.exponential(60, n)])
+  habitat[0], protected[0] = 0, 0
+  base[1, :2] = 0
+  base[2, 2] = 0.5
+  bins = np.array(['0{}'.format(10000000000 + i) for i in range(n)])
+  return {'bins': bins, 'classes': CLASSES, 'habitat': habitat, 'protected': protected, 'base': base, 'binField': 'huc12'}
+
+@pytest.fixture
+def kcal():
+  '''Two kcal tables, one of them without Shrub'''
+  return np.array([[1500.0, 900.0], [120.0, 300.0], [3100.0, 2500.0], [900.0, 1200.0], [600.0, 0.0]])
+
+def test_evaluate(matrix, kcal):
+  results = scenario.evaluate(matrix, kcal)
+  for s in range(kcal.shape[1]):
+    for b in range(len(matrix['bins'])):
+      expected = dstOutput(matrix['habitat'][b], matrix['protected'][b], matrix['base'][b], kcal[:, s])
+      for field, values in results.items():
+        if expected[field] is None:
+          assert np.isnan(values[b, s]), (field, b, s)
+        else:
+          assert values[b, s] == pytest.approx(expected[field], rel=1e-9, abs=1e-6), (field, b, s)
+
+def test_evaluate_cases(matrix, kcal):
+  results = scenario.evaluate(matrix, kcal)
+  # No habitat leaves the goals of a bin with demand empty
+  assert results['tothabitat_kcal'][0].tolist() == [0, 0]
+  assert np.isnan(results['restoregoal_lta_ha'][0]).all()
+  # No demand needs no restoration or protection
+  assert results['restoregoal_lta_ha'][1].tolist() == [0, 0] and results['protectgoal_80th_ha'][1].tolist() == [0, 0]
+  assert (results['restoregoal_lta_ha'][2] <= 0.5).all()
+
+def test_runScenarios(matrix, kcal, tmp_path):
+  '''Bins split over two matrices with different classes give the same results as one matrix'''
+  first, second = tmp_path / 'a' / scenario.MATRIX_NAME, tmp_path / 'b' / scenario.MATRIX_NAME
+  for path, rows, cols in [(first, slice(0, 25), [0, 2, 3]), (second, slice(25, None), [1, 2, 3, 4])]:
+    path.parent.mkdir()
+    np.savez_compressed(path, bins=matrix['bins'][rows], classes=CLASSES[cols], habitat=matrix['habitat'][rows][:, cols], protected=matrix['protected'][rows][:, cols],
+                        base=matrix['base'][rows], binField=np.array(matrix['binField']))
+  # Classes a matrix doesn't have are 0 hectares in its bins
+  kept = np.where(np.arange(len(matrix['bins']))[:, None] < 25, np.isin(np.arange(len(CLASSES)), [0, 2, 3]), np.isin(np.arange(len(CLASSES)), [1, 2, 3, 4]))
+  full = dict(matrix, habitat=matrix['habitat'] * kept, protected=matrix['protected'] * kept)
+  tables = []
+  for s, name in enumerate(['kcal_low', 'kcal_high']):
+    path = tmp_path / (name + '.csv')
+    # Shrub is left out of the second table like a class missing from the kcal table
+    path.write_text('Type,kcal\n' + ''.join('{},{}\n'.format(c, k) for c, k in zip(CLASSES, kcal[:, s]) if k > 0))
+    tables.append(str(path))
+  summaryPath = scenario.runScenarios([str(first), str(second)], tables, str(tmp_path / 'out'))
+  expected = scenario.evaluate(full, kcal)
+  summary = pd.read_csv(summaryPath)
+  assert summary['scenario'].tolist() == ['kcal_low', 'kcal_high']
+  for s, name in enumerate(['kcal_low', 'kcal_high']):
+    df = pd.read_csv(tmp_path / 'out' / (name + '.csv'), dtype={'huc12': str})
+    assert df['huc12'].tolist() == matrix['bins'].tolist()
+    for field, values in expected.items():
+      assert np.allclose(df[field], values[:, s], equal_nan=True)
+      if field != 'wtMean_kcal_per_ha':
+        assert summary[field][s] == pytest.approx(np.nansum(values[:, s]))
@@ -0,0 +1,67 @@
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import pytest
+import waterfowlmodel.scratchstore as scratchstore
+
+@pytest.fixture
+def energy():
+  '''Energy layer like the one written by Waterfowlmodel.prepEnergyFast, with a row of boxes'''
+  geoms = [shapely.box(i * 100, 0, i * 100 + 50, 50) for i in range(6)]
+  return gpd.GeoDataFrame({'kcal': np.array([10, 20, 0, 40, 50, 60], dtype=np.int32), 'CLASS': ['Marsh', 'Forested', 'Shrub', 'Marsh', 'Open Water', 'Marsh'],
+                           'avalNrgy': np.arange(6) * 1.5, 'CalcHA': np.full(6, 0.25)}, geometry=geoms, crs='EPSG:5070')
+
+@pytest.fixture
+def backend():
+  '''Restores the gdb backend after a test'''
+  yield
+  scratchstore.setBackend('gdb')
+  scratchstore.reads.clear()
+
+@pytest.mark.parametrize('name', ['gdb', 'compact'])
+def test_writeFrameRead(tmp_path, energy, backend, name):
+  scratchstore.setBackend(name)
+  outData = str(tmp_path / 'scratch.gdb' / 'MergedEnergyclean')
+  assert scratchstore.writeFrame(energy, outData) == outData
+  # The copy is made when the layer is written, not on a second read
+  assert os.path.isfile(scratchstore.compactPath(outData)) == (name == 'compact')
+  assert scratchstore.isCopied(outData) == (name == 'compact')
+  result = scratchstore.readFrame(outData, ['CLASS'], (220, -10, 320, 10))
+  assert list(result.columns) == ['CLASS', 'geometry']
+  assert result['CLASS'].tolist() == ['Shrub', 'Marsh']
+  table = scratchstore.readTable(outData, ['avalNrgy', 'kcal'])
+  assert list(table.columns) == ['avalNrgy', 'kcal']
+  assert table['avalNrgy'].sum() == pytest.approx(energy['avalNrgy'].sum())
+  assert table['kcal'].tolist() == energy['kcal'].tolist()
+  assert scratchstore.reads == {}
+
+def test_copyFollowsLayer(tmp_path, energy, backend):
+  '''A layer rewritten without the store is read from the geodatabase until it's copied again'''
+  scratchstore.setBackend('compact')
+  outData = str(tmp_path / 'scratch.gdb' / 'Protected')
+  scratchstore.writeFrame(energy, outData)
+  energy.iloc[:2].to_file(os.path.dirname(outData), layer=os.path.basename(outData), driver='OpenFileGDB')
+  assert not scratchstore.isCopied(outData)
+  assert len(scratchstore.readTable(outData, ['CLASS'])) == 2
+  assert len(scratchstore.readFrame(outData, ['CLASS'])) == 2
+  assert not scratchstore.isCopied(outData)
+  # The second read copies the layer
+  assert len(scratchstore.readFrame(outData, ['CLASS'])) == 2
+  assert scratchstore.isCopied(outData)
+
+def test_copyLayer(tmp_path, energy, backend, capsys):
+  '''A layer written outside the store is copied once and its area error reported'''
+  outData = str(tmp_path / 'scratch.gdb' / 'aggTourban')
+  energy.to_file(os.path.dirname(outData), layer=os.path.basename(outData), driver='OpenFileGDB')
+  assert scratchstore.copyLayer(outData) == outData
+  assert not os.path.exists(scratchstore.compactPath(outData))
+  scratchstore.setBackend('compact')
+  scratchstore.copyLayer(outData)
+  assert scratchstore.hasCopy(outData)
+  assert 'Compact copy of aggTourban' in capsys.readouterr().out
+  stamp = os.path.getmtime(scratchstore.compactPath(outData))
+  scratchstore.copyLayer(outData)
+  assert os.path.getmtime(scratchstore.compactPath(outData)) == stamp
+  assert scratchstore.readTable(outData, ['CLASS'])['CLASS'].tolist() == energy['CLASS'].tolist()
@@ -0,0 +1,68 @@
+import numpy as np
+import pytest
+import waterfowlmodel.fingerprint as fingerprint
+import waterfowlmodel.spatialindex as spatialindex
+
+def writeTree(tmp_path, oids, boxes, nodeSize):
+  '''Helper function storing a packed tree the way buildIndex does and opening it'''
+  path = str(tmp_path / 'layer')
+  oids, packed, offsets = spatialindex.pack(oids, boxes, nodeSize)
+  np.save(path + '.oids.npy', oids)
+  np.save(path + '.boxes.npy', packed)
+  fingerprint.writeJson(path + '.json', {'offsets': offsets, 'nodeSize': nodeSize, 'count': len(oids)})
+  return spatialindex.PackedRTree(path)
+
+def bruteForce(oids, boxes, bbox):
+  '''Helper function returning the object IDs of the boxes intersecting bbox by testing every box'''
+  keep = (boxes[:, 0] <= bbox[2]) & (boxes[:, 2] >= bbox[0]) & (boxes[:, 1] <= bbox[3]) & (boxes[:, 3] >= bbox[1])
+  return np.sort(oids[keep])
+
+def randomBoxes(rng, n):
+  '''Helper function returning n boxes, some of them points'''
+  corner = rng.uniform(0, 1000, (n, 2))
+  size = rng.exponential(5, (n, 2)) * (rng.random((n, 1)) > 0.1)
+  return np.column_stack([corner, corner + size])
+
+def test_hilbertVisitsEveryCellOnce():
+  order = 3
+  x, y = np.meshgrid(np.arange(8), np.arange(8))
+  x, y = x.ravel(), y.ravel()
+  d = spatialindex.hilbert(x, y, order)
+  assert sorted(d.tolist()) == list(range(64))
+  # Consecutive cells on the curve are neighbours
+  walk = np.argsort(d)
+  assert (np.abs(np.diff(x[walk])) + np.abs(np.diff(y[walk])) == 1).all()
+
+@pytest.mark.parametrize('n, nodeSize', [(1, 16), (16, 16), (17, 16), (1000, 4), (5000, 16)])
+def test_queryMatchesBruteForce(tmp_path, n, nodeSize):
+  rng = np.random.default_rng(n)
+  oids = rng.permutation(n).astype(np.int64) + 1
+  boxes = randomBoxes(rng, n)
+  tree = writeTree(tmp_path, oids, boxes, nodeSize)
+  assert len(tree) == n
+  for bbox in np.column_stack([randomBoxes(rng, 50)[:, :2], randomBoxes(rng, 50)[:, :2] + rng.uniform(0, 200, (50, 2))]):
+    assert tree.query(bbox).tolist() == bruteForce(oids, boxes, bbox).tolist()
+  assert tree.query((-10, -10, 2000, 2000)).tolist() == sorted(oids.tolist())
+  assert tree.query((2000, 2000, 3000, 3000)).tolist() == []
+
+def test_queryTouchingEdges(tmp_path):
+  oids = np.array([1, 2, 3])
+  boxes = np.array([[0, 0, 1, 1], [1, 1, 2, 2], [5, 5, 5, 5]], dtype=float)
+  tree = writeTree(tmp_path, oids, boxes, 2)
+  assert tree.query((1, 1, 1, 1)).tolist() == [1, 2]
+  assert tree.query((5, 5, 6, 6)).tolist() == [3]
+  assert tree.query((2.5, 2.5, 4.9, 4.9)).tolist() == []
+
+def test_emptyTree(tmp_path):
+  tree = writeTree(tmp_path, np.zeros(0, dtype=np.int64), np.zeros((0, 4)), 16)
+  assert len(tree) == 0
+  assert tree.query((0, 0, 1, 1)).tolist() == []
+
+def test_packLevels():
+  rng = np.random.default_rng(0)
+  boxes = randomBoxes(rng, 100)
+  oids, packed, offsets = spatialindex.pack(np.arange(100), boxes, 4)
+  # 100 leaves, 25, 7, 2 and 1 node
+  assert offsets == [0, 100, 125, 132, 134, 135]
+  assert sorted(oids.tolist()) == list(range(100))
+  assert np.allclose(packed[offsets[-2]], [boxes[:, 0].min(), boxes[:, 1].min(), boxes[:, 2].max(), boxes[:, 3].max()])
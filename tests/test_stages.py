@@ -0,0 +1,61 @@
+import os, time
+import pytest
+import waterfowlmodel.stages as stages
+
+def supply(ctx):
+  time.sleep(0.5)
+  return {'supply': os.getpid()}
+
+def public(ctx):
+  time.sleep(0.5)
+  return {'public': os.getpid()}
+
+def urban(ctx):
+  time.sleep(0.5)
+  return {'urban': os.getpid()}
+
+def model(ctx):
+  return {'model': [ctx['supply'], ctx['public'], ctx['urban']], 'modelPid': os.getpid()}
+
+def failing(ctx):
+  raise RuntimeError('public lands failed')
+
+def graph(publicStage=public):
+  '''Helper function returning three independent stages and a stage that needs all of them'''
+  g = stages.StageGraph()
+  g.add('supply', supply, [], ['supply'], separate=True)
+  g.add('public', publicStage, [], ['public'], separate=True)
+  g.add('urban', urban, [], ['urban'], separate=True)
+  g.add('model', model, ['supply', 'public', 'urban'], ['model', 'modelPid'])
+  return g
+
+def test_run_serial():
+  finished = []
+  ctx = graph().run({}, callback=lambda name, result: finished.append(name))
+  assert finished == ['supply', 'public', 'urban', 'model']
+  assert set(ctx['model']) == {os.getpid()}
+
+def test_run_separate():
+  '''Independent stages run next to each other in their own processes and pass their outputs on'''
+  finished = []
+  start = time.time()
+  ctx = graph().run({}, workers=3, callback=lambda name, result: finished.append(name))
+  assert time.time() - start < 1.2
+  assert finished[-1] == 'model' and sorted(finished[:3]) == ['public', 'supply', 'urban']
+  assert os.getpid() not in ctx['model'] and len(set(ctx['model'])) == 3
+  assert ctx['modelPid'] == os.getpid()
+
+def test_run_separate_error():
+  finished = []
+  with pytest.raises(RuntimeError, match='public lands failed'):
+    graph(failing).run({}, workers=3, callback=lambda name, result: finished.append(name))
+  assert sorted(finished) == ['supply', 'urban']
+
+def runHosted(workers):
+  '''Helper function running the graph in a pool worker'''
+  return sorted(graph().run({}, workers=workers)['model']) != []
+
+def test_host_context():
+  '''Workers of a pool made with the host context can run separate stages'''
+  with stages.HostContext().Pool(1) as pool:
+    assert pool.apply(runHosted, (3,))
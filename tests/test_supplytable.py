@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+import pytest
+import waterfowlmodel.supplytable as supplytable
+
+BIN = 'huc12'
+BINNAME = 'name'
+
+@pytest.fixture
+def mergeAll():
+  '''MergeAll attributes with bins and classes in random order, an empty class, a bin without hectares and a bin with only empty classes'''
+  rng = np.random.default_rng(45)
+  n = 2000
+  bins = np.array(['0{}'.format(10000000000 + i) for i in rng.integers(0, 40, n)])
+  classes = rng.choice(['Marsh', 'Open Water', 'Forested', 'Shrub', 'Agriculture', ''], n, p=[0.3, 0.2, 0.2, 0.1, 0.1, 0.1])
+  df = pd.DataFrame({'avalNrgy': rng.exponential(5000, n), 'CalcHA': rng.exponential(10, n), 'kcal': rng.choice([120.0, 900.0, 1500.0, 3100.0], n),
+                     'CLASS': classes, BIN: bins, BINNAME: np.char.add('HUC ', bins)})
+  df.loc[df[BIN] == bins[0], ['avalNrgy', 'CalcHA']] = 0
+  df.loc[len(df)] = [0.0, 3.0, 900.0, '', '099999999999', 'HUC empty']
+  return df
+
+@pytest.fixture
+def table(mergeAll, tmp_path, monkeypatch):
+  '''Supply table written from the MergeAll attributes in chunks smaller than the table'''
+  records = mergeAll.to_records(index=False).astype([('avalNrgy', 'f8'), ('CalcHA', 'f8'), ('kcal', 'f8'), ('CLASS', 'U50'), (BIN, 'U12'), (BINNAME, 'U30')])
+  def iterTable(inTable, columns, chunkSize, nullValues=None):
+    for start in range(0, len(records), chunkSize):
+      yield records[columns][start:start + chunkSize]
+  monkeypatch.setattr(supplytable.dataset, 'iterTable', iterTable)
+  monkeypatch.setattr(supplytable.arcpy, 'GetCount_management', lambda inTable: [str(len(records))], raising=False)
+  folder = supplytable.write('MergeAll', str(tmp_path / 'MergeAll'), [BIN, BINNAME], chunkSize=300)
+  return supplytable.SupplyTable(folder)
+
+def test_columns(table, mergeAll):
+  assert len(table) == len(mergeAll)
+  for col in ['avalNrgy', 'CalcHA', 'kcal', 'CLASS', BIN, BINNAME]:
+    assert np.asarray(table[col]).tolist() == mergeAll[col].tolist()
+  assert np.asarray(table.values('CLASS')).tolist() == sorted(mergeAll['CLASS'].unique())
+
+@pytest.mark.parametrize('col', ['avalNrgy', 'CalcHA', 'kcal'])
+def test_groupSums(table, mergeAll, col):
+  sums, counts = table.groupSums(BIN, col)
+  index, columns = np.asarray(table.values(BIN)), np.asarray(table.values('CLASS'))
+  grouped = mergeAll.groupby([BIN, 'CLASS'])[col]
+  expected = grouped.sum().unstack(fill_value=0).reindex(index=index, columns=columns, fill_value=0)
+  np.testing.assert_allclose(sums, expected.values, rtol=1e-12)
+  expectedCounts = grouped.size().unstack(fill_value=0).reindex(index=index, columns=columns, fill_value=0)
+  np.testing.assert_array_equal(counts, expectedCounts.values)
+
+def test_habitatPercent(table, mergeAll):
+  # The pandas group by used by Waterfowlmodel.pctHabitatType before the supply table
+  df = mergeAll.dropna(subset=['CLASS', BIN, 'kcal'])
+  df1 = df.groupby([BIN]).CalcHA.sum()
+  dfmerge = pd.merge(df, df1, on=[BIN, BIN], how='left')
+  dfmerge['pct'] = (dfmerge['CalcHA_x'] / dfmerge['CalcHA_y']) * 100
+  expected = dfmerge.pivot_table(index=BIN, columns='CLASS', values='pct', aggfunc='sum').fillna(0).drop(columns=[''])
+
+  pct, present = table.habitatPercent(BIN)
+  result = pd.DataFrame(pct[present], index=pd.Index(np.asarray(table.values(BIN))[present], name=BIN), columns=np.asarray(table.values('CLASS'))).drop(columns=[''])
+  pd.testing.assert_frame_equal(result, expected, check_names=False, check_column_type=False, check_index_type=False)
+
+def test_weightedMean(table, mergeAll):
+  # The pandas group by used by Waterfowlmodel.weightedMean before the supply table
+  df = mergeAll.dropna(subset=['CLASS', BIN, 'kcal'])
+  hucsum = pd.DataFrame(df.groupby([BIN])['avalNrgy'].sum())
+  hucclasssum = pd.DataFrame(df.groupby([BIN, 'CLASS'])['avalNrgy'].sum())
+  calc = hucclasssum.join(hucsum, lsuffix='_main', rsuffix='_sum')
+  calc['pct'] = calc['avalNrgy_main'] / calc['avalNrgy_sum']
+  dfclass = pd.DataFrame(df.groupby([BIN, 'CLASS'])['kcal'].mean())
+  merge = pd.merge(dfclass, calc, on=[BIN, 'CLASS'])
+  merge['wtMeankcal'] = merge['kcal'] * merge['pct']
+  expected = merge.groupby([BIN])['wtMeankcal'].sum()
+
+  wtmean, present = table.weightedMean(BIN)
+  assert np.asarray(table.values(BIN))[present].tolist() == expected.index.tolist()
+  np.testing.assert_allclose(wtmean[present], expected.values, rtol=1e-12)
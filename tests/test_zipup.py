@@ -0,0 +1,146 @@
+import os, types, zipfile, hashlib
+import numpy as np
+import pytest
+import waterfowlmodel.zipup as zipup
+
+@pytest.fixture
+def outputFolder(tmp_path):
+  '''Output folder with a geodatabase of files that compress well, one that doesn't, and an empty one'''
+  gdb = tmp_path / 'out' / 'ABDU.gdb'
+  gdb.mkdir(parents=True)
+  (gdb / 'a00000001.gdbtable').write_bytes(b'habitat ' * 50000)
+  (gdb / 'a00000002.gdbtable').write_bytes(os.urandom(300000))
+  (gdb / 'timestamps').write_bytes(b'')
+  (gdb / 'sub').mkdir()
+  (gdb / 'sub' / 'nested.txt').write_text('nested')
+  return tmp_path
+
+def checkArchive(path, folder):
+  '''Helper function comparing every member of an archive with the file it was made from'''
+  with zipfile.ZipFile(path) as archive:
+    assert archive.testzip() is None
+    names = archive.namelist()
+    for root, dirs, files in os.walk(folder):
+      for name in files:
+        full = os.path.join(root, name)
+        arcname = os.path.relpath(full, folder).replace(os.sep, '/')
+        with open(full, 'rb') as f:
+          assert archive.read(arcname) == f.read()
+        names.remove(arcname)
+  assert names == ['ABDU.gdb/', 'ABDU.gdb/sub/']
+
+def test_zipUpRoundTrip(outputFolder):
+  base, fldr = str(outputFolder), str(outputFolder / 'out')
+  path = zipup.zipUp(base, fldr, workers=2)
+  checkArchive(path, fldr)
+  assert not os.path.exists(os.path.join(base, '_zipcache'))
+  assert sorted(os.listdir(os.path.dirname(path))) == [zipup.ARCHIVE_NAME + '.checksums.json', zipup.ARCHIVE_NAME + '.zip']
+
+def test_zipUpForcedZip64(outputFolder, monkeypatch):
+  # Every size and offset above 100 bytes uses zip64 records
+  monkeypatch.setattr(zipup, 'ZIP64_LIMIT', 100)
+  base, fldr = str(outputFolder), str(outputFolder / 'out')
+  path = zipup.zipUp(base, fldr)
+  with open(path, 'rb') as f:
+    assert b'PK\x06\x06' in f.read()
+  checkArchive(path, fldr)
+
+def test_zipUpCache(outputFolder):
+  base, fldr = str(outputFolder), str(outputFolder / 'out')
+  first = zipup.zipUp(base, fldr, keepCache=True)
+  with open(first, 'rb') as f:
+    digest = hashlib.sha256(f.read()).hexdigest()
+  assert os.path.isfile(os.path.join(base, '_zipcache', 'manifest.json'))
+  entries = os.listdir(os.path.join(base, '_zipcache'))
+  second = zipup.zipUp(base, fldr, keepCache=True)
+  with open(second, 'rb') as f:
+    assert hashlib.sha256(f.read()).hexdigest() == digest
+  assert sorted(os.listdir(os.path.join(base, '_zipcache'))) == sorted(entries)
+  checkArchive(second, fldr)
+
+class FakeTable:
+  '''Helper class holding the fields and rows of a feature class for the patched arcpy functions'''
+  def __init__(self, data, fields=None):
+    self.data = {k: list(v) for k, v in data.items()}
+    self.fields = fields or {k: {} for k in data}
+
+class FakeCursor:
+  '''Helper class updating the rows of a FakeTable with an empty label'''
+  def __init__(self, table, fields, where):
+    self.table, self.fields = table, fields
+  def __enter__(self):
+    return self
+  def __exit__(self, *args):
+    return False
+  def __iter__(self):
+    for self.i in range(len(self.table.data['OBJECTID'])):
+      if self.table.data['label'][self.i] in (None, ''):
+        yield [self.table.data[f][self.i] for f in self.fields]
+  def updateRow(self, row):
+    for f, v in zip(self.fields, row):
+      self.table.data[f][self.i] = v
+
+@pytest.fixture
+def hucLayers(tmp_path, monkeypatch):
+  '''HUC layer with a duplicate and an unnamed watershed, and model outputs with and without a label field'''
+  tables = {
+    'hucs': FakeTable({'huc12': ['030101', '010203', '020304', '010203', '040506'], 'name': ['Cape Fear', 'Upper Saco', 'Lake Erie', 'Duplicate', '']}),
+    'out': FakeTable({'OBJECTID': [1, 2, 3, 4, 5], 'HUC12': ['010203', '999999', '', '030101', '040506']}),
+    'labelled': FakeTable({'OBJECTID': [1, 2, 3], 'HUC12': ['010203', '020304', '030101'], 'label': ['Kept', None, '']}),
+  }
+  reads = []
+  def table(fc):
+    return tables[os.path.basename(fc)]
+  def tableToNumPyArray(fc, fields, null_value=None):
+    reads.append(os.path.basename(fc))
+    data = table(fc).data
+    return np.rec.fromarrays([np.array([null_value.get(f, v) if v is None else v for v in data[f]]) for f in fields], names=fields)
+  def extendTable(fc, key, array, arrayKey):
+    data = table(fc).data
+    for name in array.dtype.names:
+      lookup = dict(zip(array[arrayKey].tolist(), array[name].tolist()))
+      data[name] = [lookup.get(k) for k in data[key]]
+      table(fc).fields[name] = {'type': 'TEXT', 'length': array.dtype[name].itemsize // 4}
+  def addField(fc, name, fieldType, field_length=None, field_alias=None):
+    table(fc).fields[name] = {'type': fieldType, 'length': field_length, 'alias': field_alias}
+    table(fc).data[name] = [None] * len(table(fc).data['OBJECTID'])
+  def calculateField(fc, field, expression, expressionType):
+    data = table(fc).data
+    data[field] = list(data[expression.strip('!')])
+  def deleteField(fc, names):
+    for name in names:
+      table(fc).fields.pop(name)
+      table(fc).data.pop(name)
+  monkeypatch.setattr(zipup.arcpy, 'da', types.SimpleNamespace(TableToNumPyArray=tableToNumPyArray, ExtendTable=extendTable,
+                      UpdateCursor=lambda fc, fields, where=None: FakeCursor(table(fc), fields, where)), raising=False)
+  monkeypatch.setattr(zipup.arcpy, 'Describe', lambda fc: types.SimpleNamespace(OIDFieldName='OBJECTID'), raising=False)
+  monkeypatch.setattr(zipup.arcpy, 'ListFields', lambda fc, wildcard=None: [types.SimpleNamespace(name=n) for n in table(fc).fields if wildcard in (None, n)], raising=False)
+  monkeypatch.setattr(zipup.arcpy, 'AddField_management', addField, raising=False)
+  monkeypatch.setattr(zipup.arcpy, 'CalculateField_management', calculateField, raising=False)
+  monkeypatch.setattr(zipup.arcpy, 'DeleteField_management', deleteField, raising=False)
+  monkeypatch.setattr(zipup.fingerprint, 'datasetKey', lambda inData: 'v1')
+  gdb = tmp_path / 'national.gdb'
+  gdb.mkdir()
+  return {k: str(gdb / k) for k in tables}, tables, reads
+
+def test_hucNameIndex(hucLayers, monkeypatch):
+  paths, tables, reads = hucLayers
+  ids, names = zipup.hucNameIndex(paths['hucs'])
+  assert ids.tolist() == ['010203', '020304', '030101', '040506']
+  assert names.tolist() == ['Upper Saco', 'Lake Erie', 'Cape Fear', '']
+  # The saved index is used until the HUC layer changes
+  assert [i.tolist() for i in zipup.hucNameIndex(paths['hucs'])] == [ids.tolist(), names.tolist()] and reads == ['hucs']
+  monkeypatch.setattr(zipup.fingerprint, 'datasetKey', lambda inData: 'v2')
+  zipup.hucNameIndex(paths['hucs'])
+  assert reads == ['hucs', 'hucs']
+
+def test_AddHUCNames(hucLayers):
+  paths, tables, reads = hucLayers
+  zipup.AddHUCNames(paths['out'], paths['hucs'])
+  out = tables['out']
+  # IDs that aren't in the index or have no name are labelled with the ID, rows without an ID are left empty
+  assert out.data['label'] == ['Upper Saco', '999999', None, 'Cape Fear', '040506']
+  assert out.fields['label'] == {'type': 'TEXT', 'length': 255, 'alias': 'Map Label'}
+  assert sorted(out.fields) == ['HUC12', 'OBJECTID', 'label']
+  zipup.AddHUCNames(paths['labelled'], paths['hucs'])
+  assert tables['labelled'].data['label'] == ['Kept', 'Lake Erie', 'Cape Fear']
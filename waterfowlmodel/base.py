@@ -14,9 +14,15 @@ import numpy as np
 from arcgis.features import FeatureLayer, GeoAccessor, GeoSeriesAccessor
 import geopandas as gpd
 from pyproj.crs import CRS
-#from multiprocessing_logging import install_mp_handler
-
-#install_mp_handler()    
+import waterfowlmodel.projection as projection
+import waterfowlmodel.fingerprint as fingerprint
+import waterfowlmodel.validity as validity
+import waterfowlmodel.partition as partition
+import waterfowlmodel.profiling as profiling
+import waterfowlmodel.columnstore as columnstore
+import waterfowlmodel.scratchstore as scratchstore
+import waterfowlmodel.dataset as dataset
+import waterfowlmodel.supplytable as supplytable
 def report_time(func):
     '''Decorator reporting the execution time'''
     @wraps(func)
@@ -28,30 +34,14 @@ def report_time(func):
         return result
     return wrapper
 
-def make_df(in_table):
-    columns = [f.name for f in arcpy.ListFields(in_table)]
-    cur = arcpy.da.SearchCursor(in_table,columns)
-    rows = (row for row in cur)
-    df = pd.DataFrame(rows,columns=columns)
-    return df
-
 def printlog(txt, var):
    print(txt + ':', var)
    logging.info(txt + ': ' + var)
   
-def calculate_field(df, inDataset, xTable, curclass):
-  '''Helper function for calculating dataset landcover class from csv or json'''
-  if int(arcpy.GetCount_management(inDataset)[0]) > 0:
-      file_extension = os.path.splitext(xTable)[-1].lower()
-      if file_extension == ".json":
-        dataDict = json.load(open(xTable))
-      else:
-        with open(xTable, mode='r') as infile:
-          reader = csv.reader(infile)
-          dataDict = {rows[0]:rows[1].split(',') for rows in reader}
-      reversed_dict = {val: key.replace('_', '') for key in dataDict for val in dataDict[key]}
-      df['CLASS'] = df[curclass].map(reversed_dict)    
-  return df    
+def classLookup(xTable):
+  '''Helper function returning the landcover class of each habitat type from a csv, json or npz crosswalk'''
+  dataDict = columnstore.crosswalk(xTable)
+  return {val: key.replace('_', '') for key in dataDict for val in dataDict[key]}
 
 def calculateStandardizedABDU(WebReady, binUnique):
   '''Helper function for calculating standardized values for ABDU'''
@@ -109,6 +99,7 @@ def calculateStandardizedABDU(WebReady, binUnique):
 
   return WebReady
 
+@profiling.profileMethods
 class Waterfowlmodel:
   """Stores waterfowl model parameters and methods."""
   def __init__(self, aoi, aoiname, wetland, kcalTable, crosswalk, demand, urban, binIt, binUnique, extra, fieldtable, scratch, classAttr):
@@ -144,13 +135,13 @@ class Waterfowlmodel:
     self.aoi = self.projAlbers(aoi, 'AOI')
     self.aoiname = aoiname
     self.binUnique = binUnique
-    self.binIt = self.projAlbers(self.clipStuff(binIt, 'bin'), 'Bin')
-    self.wetland = self.projAlbers(self.clipStuff(wetland, 'wetland'), 'Wetland')
+    self.binIt = self.clipProject(binIt, 'bin', 'Bin')
+    self.wetland = self.clipProject(wetland, 'wetland', 'Wetland')
     self.classAttr = classAttr
     self.kcalTbl = kcalTable
     self.kcalList = self.getHabList()
     self.crossTbl = crosswalk
-    self.demand = self.projAlbers(self.clipStuff(demand, 'demand'), 'Demand')
+    self.demand = self.clipProject(demand, 'demand', 'Demand', partition.DEMAND_RATIO_FIELDS)
     self.urban = urban
     self.extra = self.processExtra(extra)
     self.mergedenergy = os.path.join(self.scratch, 'MergedEnergy')
@@ -173,11 +164,12 @@ class Waterfowlmodel:
     :return outfc: Location of projected feature
     :rtype outfc: str    
     """
-    if arcpy.Describe(inFeature).SpatialReference.Name != 102003:
+    if not projection.sameCRS(arcpy.Describe(inFeature).spatialReference):
       outfc = os.path.join(self.scratch, cat + '_projected')
-      if not (arcpy.Exists(outfc)):
+      if not fingerprint.isCurrent(outfc, [inFeature]):
         print('\tProjecting {}'.format(cat + ' layer: ' + inFeature + ' to ' + outfc))
-        arcpy.Project_management(inFeature, outfc, arcpy.SpatialReference(102003))
+        projection.projectFeature(inFeature, outfc)
+        fingerprint.record(outfc, [inFeature])
         return outfc
       else:
         logging.info('\tAlready projected to ' + outfc)
@@ -216,7 +208,7 @@ class Waterfowlmodel:
     :rtype outfc: str
     """
     outfc = os.path.join(self.scratch, cat + 'clip')
-    if arcpy.Exists(outfc):
+    if fingerprint.isCurrent(outfc, [inFeature, self.aoi]):
       #print('\tAlready have {} clipped with aoi'.format(cat))
       logging.info('\tAlready have {} clipped with aoi'.format(cat))
     else:
@@ -232,6 +224,34 @@ class Waterfowlmodel:
       #  arcpy.MakeFeatureLayer_management(in_features=inFeature, out_layer=outfc + 'bLayer', where_clause="", workspace="", field_info=self.binUnique[0] + " " + self.binUnique[0] + "VISIBLE NONE;"+ self.binUnique[1] + " " + self.binUnique[1] + "VISIBLE NONE")
       #  inFeature = outfc + 'bLayer'
       arcpy.Clip_analysis(inFeature, self.aoi, outfc)
+      fingerprint.record(outfc, [inFeature, self.aoi])
+    return outfc
+
+  def clipProject(self, inFeature, cat, projCat, ratioFields=None):
+    """
+    Clips input feature to the area of interest and projects it to Albers in a single pass.  A partition written by the national partitioner is used
+    when it was made from the current input feature and area of interest.
+
+    :param inFeature: Feature dataset to clip to AOI
+    :type inFeature: str
+    :param cat: Category name used for the clipped partition
+    :type cat: str
+    :param projCat: Category name used for unique storage of the projected output
+    :type projCat: str
+    :param ratioFields: Fields scaled by the proportion of area kept for features crossing the AOI boundary
+    :type ratioFields: list
+    :return outfc: Location of clipped and projected feature
+    :rtype outfc: str
+    """
+    if fingerprint.isCurrent(os.path.join(self.scratch, cat + 'clip'), [inFeature, self.aoi]):
+      return self.projAlbers(os.path.join(self.scratch, cat + 'clip'), projCat)
+    outfc = os.path.join(self.scratch, projCat + '_projected')
+    if fingerprint.isCurrent(outfc, [inFeature, self.aoi]):
+      logging.info('\tAlready have {} clipped and projected'.format(cat))
+      return outfc
+    print('\tClipping and projecting {}'.format(cat + ' layer: ' + inFeature + ' to ' + outfc))
+    projection.clipProject(inFeature, self.aoi, outfc, ratioFields)
+    fingerprint.record(outfc, [inFeature, self.aoi])
     return outfc
 
   def getHabList(self):
@@ -241,7 +261,7 @@ class Waterfowlmodel:
     :return list: List of habitat types
     :rtype list: list
     """    
-    df = pd.read_csv(self.kcalTbl)
+    df = columnstore.frame(self.kcalTbl)
     return list(df['habitatType'])
 
   def processExtra(self, extra):
@@ -256,7 +276,7 @@ class Waterfowlmodel:
     readyExtra = {}
     a=0
     for k in extra.keys():
-      readyExtra[a] = [self.projAlbers(self.clipStuff(extra[k][0], 'extra' + str(a)), 'extra' + str(a)),extra[k][1]]
+      readyExtra[a] = [self.clipProject(extra[k][0], 'extra' + str(a), 'extra' + str(a)),extra[k][1]]
       a+=1
     return readyExtra
 
@@ -273,6 +293,9 @@ class Waterfowlmodel:
     :type curclass: str.
     """
     logging.info("Calculating habitat")
+    if fingerprint.isApplied(inDataset, 'crossclass', [xTable], {'curclass': curclass}):
+      logging.info('\tHabitat class already current for ' + inDataset)
+      return
     if int(arcpy.GetCount_management(inDataset)[0]) > 0:
       if len(arcpy.ListFields(inDataset,'CLASS'))>0:
         for field in arcpy.ListFields(inDataset):
@@ -282,13 +305,7 @@ class Waterfowlmodel:
       else:
         arcpy.AddField_management(inDataset, 'CLASS', "TEXT", 50)
       # Read data from file:
-      file_extension = os.path.splitext(xTable)[-1].lower()
-      if file_extension == ".json":
-        dataDict = json.load(open(xTable))
-      else:
-        with open(xTable, mode='r') as infile:
-          reader = csv.reader(infile)
-          dataDict = {rows[0]:rows[1].split(',') for rows in reader}
+      dataDict = columnstore.crosswalk(xTable)
       #print(inDataset)
       with arcpy.da.UpdateCursor(inDataset, [curclass, 'CLASS']) as cursor:
         for row in cursor:
@@ -305,6 +322,7 @@ class Waterfowlmodel:
               continue
           else:
             continue
+      fingerprint.applied(inDataset, 'crossclass', [xTable], {'curclass': curclass})
     else:
       return
   
@@ -320,16 +338,29 @@ class Waterfowlmodel:
     :param curclass: Field that lists current class within inDataset
     :type curclass: str.
     """    
-    df = make_df(inDataset)
-    outdf = calculate_field(df, inDataset, xTable, curclass)
-    outdf = outdf[['OBJECTID', 'CLASS']]
-    v = outdf.reset_index()
-    outnp = np.rec.fromrecords(v, names=v.columns.tolist())
+    if fingerprint.isApplied(inDataset, 'crossclass', [xTable], {'curclass': curclass}):
+      logging.info('\tHabitat class already current for ' + inDataset)
+      return inDataset
+    # Classified chunk by chunk.  Only the object ID and the class of rows with a habitat type in the crosswalk are kept, other rows are left null by the join.
+    lookup = classLookup(xTable)
+    oids, classes = [], []
+    for chunk in dataset.iterTable(inDataset, ['OBJECTID', curclass]):
+      mapped = pd.Series(chunk[curclass]).map(lookup)
+      keep = mapped.notnull().values
+      oids.append(chunk['OBJECTID'][keep])
+      classes.append(mapped.values[keep].astype(str))
+    oids = np.concatenate(oids) if oids else np.array([], dtype='i4')
+    classes = np.concatenate(classes) if classes else np.array([], dtype='U1')
+    outnp = np.rec.fromarrays([oids, classes], names=['OBJECTID', 'CLASS'])
     if len(arcpy.ListFields(inDataset,'CLASS'))>0:
       arcpy.DeleteField_management(inDataset, 'CLASS')
     if len(arcpy.ListFields(inDataset,'index'))>0:
       arcpy.DeleteField_management(inDataset, 'index')         
-    arcpy.da.ExtendTable(inDataset, "OBJECTID", outnp, "OBJECTID")
+    if len(outnp):
+      arcpy.da.ExtendTable(inDataset, "OBJECTID", outnp, "OBJECTID")
+    else:
+      arcpy.AddField_management(inDataset, 'CLASS', "TEXT", 50)
+    fingerprint.applied(inDataset, 'crossclass', [xTable], {'curclass': curclass})
     return inDataset  
 
   def joinEnergy(self, wetland, extra, mergedenergy):
@@ -346,14 +377,15 @@ class Waterfowlmodel:
     :rtype: str
     """    
     #Merge extra datasets and erase from NWI then merge
-    if arcpy.Exists(mergedenergy):
+    blah = [item[0] for item in extra.values()]
+    if fingerprint.isCurrent(mergedenergy, [wetland] + blah):
       logging.info('\tAlready joined habitat supply')
       return mergedenergy
-    blah = [item[0] for item in extra.values()]
     arcpy.analysis.Union(' #;'.join([str(x) for x in blah]) + ' #', os.path.join(self.scratch, 'mergedExtra'), "ALL", None, "GAPS")
     arcpy.Erase_analysis(wetland, os.path.join(self.scratch, 'mergedExtra'), os.path.join(self.scratch, 'nwiDelExtra'))
     erased = [os.path.join(self.scratch, 'nwiDelExtra'), os.path.join(self.scratch, 'mergedExtra')]
     arcpy.Merge_management(erased, mergedenergy)
+    fingerprint.record(mergedenergy, [wetland] + blah)
     return mergedenergy
 
   def gpdToGDB(self, inDataset, fields, areafield, cat):
@@ -371,25 +403,20 @@ class Waterfowlmodel:
     :return: Modifed inDataset
     :rtype: str
     """    
-    cleanMe = gpd.read_file(os.path.dirname(inDataset), layer=os.path.basename(inDataset), driver='FileGDB')
     if 'geometry' not in fields:
       fields.append('geometry')
     if areafield not in fields:
       fields.append(areafield)
+    cleanMe = scratchstore.readFrame(inDataset, [f for f in fields if f != 'geometry'])
     cleanMe = cleanMe[fields]
     #cc = CRS('PROJCS["North_America_Albers_Equal_Area_Conic",GEOGCS["GCS_North_American_1983",DATUM["North_American_Datum_1983",SPHEROID["GRS_1980",6378137.0,298.257222101]],PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433],AUTHORITY["EPSG","4269"]],PROJECTION["Albers_Conic_Equal_Area"],PARAMETER["False_Easting",0.0],PARAMETER["False_Northing",0.0],PARAMETER["longitude_of_center",-96.0],PARAMETER["Standard_Parallel_1",20.0],PARAMETER["Standard_Parallel_2",60.0],PARAMETER["latitude_of_center",40.0],UNIT["Meter",1.0],AUTHORITY["Esri","102008"]]')
     if cat == 'padfix':
       cleanMe = cleanMe.explode(ignore_index=True)
     cleanMe[areafield] = cleanMe.geometry.area/10000 #/10,000 for Hectares
-    try:
-      cleanMe = cleanMe.fillna('')
-    except:
-      pass
-    arcpy.CreateFeatureclass_management(os.path.dirname(inDataset), os.path.basename(inDataset)+cat,'POLYGON', inDataset)
-    fields.remove('geometry')
-    fields.append('SHAPE@')
-    #print(len(fields))
-    #print(cleanMe.columns)
+    # Text columns get empty strings and numeric columns 0 so every column keeps its type when written
+    for col in [f for f in fields if f != 'geometry']:
+      if not pd.api.types.is_numeric_dtype(cleanMe[col]):
+        cleanMe[col] = cleanMe[col].fillna('')
     try:
       for i in ['UrbanHA', 'THabNrg', 'THabHA','LTADUD', 'LTADemand', 'LTAPopObj', 'X80DUD', 'X80Demand', 'X80PopObj','ProtHA', 'ProtHabHA', 'ProtHabNrg', 'LTASurpDef', 'X80SurpDef','wtMeankcal', 'unavailHA']:
         cleanMe[i] = pd.to_numeric(cleanMe[i], errors='coerce')
@@ -397,91 +424,61 @@ class Waterfowlmodel:
       pass
     cleanMe = cleanMe.fillna(0.0)
     #print(cleanMe.head())
-    spr = arcpy.Describe(inDataset).spatialReference
-    with arcpy.da.InsertCursor(inDataset+cat,fields) as cursor:
-      for index,row in cleanMe.iterrows():
-        tmp = cleanMe.loc[index]
-        insertme = []
-        for l in tmp[:-1]:
-          insertme.append(l)
-        #insertme = [item for sublist in tmp[:-1] for item in sublist]
-        insertme.append(arcpy.FromWKT(tmp.geometry.to_wkt(),spr))
-        cursor.insertRow(insertme)
-    del cursor
+    if arcpy.Exists(inDataset+cat):
+      arcpy.Delete_management(inDataset+cat)
+    # Written in one bulk write, with a copy for the parquet and compact scratch backends
+    scratchstore.writeFrame(cleanMe, inDataset+cat)
     inDataset = inDataset+cat
     return inDataset
 
-  def prepEnergyFast(self, inDataset, xTable):
+  def prepEnergyFast(self, inDataset, xTable, spatialReference=None):
     """
-    Calculates habitat area and energy of the input dataset.  Utilizes geopandas which has been much faster than arcpy.  Not without issues (Larger than 2GB shapefile).
-    Incorporated a workaround by creating a new empty feature dataset in a file geodatabase and using an insertcursor to write each row from the geopandas dataframe.
+    Calculates habitat area and energy of the input dataset.  Utilizes geopandas which has been much faster than arcpy.  The kcal of each class is looked up
+    and the energy calculated for every polygon at once, and the clean copy is written to the scratch geodatabase in one bulk write through the scratch
+    store.  inDataset isn't changed.  The clean copy is fingerprinted with inDataset and xTable once it's complete.
 
-    :param inDataset: Feature to be updated with kcal values that relate to the class
+    :param inDataset: Feature with the habitat CLASS of each polygon
     :type inDataset: str
     :param xTable: Location of csv or json file with two columns, from class and to class
     :type xTable: str
-    :return: Modifed inDataset
+    :param spatialReference: Spatial reference of the clean copy.  Defaults to the spatial reference of inDataset
+    :type spatialReference: arcpy.SpatialReference
+    :return: Clean copy of inDataset with kcal values that relate to the class
     :rtype: str
     """
     print('\tCalculate energy for', inDataset)
     logging.info("Calculate energy for " + inDataset)
+    if fingerprint.isCurrent(inDataset + "clean", [inDataset, xTable]):
+      logging.info('\tEnergy already calculated for ' + inDataset)
+      return inDataset + "clean"
+    source = inDataset
     try:
-      if not len(arcpy.ListFields(inDataset,'avalNrgy'))>0:
-        arcpy.AddField_management(inDataset, 'avalNrgy', "DOUBLE", 9, "", "", "AvailableEnergy")    
-      if not len(arcpy.ListFields(inDataset,'kcal'))>0:
-        arcpy.AddField_management(inDataset, 'kcal', "LONG")
-      if not len(arcpy.ListFields(inDataset,'CalcHA'))>0:
-        arcpy.AddField_management(inDataset, 'CalcHA', "DOUBLE", 9, 2, "", "Hectares")
-      cleanMe = gpd.read_file(os.path.dirname(inDataset), layer=os.path.basename(inDataset), driver='FileGDB')
-      cleanMe = cleanMe[['kcal', 'CLASS', 'avalNrgy', 'CalcHA','geometry']]
-      cc = CRS('PROJCS["North_America_Albers_Equal_Area_Conic",GEOGCS["GCS_North_American_1983",DATUM["North_American_Datum_1983",SPHEROID["GRS_1980",6378137.0,298.257222101]],PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433],AUTHORITY["EPSG","4269"]],PROJECTION["Albers_Conic_Equal_Area"],PARAMETER["False_Easting",0.0],PARAMETER["False_Northing",0.0],PARAMETER["longitude_of_center",-96.0],PARAMETER["Standard_Parallel_1",20.0],PARAMETER["Standard_Parallel_2",60.0],PARAMETER["latitude_of_center",40.0],UNIT["Meter",1.0],AUTHORITY["Esri","102008"]]')
+      cleanMe = scratchstore.readFrame(inDataset, ['CLASS'])
+      cleanMe = cleanMe[['CLASS','geometry']]
       cleanMe = cleanMe[~cleanMe['CLASS'].isnull()]
       cleanMe = cleanMe.explode(ignore_index=True)
       cleanMe['CalcHA'] = cleanMe.geometry.area/10000 #/10,000 for Hectares
-      try:
-        cleanMe = cleanMe.fillna('')
-      except:
-        pass
-      cleanMe['kcal'] = 0
-      cleanMe['avalNrgy'] = 0
-      arcpy.CreateFeatureclass_management(os.path.dirname(inDataset), os.path.basename(inDataset)+"clean",'POLYGON', inDataset)
-      spr = arcpy.Describe(inDataset).spatialReference
-      with arcpy.da.InsertCursor(inDataset+"clean",['kcal', 'CLASS', 'avalNrgy', 'CalcHA', 'SHAPE@']) as cursor:
-        for index,row in cleanMe.iterrows():
-          tmp = cleanMe.loc[index]
-          cursor.insertRow((0, tmp['CLASS'],0, tmp['CalcHA'], arcpy.FromWKT(tmp.geometry.to_wkt(),spr)))
-      del cursor
-      inDataset = inDataset+"clean"
+      if spatialReference is not None:
+        cleanMe = cleanMe.set_crs(spatialReference.exportToString().split(';')[0], allow_override=True)
       # Read data from file:
       print('\tReading in habitat file')
-      file_extension = os.path.splitext(xTable)[-1].lower()
-      if file_extension == ".json":
-        dataDict = json.load(open(xTable))
-      else:
-        with open(xTable, mode='r') as infile:
-          reader = csv.reader(infile)
-          dataDict = {rows[0]:rows[1].split(',') for rows in reader}
-      print('\tCalculating available energy for', inDataset)
-      with arcpy.da.UpdateCursor(inDataset, ['kcal', 'CLASS', 'avalNrgy', 'CalcHA']) as cursor:
-        print('Entering calculation')
-        for row in cursor:
-          if row[0] is None or row[0]== 0:
-            for key, value in dataDict.items():
-              try:
-                if row[1] == key:
-                  row[0] = value[0]
-                  row[2] = float(value[0]) * float(row[3])
-                  cursor.updateRow(row)
-              except Exception as e:
-                print(' !! Error {} in calculating available habitat for {}'.format(e, self.aoiname))
-          else:
-            print(' !! Error in calculating available habitat for {}'.format(self.aoiname))
-            continue
+      kcal = {}
+      for key, value in columnstore.crosswalk(xTable).items():
         try:
-          del cursor, row
-        except Exception as et:
+          kcal[key] = float(value[0])
+        except Exception as e:
           print(' !! Error {} in calculating available habitat for {}'.format(e, self.aoiname))
+      print('\tCalculating available energy for', inDataset)
+      # Classes missing from the kcal table have no energy
+      classKcal = cleanMe['CLASS'].map(kcal).fillna(0.0)
+      cleanMe['kcal'] = classKcal.astype(np.int32)
+      cleanMe['avalNrgy'] = classKcal * cleanMe['CalcHA']
+      if arcpy.Exists(inDataset+"clean"):
+        arcpy.Delete_management(inDataset+"clean")
+      inDataset = inDataset+"clean"
+      scratchstore.writeFrame(cleanMe[['kcal', 'CLASS', 'avalNrgy', 'CalcHA', 'geometry']], inDataset)
       print('Energy calculated')
+      fingerprint.record(inDataset, [source, xTable])
       return inDataset
     except Exception as e:
       print(' !! Error {} for {}'.format(e, self.aoiname))
@@ -524,7 +521,11 @@ class Waterfowlmodel:
     print("Mergebin: {}".format(mergebin))
     if arcpy.Exists(os.path.join(self.scratch, 'AllDataBintemp')):
       arcpy.Delete_management(os.path.join(self.scratch, 'AllDataBintemp'))
-    arcpy.Merge_management(mergebin, os.path.join(self.scratch, 'AllDataBintemp'))
+    # The bin layers are read through the scratch store and merged in one bulk write.  Copies of bin layers kept from an earlier run are read instead of
+    # the geodatabase.  The geodatabase area and length fields are left out since they no longer match the merged features.
+    frames = [scratchstore.readFrame(scratchstore.copyLayer(fc)) for fc in mergebin]
+    merged = pd.concat([f.drop(columns=[c for c in ['Shape_Length', 'Shape_Area'] if c in f.columns]) for f in frames], ignore_index=True)
+    scratchstore.writeFrame(gpd.GeoDataFrame(merged, crs=frames[0].crs), os.path.join(self.scratch, 'AllDataBintemp'))
     print('\tDissolving features and fixing fields')
     fieldstats = self.binUnique[1] +" MAX; BinHA MAX; UrbanHA SUM; THabNrg SUM;THabHA SUM;LTADUD SUM;LTADemand SUM; LTAPopObj SUM;X80DUD SUM;X80Demand SUM; X80PopObj SUM;ProtHA SUM;ProtHabHA SUM;ProtHabNrg SUM;LTASurpDef SUM;X80SurpDef SUM;wtMeankcal SUM;unavailHA MAX;"
     if arcpy.Exists(os.path.join(self.scratch, 'AllDataBin')):
@@ -730,12 +731,14 @@ class Waterfowlmodel:
       outLayer = os.path.join(scratch, 'aggproptemp' + cat)
       outLayerI = os.path.join(scratch, 'aggUnion' + cat)
       aggToOut = os.path.join(scratch, 'aggTo' + cat)
+      params = {'IDField': IDField, 'aggFields': aggFields, 'dissolveFields': dissolveFields, 'aggStat': aggStat}
       # Process: Make Feature Layer
-      if arcpy.Exists(aggToOut):
+      if fingerprint.isCurrent(aggToOut, [aggTo, aggData], params):
         logging.info('\tAlready dissolved and aggregated everything for ' + cat)
-        print('\tAlready dissolved and calculated, Deleting', aggToOut)
+        return aggToOut
+      if arcpy.Exists(aggToOut):
+        print('\tAggregation out of date, Deleting', aggToOut)
         arcpy.Delete_management(aggToOut)
-        #return aggToOut
       arcpy.MakeFeatureLayer_management(in_features=aggData, out_layer=outLayer,field_info=FieldsToAgg)
       print(aggTo)
       print(outLayer)
@@ -745,13 +748,14 @@ class Waterfowlmodel:
       print('indata', outLayerI)
       arcpy.Dissolve_management(in_features=outLayerI, out_feature_class=aggToOut, dissolve_field=Dissolve_Field_s_, statistics_fields=AggStats, multi_part="MULTI_PART", unsplit_lines="DISSOLVE_LINES")
       arcpy.Delete_management(outLayerI)
+      fingerprint.record(aggToOut, [aggTo, aggData], params)
     except Exception as e:
       exc_type, exc_obj, exc_tb = sys.exc_info()
       fname = os.path.split(exc_tb.tb_frame.f_code.co_filename)[1]
       print(exc_type, fname, exc_tb.tb_lineno)
     return aggToOut
 
-  def aggByField(self, mergeAll, scratch, demand, binme, cat):
+  def aggByField(self, mergeAll, scratch, demand, binme, cat, fipsum=None):
     """
     Very similar to aggproportion but instead of using area to aggregate data this function uses avalNrgy.  This is largely used for proportioning energy demand based on
     energy supply.
@@ -762,6 +766,9 @@ class Waterfowlmodel:
     :type scratch: str  
     :param cat: Spatial dataset used as the aggregation feature.  Data will be binned to the features within this dataset.
     :type cat: str
+    :param fipsum: Table of total available energy by county (fips, SUM_SUM_avalNrgy).  Used by tiles so counties crossing tile boundaries are proportioned by
+     the total for the whole area of interest.  Defaults to the totals within mergeAll.
+    :type fipsum: str
     :return: Feature class with energy demand proportioned to smaller aggregation unit based on available energy supply
     :rtype:  str
     """
@@ -769,7 +776,10 @@ class Waterfowlmodel:
       print('\tProportioning energy demand based on energy supply.')
       outLayer = os.path.join(scratch, 'aggByField' + cat)
       arcpy.Statistics_analysis(in_table=mergeAll, out_table=outLayer + 'hucfipsum', statistics_fields="avalNrgy SUM", case_field=self.binUnique[0]+";fips")
-      arcpy.Statistics_analysis(in_table=outLayer + 'hucfipsum', out_table=outLayer + 'fipsum', statistics_fields="SUM_avalNrgy SUM", case_field="fips")
+      if fipsum:
+        arcpy.Copy_management(fipsum, outLayer + 'fipsum')
+      else:
+        arcpy.Statistics_analysis(in_table=outLayer + 'hucfipsum', out_table=outLayer + 'fipsum', statistics_fields="SUM_avalNrgy SUM", case_field="fips")
       arcpy.AddField_management(outLayer + 'hucfipsum', "PropPCT", "DOUBLE", 9, "", "", "EnergyProportionPercent", "NULLABLE", "REQUIRED")
       arcpy.AddField_management(outLayer + 'hucfipsum', 'hucfip', "TEXT", 50)
       print("!"+self.binUnique[0]+"!+ !fips!")
@@ -847,7 +857,7 @@ class Waterfowlmodel:
       arcpy.AddField_management(Joined_demandbySpecies, uni, "TEXT")
     arcpy.Append_management(binIt, Joined_demandbySpecies, "NO_TEST")
     # read in csv that contains the crosswalk for all the field names
-    fieldtable = pd.read_csv(fieldtable, encoding='unicode_escape')
+    fieldtable = columnstore.frame(fieldtable, encoding='unicode_escape')
     # species list
     fieldtable["species"]=fieldtable["species"].apply(str)
     speciesList = [f.upper() for f in fieldtable.species.unique() if f.upper()!='ALL']
@@ -867,12 +877,9 @@ class Waterfowlmodel:
     :param mergeAll: Merged energy returned from self.prepnpptables.
     :type mergeAll: str      
     """
-    insp = gpd.GeoDataFrame.from_file(arcpy.Describe(demand).path, layer=arcpy.Describe(demand).name)
-    speciesList = insp.species.unique()
-    try:
-      speciesList = speciesList[~np.in1d(speciesList, np.array(['All']))]
-    except:
-      pass
+    # Only the species column is read, the demand geometry isn't needed for the species list
+    speciesList = pd.unique(arcpy.da.TableToNumPyArray(demand, ['species'], skip_nulls=True)['species'])
+    speciesList = speciesList[~np.in1d(speciesList, np.array(['All']))]
     #print(speciesList)
     for sp in speciesList:
       # filter demand layer to only this species...
@@ -912,17 +919,14 @@ class Waterfowlmodel:
     """
     Creates attribute for hectares of habitat and hectares of protected habitat
     """
-    if not arcpy.Exists(protectedEnergy):
-      try:
-        print('Clipping protected energy')
-        arcpy.Clip_analysis(mergedenergy, protectedMerge, protectedEnergy)
-      except Exception as e:
-        print('\t Need to repair')
-        arcpy.RepairGeometry_management(mergedenergy)
-        arcpy.RepairGeometry_management(protectedMerge)
-        arcpy.Clip_analysis(mergedenergy, protectedMerge, protectedEnergy)
+    if not fingerprint.isCurrent(protectedEnergy, [mergedenergy, protectedMerge]):
+      validEnergy = validity.ensureValid(mergedenergy, os.path.join(self.scratch, os.path.splitext(os.path.basename(mergedenergy))[0] + '_valid'))
+      validProtected = validity.ensureValid(protectedMerge, os.path.join(self.scratch, os.path.splitext(os.path.basename(protectedMerge))[0] + '_valid'))
+      print('Clipping protected energy')
+      arcpy.Clip_analysis(validEnergy, validProtected, protectedEnergy)
       arcpy.CalculateField_management(in_table=protectedEnergy, field="CalcHA", expression="!shape.area@hectares!", expression_type="PYTHON_9.3", code_block="")
       arcpy.CalculateField_management(in_table=protectedEnergy, field="avalNrgy", expression="!CalcHA!* !kcal!", expression_type="PYTHON_9.3", code_block="")
+      fingerprint.record(protectedEnergy, [mergedenergy, protectedMerge])
 
   def prepProtected(self, protlist):
     """
@@ -957,21 +961,23 @@ class Waterfowlmodel:
     :type pad: list
     :param nced: List of dataset locations to be merged
     :type nced: list    
-    :param output: Location of output
+    :param output: Location of output in the scratch geodatabase
     :type output: str
     :return output: Location of output
     :rtype output: str    
     """
     print(pad)
     print(nced)
-    pad = gpd.read_file(os.path.dirname(pad), layer=os.path.basename(pad), driver='FileGDB')
-    nced = gpd.read_file(os.path.dirname(nced), layer=os.path.basename(nced), driver='FileGDB')
+    pad = scratchstore.readFrame(pad)
+    nced = scratchstore.readFrame(nced)
     #diff = pad.difference(nced).append(nced)
     diff = gpd.overlay(pad, nced, how='union')
     cc = diff.crs
     diff['CalcHA'] = diff.geometry.area/10000 #/10,000 for Hectares
     #diff = gpd.GeoDataFrame(diff, crs=cc)
-    diff.to_file(output)
+    if arcpy.Exists(output):
+      arcpy.Delete_management(output)
+    scratchstore.writeFrame(diff, output)
     return output, diff
 
   @report_time
@@ -989,7 +995,7 @@ class Waterfowlmodel:
     diffs = []
     gdfs = []
     for i in toMerge:
-      gdfs.append(gpd.read_file(os.path.dirname(i), layer=os.path.basename(i)).buffer(0))
+      gdfs.append(scratchstore.readFrame(i, []).buffer(0))
     for idx, gdf in enumerate(gdfs):
       if idx < len(gdfs) - 1:
         diffs.append(gdf.symmetric_difference(gdfs[idx+1]).iloc[0])
@@ -1003,24 +1009,17 @@ class Waterfowlmodel:
   @report_time
   def pandasClean(self, workspace, toClean):
     """
-    ESRI Repair is slow.  Pandas buffering by 0 seems to fix irregularities much faster.
+    ESRI Repair is slow.  Copies the feature class and repairs only the invalid geometries with make_valid.
 
     :param workspace: Workspace directory for storing temporary data
     :type workspace: str
     :param toClean: Feature Class that needs repair.
     :type toClean: str
-    :return output: Location of output
+    :return output: Location of the repaired copy, or toClean when every geometry is valid
     :rtype output: str
     """
     print('\tCleaning ' + os.path.basename(toClean))
-    output = os.path.join(os.path.dirname(toClean), os.path.basename(toClean) + '_Cleaned')
-    cleanMeFC = gpd.read_file(os.path.dirname(toClean), layer=os.path.basename(toClean))
-    cleanMeFC['geometry'] = cleanMeFC.buffer(0)
-    cleanMeFC = cleanMeFC.to_crs(CRS.from_string('EPSG:4326'))
-    cleaned = pd.DataFrame.spatial.from_geodataframe(cleanMeFC)
-    cleaned.spatial.to_featureclass(location=output+'toproj')
-    arcpy.Project_management(output+'toproj', output, arcpy.SpatialReference(102003))
-    return output
+    return validity.ensureValid(toClean, os.path.join(os.path.dirname(toClean), os.path.basename(toClean) + '_Cleaned'))
   
   @report_time
   def cleanMe(self, toClean):
@@ -1030,7 +1029,8 @@ class Waterfowlmodel:
 
   def prepnpTables(self, demand, binme, energy, scratch):
     """
-    Reads in merged energy dataset, repairs it, then exports a csv file for use in habitat proportion calculations.
+    Unions the demand, bins and merged energy supply, then stores the supply attributes of the union as a memory mapped supply table for the weighted mean
+    and habitat proportion calculations.
 
     :param demand: Energy demand layer location
     :type demand: str
@@ -1040,8 +1040,8 @@ class Waterfowlmodel:
     :type energy: str
     :param scratch: Scratch geodatabase location
     :type scratch: str
-    :return: Merged energy supply and demand layer location
-    :rtype: str 
+    :return: Merged energy supply and demand layer location and the supply table folder
+    :rtype: tuple
     """    
     outLayer = os.path.join(scratch, 'MergeAll')
     print('\toutlayer:', outLayer)
@@ -1050,29 +1050,31 @@ class Waterfowlmodel:
     for fc in [demand, energy]:
        if len(arcpy.ListFields(fc,'name'))>0:
          arcpy.DeleteField_management(fc,["name"])
-    if arcpy.Exists(outLayer):
-      arcpy.Delete_management(outLayer)
-    print('\tRun union')
-    arcpy.Union_analysis(in_features=unionme, out_feature_class=outLayer, join_attributes="ALL", cluster_tolerance="", gaps="GAPS")
-    wtmarray = arcpy.da.FeatureClassToNumPyArray(outLayer, ['avalNrgy','CLASS', 'CalcHA', self.binUnique[0], self.binUnique[1], 'kcal'], null_value=0)
-    return outLayer, wtmarray
+    if not fingerprint.isCurrent(outLayer, [demand, binme, energy]):
+      if arcpy.Exists(outLayer):
+        arcpy.Delete_management(outLayer)
+      print('\tRun union')
+      arcpy.Union_analysis(in_features=unionme, out_feature_class=outLayer, join_attributes="ALL", cluster_tolerance="", gaps="GAPS")
+      fingerprint.record(outLayer, [demand, binme, energy])
+    # The supply table is read from the union's scratch store copy
+    scratchstore.copyLayer(outLayer)
+    return outLayer, supplytable.build(outLayer, scratch, self.binUnique[:2])
 
   def pctHabitatType(self, binUnique, wtmarray):
     """
     Calculates proportion of habitat type by bin feature.
+
+    :param binUnique: Bin ID field
+    :type binUnique: str
+    :param wtmarray: Supply table folder returned by prepnpTables
+    :type wtmarray: str
+    :return: Habitat proportion layer location
+    :rtype: str
     """
-    print('\tConverting to pandas')
-    df = pd.DataFrame(wtmarray)
-    df = df.dropna(subset=['CLASS', binUnique, 'kcal'])
-    df1 = df.groupby([binUnique]).CalcHA.sum()
-    dfmerge = pd.merge(df, df1, on=[binUnique,binUnique],how='left')
-    dfmerge['pct'] = (dfmerge['CalcHA_x']/dfmerge['CalcHA_y'])*100
-    outdf = dfmerge.pivot_table(index=binUnique, columns='CLASS', values='pct', aggfunc=np.sum)
-    outdf = outdf.fillna(0)
-    try:
-      outdf = outdf.drop(columns = ['', 'nan'])
-    except:
-      outdf = outdf.drop(columns = [''])
+    table = supplytable.openTable(wtmarray)
+    pct, present = table.habitatPercent(binUnique)
+    outdf = pd.DataFrame(pct[present], index=pd.Index(np.asarray(table.values(binUnique))[present], name=binUnique), columns=np.asarray(table.values('CLASS')))
+    outdf = outdf.drop(columns=[c for c in ['', 'nan'] if c in outdf.columns])
     #print(outdf.sum(axis=1))
     badfields = []
     for field in self.kcalList:
@@ -1106,21 +1108,19 @@ class Waterfowlmodel:
   def weightedMean(self, inDataset, wtmarray):
     """
     Calculates weighted average of kcal/ha weight available energy as the weight.
+
+    :param inDataset: Binned energy demand layer the weighted mean is added to
+    :type inDataset: str
+    :param wtmarray: Supply table folder returned by prepnpTables
+    :type wtmarray: str
     """
     print('\tCalculating  weighted average')
-    df = pd.DataFrame(wtmarray)
-    df = df.dropna(subset=['CLASS', self.binUnique[0], 'kcal'])
-    hucsum = pd.DataFrame(df.groupby([self.binUnique[0]])['avalNrgy'].sum())
-    hucclasssum = pd.DataFrame(df.groupby([self.binUnique[0], 'CLASS'])['avalNrgy'].sum())
-    calc = hucclasssum.join(hucsum, lsuffix='_main', rsuffix='_sum')
-    calc['pct'] = calc['avalNrgy_main']/calc['avalNrgy_sum']
-    dfclass = pd.DataFrame(df.groupby([self.binUnique[0], 'CLASS'])['kcal'].mean())
-    merge = pd.merge(dfclass, calc, on=[self.binUnique[0], 'CLASS'])
-    merge['wtMeankcal'] = merge['kcal'] * merge['pct']
-    wtmean = merge.groupby([self.binUnique[0]])['wtMeankcal'].sum()
-    wtmean = wtmean.reset_index()
-    wtmean.columns = [self.binUnique[0], 'wtMeankcal']
-    outnp = np.rec.fromrecords(wtmean.values, names=wtmean.columns.tolist())
+    table = supplytable.openTable(wtmarray)
+    wtmean, present = table.weightedMean(self.binUnique[0])
+    bins = np.asarray(table.values(self.binUnique[0]))[present]
+    outnp = np.empty(len(bins), dtype=[(self.binUnique[0], bins.dtype), ('wtMeankcal', 'f8')])
+    outnp[self.binUnique[0]] = bins
+    outnp['wtMeankcal'] = wtmean[present]
     if len(arcpy.ListFields(inDataset,'wtMeankcal'))>0:
       arcpy.DeleteField_management(inDataset, 'wtMeankcal')
     arcpy.da.ExtendTable(inDataset, self.binUnique[0], outnp, self.binUnique[0])
@@ -0,0 +1,127 @@
+"""
+Module Checkpoint
+=================
+Run manifest used to resume a national run.  Every area of interest (and tile) has its own small json file with the stages it finished, their output
+locations, failed attempts, and its final result.  Workers only write their own file so no locking is needed.
+"""
+import os, glob, time, logging, arcpy
+import waterfowlmodel.fingerprint as fingerprint
+
+class RunManifest:
+  """
+  Per area of interest checkpoints for one run.
+
+  :param folder: Folder that stores the manifest files
+  :type folder: str
+  """
+  def __init__(self, folder):
+    self.folder = folder
+
+  def path(self, name):
+    '''Helper function returning the manifest file of an area of interest'''
+    return os.path.join(self.folder, '{}.json'.format(name))
+
+  def load(self, name):
+    """
+    Reads the manifest of an area of interest.
+
+    :param name: Area of interest or tile name
+    :type name: str
+    :return: Manifest {stages: {stage: outputs}, results: {stages key: result}, attempts: [errors], status: str}
+    :rtype: dict
+    """
+    manifest = fingerprint.readJson(self.path(name))
+    manifest.setdefault('stages', {})
+    manifest.setdefault('results', {})
+    manifest.setdefault('attempts', [])
+    return manifest
+
+  def update(self, name, func):
+    '''Helper function applying func to the manifest of an area of interest and writing it back'''
+    manifest = self.load(name)
+    func(manifest)
+    manifest['updated'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    fingerprint.writeJson(self.path(name), manifest)
+
+  def reset(self):
+    '''Removes every manifest so the next run starts over'''
+    for path in glob.glob(os.path.join(self.folder, '*.json')):
+      os.remove(path)
+
+  def stageDone(self, name, stage, outputs):
+    """
+    Records a finished stage.  Only outputs that are dataset locations (or empty) are stored, stages with any other output are run again on resume.
+
+    :param name: Area of interest or tile name
+    :type name: str
+    :param stage: Stage name
+    :type stage: str
+    :param outputs: Stage outputs
+    :type outputs: dict
+    """
+    if all(v is None or isinstance(v, str) for v in outputs.values()):
+      def done(manifest):
+        manifest['stages'][stage] = outputs
+        manifest['status'] = 'running'
+      self.update(name, done)
+
+  def completedStages(self, name):
+    """
+    Returns the outputs of finished stages whose datasets still exist.
+
+    :param name: Area of interest or tile name
+    :type name: str
+    :return: Outputs by stage name
+    :rtype: dict
+    """
+    stages = {}
+    for stage, outputs in self.load(name)['stages'].items():
+      if all(v is None or arcpy.Exists(v) for v in outputs.values()):
+        stages[stage] = outputs
+    return stages
+
+  def finished(self, name, key, result):
+    '''Records the result of a finished area of interest for a set of stages'''
+    def done(manifest):
+      manifest['results'][key] = result
+      manifest['status'] = 'complete'
+    self.update(name, done)
+
+  def failed(self, name, error):
+    '''Records a failed attempt for an area of interest'''
+    def fail(manifest):
+      manifest['attempts'].append(str(error))
+      manifest['status'] = 'failed'
+    self.update(name, fail)
+    logging.info('Failed {}: {}'.format(name, error))
+
+  def result(self, name, key):
+    """
+    Returns the stored result of a finished area of interest if it still exists.
+
+    :param name: Area of interest or tile name
+    :type name: str
+    :param key: Stages key the result was recorded for
+    :type key: str
+    :return: Result location, empty string for no result, or None if it has to be run
+    :rtype: str
+    """
+    manifest = self.load(name)
+    if manifest.get('status') != 'complete' or key not in manifest['results']:
+      return None
+    result = manifest['results'][key]
+    if result and not arcpy.Exists(result):
+      return None
+    return result
+
+  def status(self, name):
+    '''Returns the status of an area of interest (running, complete, failed) or None if it hasn't started'''
+    return self.load(name).get('status')
+
+  def isDone(self, name, step):
+    '''Returns True if a run level step (e.g. partitioning the national layers) finished'''
+    return step in self.load(name)['stages']
+
+  def markDone(self, name, step):
+    '''Records a finished run level step'''
+    self.update(name, lambda manifest: manifest['stages'].update({step: {}}))
@@ -0,0 +1,243 @@
+"""
+Module Column Store
+===================
+Read-only store of the national inputs shared by every pool worker.  The parent writes the kcal table, habitat crosswalks, field table and the national
+bin and demand layers once as one .npy file per column, and workers memory map the columns instead of re-reading and parsing their own copies, so the
+operating system keeps a single copy of the pages for all workers.
+
+Layers also store their geometry as one WKB buffer with the offset and bounding box of every feature.  A worker clipping a stored layer to its area of
+interest compares the memory mapped bounding boxes and only decodes the features that overlap, instead of opening the geodatabase.
+
+Tables and layers are keyed by their source and rewritten only when the source changes.  Lookups fall back to reading the source when no store is attached
+or the source isn't in it, so the model runs the same without a store.
+"""
+import os, hashlib, logging, arcpy
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import waterfowlmodel.dataset as dataset
+import waterfowlmodel.fingerprint as fingerprint
+
+state = {'folder': None}
+cache = {}
+
+def attach(folder):
+  """
+  Attaches this process to a store.  Used as part of the pool initializer.
+
+  :param folder: Store folder written by prepare
+  :type folder: str
+  """
+  state['folder'] = folder
+  cache.clear()
+
+def tableFolder(folder, source, kind):
+  '''Helper function returning the folder of one stored table'''
+  key = hashlib.sha1(os.path.abspath(source).encode()).hexdigest()[:10]
+  return os.path.join(folder, '{}_{}_{}'.format(os.path.splitext(os.path.basename(source))[0], kind, key))
+
+def isStored(folder, source, kind):
+  '''Helper function returning True when a table is stored and was made from the current version of its source'''
+  info = fingerprint.readJson(os.path.join(tableFolder(folder, source, kind), 'columns.json'))
+  return bool(info) and info.get('key') == fingerprint.datasetKey(source)
+
+def write(folder, source, kind, columns, info=None):
+  """
+  Writes one table as a .npy file per column.  Text columns are stored as fixed width unicode so they can be memory mapped.
+
+  :param folder: Store folder
+  :type folder: str
+  :param source: Source of the table
+  :type source: str
+  :param kind: Table kind (crosswalk, csv or layer)
+  :type kind: str
+  :param columns: Column arrays by name
+  :type columns: dict
+  :param info: Extra values recorded with the column names (e.g. the coordinate system of a layer)
+  :type info: dict
+  """
+  out = tableFolder(folder, source, kind)
+  os.makedirs(out, exist_ok=True)
+  names = []
+  for i, (name, values) in enumerate(columns.items()):
+    values = np.asarray(values)
+    if values.dtype == object:
+      nulls = pd.isnull(values)
+      if nulls.any():
+        np.save(os.path.join(out, '{}_null.npy'.format(i)), nulls)
+      values = np.array(['' if n else str(v) for v, n in zip(values, nulls)], dtype=str)
+    np.save(os.path.join(out, '{}.npy'.format(i)), values)
+    names.append(name)
+  # Written last so a table interrupted while writing is never read
+  fingerprint.writeJson(os.path.join(out, 'columns.json'), dict(info or {}, source=source, key=fingerprint.datasetKey(source), columns=names))
+
+def read(source, kind):
+  """
+  Returns the memory mapped columns of a stored table.
+
+  :param source: Source of the table
+  :type source: str
+  :param kind: Table kind (crosswalk, csv or layer)
+  :type kind: str
+  :return: Column arrays by name and the recorded table information, or None when no store is attached or the table is missing or out of date
+  :rtype: tuple
+  """
+  if state['folder'] is None or not source:
+    return None
+  if (source, kind) in cache:
+    return cache[(source, kind)]
+  folder = tableFolder(state['folder'], source, kind)
+  info = fingerprint.readJson(os.path.join(folder, 'columns.json'))
+  exists = arcpy.Exists(source) if kind == 'layer' else os.path.isfile(source)
+  if not info or not exists or info['key'] != fingerprint.datasetKey(source):
+    return None
+  columns = {}
+  for i, name in enumerate(info['columns']):
+    values = np.load(os.path.join(folder, '{}.npy'.format(i)), mmap_mode='r')
+    nullPath = os.path.join(folder, '{}_null.npy'.format(i))
+    if os.path.isfile(nullPath):
+      values = np.where(np.load(nullPath), np.nan, values.astype(object))
+    columns[name] = values
+  cache[(source, kind)] = columns, info
+  return columns, info
+
+def crosswalk(xTable):
+  """
+  Returns a habitat crosswalk from the store, or from the file when it isn't stored.
+
+  :param xTable: Crosswalk file (json, csv or npz)
+  :type xTable: str
+  :return: Habitat types by class
+  :rtype: dict
+  """
+  stored = read(xTable, 'crosswalk')
+  if stored is None:
+    return dataset.readCrosswalk(xTable)
+  columns = stored[0]
+  # One stored row per habitat type.  A new row number starts the class over like a repeated key in the file would.
+  dataDict, last = {}, None
+  for row, key, value in zip(columns['row'].tolist(), columns['key'].tolist(), columns['value'].tolist()):
+    if row != last:
+      dataDict[key], last = [], row
+    dataDict[key].append(value)
+  return dataDict
+
+def frame(csvPath, **kwargs):
+  """
+  Returns a csv table from the store as a DataFrame, or reads the csv when it isn't stored.
+
+  :param csvPath: Csv file
+  :type csvPath: str
+  :param kwargs: Arguments passed to pandas.read_csv when the table isn't stored
+  :type kwargs: dict
+  :return: Table
+  :rtype: pandas.DataFrame
+  """
+  stored = read(csvPath, 'csv')
+  if stored is None:
+    return pd.read_csv(csvPath, **kwargs)
+  return pd.DataFrame({name: np.asarray(values) for name, values in stored[0].items()})
+
+def features(inFeature, chunkSize, mask):
+  """
+  Returns the features of a stored layer within the bounding box of a mask in chunks, like dataset.iterFeatures.
+
+  :param inFeature: National feature class
+  :type inFeature: str
+  :param chunkSize: Number of features in each chunk
+  :type chunkSize: int
+  :param mask: Only features whose bounding box overlaps the bounding box of the mask are read.  The mask can be in any coordinate system.
+  :type mask: GeoDataFrame
+  :return: Generator of GeoDataFrames, or None when the layer isn't stored
+  :rtype: generator
+  """
+  stored = read(inFeature, 'layer')
+  if stored is None:
+    return None
+  columns, info = stored
+  folder = tableFolder(state['folder'], inFeature, 'layer')
+  bounds = np.load(os.path.join(folder, 'bounds.npy'), mmap_mode='r')
+  offsets = np.load(os.path.join(folder, 'offsets.npy'), mmap_mode='r')
+  wkb = np.memmap(os.path.join(folder, 'geometry.bin'), dtype=np.uint8, mode='r') if offsets[-1] else np.zeros(0, dtype=np.uint8)
+  box = mask.to_crs(info['crs']).total_bounds
+  # Missing geometries have NaN bounds and never overlap
+  hits = np.flatnonzero((bounds[:, 2] >= box[0]) & (bounds[:, 3] >= box[1]) & (bounds[:, 0] <= box[2]) & (bounds[:, 1] <= box[3]))
+  def chunks():
+    for start in range(0, len(hits), chunkSize):
+      rows = hits[start:start + chunkSize]
+      geoms = shapely.from_wkb(np.array([wkb[offsets[r]:offsets[r + 1]].tobytes() for r in rows], dtype=object))
+      yield gpd.GeoDataFrame({name: np.asarray(values[rows]) for name, values in columns.items()}, geometry=geoms, crs=info['crs'])
+  return chunks()
+
+def writeLayer(folder, inFeature, chunkSize=50000):
+  """
+  Writes the attribute columns of a layer, its geometry as one WKB buffer and the offset and bounding box of every feature.
+
+  :param folder: Store folder
+  :type folder: str
+  :param inFeature: Feature class
+  :type inFeature: str
+  :param chunkSize: Number of features read at a time
+  :type chunkSize: int
+  """
+  out = tableFolder(folder, inFeature, 'layer')
+  os.makedirs(out, exist_ok=True)
+  frames, offsets, bounds = [], [np.zeros(1, dtype=np.int64)], []
+  crs, end = None, 0
+  with open(os.path.join(out, 'geometry.bin'), 'wb') as f:
+    for chunk in dataset.iterFeatures(inFeature, chunkSize):
+      crs = chunk.crs.to_wkt() if chunk.crs else crs
+      geoms = np.asarray(chunk.geometry.values)
+      wkbs = shapely.to_wkb(geoms)
+      sizes = np.array([0 if w is None else len(w) for w in wkbs], dtype=np.int64)
+      f.write(b''.join(w for w in wkbs if w is not None))
+      offsets.append(end + np.cumsum(sizes))
+      end += int(sizes.sum())
+      bounds.append(shapely.bounds(geoms))
+      frames.append(pd.DataFrame(chunk.drop(columns=chunk.geometry.name)))
+  np.save(os.path.join(out, 'offsets.npy'), np.concatenate(offsets))
+  np.save(os.path.join(out, 'bounds.npy'), np.concatenate(bounds) if bounds else np.zeros((0, 4)))
+  attributes = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+  write(folder, inFeature, 'layer', {name: attributes[name].to_numpy(dtype=object if attributes[name].dtype.kind in 'OT' else None) for name in attributes.columns},
+        {'crs': crs})
+
+def prepare(folder, crosswalks=(), tables=(), layers=()):
+  """
+  Writes the shared tables and layers for a run.  Sources that didn't change since the last run are kept.
+
+  :param folder: Store folder
+  :type folder: str
+  :param crosswalks: Crosswalk files (json, csv or npz)
+  :type crosswalks: list
+  :param tables: Csv files read as tables.  Items are a path or a (path, read_csv arguments) pair
+  :type tables: list
+  :param layers: National feature classes clipped by every area of interest (e.g. the bin and demand layers)
+  :type layers: list
+  :return: folder
+  :rtype: str
+  """
+  for xTable in [x for x in crosswalks if x]:
+    if isStored(folder, xTable, 'crosswalk'):
+      continue
+    dataDict = dataset.readCrosswalk(xTable)
+    if not all(isinstance(v, list) and v and all(isinstance(i, str) for i in v) for v in dataDict.values()):
+      logging.info('Crosswalk {} is not a list of habitat types by class.  Not stored'.format(xTable))
+      continue
+    rows = [(r, k, str(v)) for r, (k, values) in enumerate(dataDict.items()) for v in values]
+    write(folder, xTable, 'crosswalk', {'row': np.array([r[0] for r in rows], dtype=np.int32), 'key': np.array([r[1] for r in rows], dtype=str),
+                                         'value': np.array([r[2] for r in rows], dtype=str)})
+    print('\tStored crosswalk {}'.format(xTable))
+  for table in tables:
+    csvPath, kwargs = table if isinstance(table, tuple) else (table, {})
+    if not csvPath or isStored(folder, csvPath, 'csv'):
+      continue
+    df = pd.read_csv(csvPath, **kwargs)
+    write(folder, csvPath, 'csv', {name: df[name].to_numpy(dtype=object if df[name].dtype.kind in 'OT' else None) for name in df.columns})
+    print('\tStored table {}'.format(csvPath))
+  for inFeature in [l for l in layers if l]:
+    if isStored(folder, inFeature, 'layer'):
+      continue
+    writeLayer(folder, inFeature)
+    print('\tStored layer {}'.format(inFeature))
+  return folder
@@ -0,0 +1,270 @@
+"""
+Module Compact Geometry
+=======================
+Compact storage for scratch layers.  Coordinates are snapped to a grid (1 cm by default, the model works in Albers meters), stored as integer steps from
+the previous vertex of the same ring, and written to a compressed .npz with the attribute columns.  Deltas are stored in the smallest integer type that
+holds them, so a layer usually takes a fraction of its double precision size.  Attribute columns keep their dtype and nulls, missing geometries stay
+missing, and a bbox read only rebuilds the geometries whose bounding box intersects the box.
+
+Snapping moves every vertex by at most half a grid cell on each axis.  For a ring with perimeter P and n vertices that changes the area by at most
+d*P + n*d*d/2 where d is half the cell diagonal.  The bound and the measured area change are stored with every layer and logged when it's written.
+"""
+import os, re, logging
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+
+GRID = 0.01
+# NumPy types for the values of object columns by pandas.api.types.infer_dtype kind.  Other kinds are stored as text
+STORED_KINDS = {'string': str, 'empty': str, 'bytes': bytes, 'boolean': bool, 'integer': np.int64, 'floating': np.float64, 'mixed-integer-float': np.float64,
+                'decimal': np.float64, 'datetime': 'M8[us]', 'datetime64': 'M8[us]', 'date': 'M8[D]', 'timedelta': 'm8[us]', 'timedelta64': 'm8[us]'}
+
+def smallestInt(values):
+  '''Helper function returning values in the smallest signed integer type that holds them'''
+  if not len(values):
+    return values.astype(np.int16)
+  low, high = values.min(), values.max()
+  for dtype in [np.int8, np.int16, np.int32]:
+    info = np.iinfo(dtype)
+    if low >= info.min and high <= info.max:
+      return values.astype(dtype)
+  return values.astype(np.int64)
+
+def encode(geoms, grid=GRID):
+  """
+  Snaps geometries to a grid and delta encodes each ring.  Missing geometries are kept as a mask and empty geometries by their type.  Single part
+  geometries in a layer that also has multi part geometries are flagged so they come back single part.
+
+  :param geoms: Polygon, line or point geometries of one family.  Can hold None
+  :type geoms: numpy.ndarray
+  :param grid: Grid cell size in layer units
+  :type grid: float
+  :return: Encoded arrays
+  :rtype: dict
+  """
+  geoms = np.asarray(geoms, dtype=object)
+  missing = shapely.is_missing(geoms)
+  # Empty geometries are rebuilt from their type since from_ragged_array can't read them back in a multi part layer
+  emptyType = np.where(~missing & shapely.is_empty(geoms), shapely.get_type_id(geoms), -1).astype(np.int8)
+  present = geoms[~missing & (emptyType < 0)]
+  if len(present):
+    geomType, coords, offsets = shapely.to_ragged_array(present)
+  else:
+    geomType, coords, offsets = shapely.GeometryType.POLYGON, np.zeros((0, 2)), (np.zeros(1, dtype=np.int32), np.zeros(1, dtype=np.int32))
+  # to_ragged_array returns every geometry as multi part when the layer has both
+  single = shapely.get_type_id(present) != int(geomType)
+  origin = coords.min(axis=0) if len(coords) else np.zeros(2)
+  q = np.round((coords - origin) / grid).astype(np.int64)
+  # Part starts (rings for polygons, lines for lines) keep their position, every other vertex stores the step from the vertex before it
+  isStart = partStarts(offsets, len(q))
+  deltas = np.diff(q, axis=0, prepend=np.zeros((1, 2), dtype=np.int64))
+  return {'geomType': np.array(int(geomType)), 'grid': np.array(grid), 'origin': origin, 'first': smallestInt(q[isStart]), 'deltas': smallestInt(deltas[~isStart]),
+          'count': np.array(len(q)), 'missing': missing, 'emptyType': emptyType, 'single': single, **{'offsets{}'.format(i): np.asarray(o) for i, o in enumerate(offsets)}}
+
+def partStarts(offsets, count):
+  '''Helper function returning a mask of the coordinates that start a ring, line or point'''
+  starts = np.asarray(offsets[0][:-1]) if len(offsets) else np.arange(count)
+  isStart = np.zeros(count, dtype=bool)
+  isStart[starts[starts < count]] = True
+  return isStart
+
+def select(arrays, offsets, isStart, keep):
+  '''Helper function returning the offsets, part starts and steps of the encoded geometries at positions keep'''
+  index = keep
+  subOffsets = []
+  # Walk down from the geometries to the coordinates, keeping the selected range at every level
+  for o in reversed(offsets):
+    lengths = o[index + 1] - o[index]
+    subOffsets.insert(0, np.concatenate([[0], np.cumsum(lengths)]).astype(o.dtype))
+    index = np.repeat(o[index] - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+  firstPos = np.cumsum(isStart) - 1
+  deltaPos = np.cumsum(~isStart) - 1
+  subStart = isStart[index]
+  steps = np.zeros((len(index), 2), dtype=np.int64)
+  steps[subStart] = arrays['first'][firstPos[index[subStart]]]
+  steps[~subStart] = arrays['deltas'][deltaPos[index[~subStart]]]
+  return tuple(subOffsets), subStart, steps
+
+def decode(arrays, keep=None):
+  """
+  Rebuilds geometries from encoded arrays.
+
+  :param arrays: Arrays returned by encode
+  :type arrays: dict
+  :param keep: Positions of the geometries to rebuild.  Rebuilds every geometry when None
+  :type keep: numpy.ndarray
+  :return: Geometries on the grid, None where a geometry was missing
+  :rtype: numpy.ndarray
+  """
+  count = int(arrays['count'])
+  offsets = tuple(arrays['offsets{}'.format(i)] for i in range(len([k for k in arrays if k.startswith('offsets')])))
+  emptyType = arrays['emptyType']
+  stored = ~arrays['missing'] & (emptyType < 0)
+  keep = np.arange(len(stored)) if keep is None else np.asarray(keep, dtype=np.int64)
+  out = np.full(len(keep), None, dtype=object)
+  for t in np.unique(emptyType[keep][emptyType[keep] >= 0]).tolist():
+    out[emptyType[keep] == t] = shapely.from_wkt(shapely.GeometryType(t).name + ' EMPTY')
+  # Positions of the kept geometries among the encoded ones
+  encoded = (np.cumsum(stored) - 1)[keep[stored[keep]]]
+  if not len(encoded):
+    return out
+  isStart = partStarts(offsets, count)
+  if len(encoded) == stored.sum():
+    steps = np.zeros((count, 2), dtype=np.int64)
+    steps[isStart] = arrays['first']
+    steps[~isStart] = arrays['deltas']
+  else:
+    offsets, isStart, steps = select(arrays, offsets, isStart, encoded)
+  # Cumulative sum within each part: starts hold absolute positions so the running total before a start is removed from the part
+  total = np.cumsum(steps, axis=0)
+  before = np.vstack([np.zeros((1, 2), dtype=np.int64), total[:-1]])[isStart]
+  part = np.cumsum(isStart) - 1
+  q = total - before[part] if len(total) else total
+  coords = q * float(arrays['grid']) + arrays['origin']
+  geoms = shapely.from_ragged_array(shapely.GeometryType(int(arrays['geomType'])), coords, offsets)
+  single = arrays['single'][encoded]
+  geoms[single] = shapely.get_geometry(geoms[single], 0)
+  out[stored[keep]] = geoms
+  return out
+
+def areaErrorBound(geoms, grid=GRID):
+  """
+  Returns the largest possible total area change from snapping geometries to a grid.
+
+  :param geoms: Geometries
+  :type geoms: numpy.ndarray
+  :param grid: Grid cell size in layer units
+  :type grid: float
+  :return: Area error bound in square layer units
+  :rtype: float
+  """
+  d = grid * np.sqrt(2) / 2
+  return float(np.sum(d * shapely.length(geoms) + shapely.get_num_coordinates(geoms) * d * d / 2))
+
+def encodeColumn(series):
+  '''Helper function returning the values of a column as a NumPy array, and the null mask of columns stored without their nulls'''
+  if isinstance(series.dtype, pd.DatetimeTZDtype):
+    series = series.dt.tz_convert('UTC').dt.tz_localize(None)
+  values = series.to_numpy()
+  if values.dtype.kind in 'biufmM':
+    return values, None
+  nulls = np.asarray(pd.isnull(values), dtype=bool)
+  filled = values[~nulls]
+  kind = pd.api.types.infer_dtype(filled, skipna=False)
+  if kind not in STORED_KINDS:
+    logging.warning('Column {} holds {} values.  Storing them as text'.format(series.name, kind))
+    return np.array([str(v) for v in filled], dtype=str), nulls
+  return np.array(filled.tolist(), dtype=STORED_KINDS[kind]), nulls
+
+def decodeColumn(values, nulls, dtype):
+  '''Helper function rebuilding a column as a Series with its original dtype'''
+  if nulls is not None:
+    full = np.full(len(nulls), None, dtype=object)
+    full[~nulls] = values.astype(object)
+    values = full
+  dtype = pd.api.types.pandas_dtype(dtype)
+  if values.dtype == dtype:
+    return pd.Series(values, dtype=dtype)
+  if isinstance(dtype, pd.DatetimeTZDtype):
+    return pd.Series(values).dt.tz_localize('UTC').dt.tz_convert(dtype.tz)
+  return pd.Series(values, dtype=object).astype(dtype)
+
+def outwardBounds(bounds):
+  '''Helper function returning bounds as float32 rounded outward, so a bbox read never misses a feature that touches the box'''
+  bounds = np.asarray(bounds, dtype=np.float64)
+  low, high = bounds[:, :2].astype(np.float32), bounds[:, 2:].astype(np.float32)
+  low = np.where(low > bounds[:, :2], np.nextafter(low, np.float32(-np.inf)), low)
+  high = np.where(high < bounds[:, 2:], np.nextafter(high, np.float32(np.inf)), high)
+  return np.hstack([low, high])
+
+def writeCompact(gdf, path, grid=GRID):
+  """
+  Writes a layer in the compact format.  Attribute columns keep their dtype and nulls.
+
+  :param gdf: Layer contents
+  :type gdf: GeoDataFrame
+  :param path: Output .npz file
+  :type path: str
+  :param grid: Grid cell size in layer units
+  :type grid: float
+  :return: Area report {area, bound, error, relativeBound} of the geometries that aren't missing
+  :rtype: dict
+  """
+  geoms = np.asarray(gdf.geometry.values, dtype=object)
+  arrays = encode(geoms, grid)
+  decoded = decode(arrays)
+  present = ~arrays['missing']
+  area = float(np.sum(shapely.area(geoms[present])))
+  report = {'area': area, 'bound': areaErrorBound(geoms[present], grid), 'error': float(np.sum(np.abs(shapely.area(decoded[present]) - shapely.area(geoms[present]))))}
+  report['relativeBound'] = report['bound'] / area if area else 0.0
+  columns = [c for c in gdf.columns if c != gdf.geometry.name]
+  for i, col in enumerate(columns):
+    values, nulls = encodeColumn(gdf[col])
+    if nulls is not None:
+      arrays['null{}'.format(i)] = nulls
+    arrays['col{}'.format(i)] = values
+  bounds = shapely.bounds(decoded) if len(decoded) else np.zeros((0, 4))
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  np.savez_compressed(path, columns=np.array(columns, dtype=str), dtypes=np.array([str(gdf[c].dtype) for c in columns], dtype=str),
+                      crs=np.array(gdf.crs.to_wkt() if gdf.crs else ''), bounds=outwardBounds(bounds), report=np.array([report['area'], report['bound'], report['error']]), **arrays)
+  logging.info('Compact {}: area {:.1f}, snapping changed it by {:.3f} (bound {:.3f}, {:.2e} of the area)'.format(path, area, report['error'], report['bound'], report['relativeBound']))
+  return report
+
+def readCompact(path, columns=None, bbox=None):
+  """
+  Reads a layer written by writeCompact.
+
+  :param path: Compact .npz file
+  :type path: str
+  :param columns: Attribute columns to read.  Reads every column when None
+  :type columns: list
+  :param bbox: Only return features whose bounding box intersects (xmin, ymin, xmax, ymax).  Only those features are decoded
+  :type bbox: tuple
+  :return: Layer contents
+  :rtype: GeoDataFrame
+  """
+  with np.load(path) as data:
+    names = data['columns'].tolist()
+    wanted = [i for i, name in enumerate(names) if columns is None or name in columns]
+    # Only the requested attribute columns are decompressed
+    keys = [k for k in data.files if not re.fullmatch(r'(col|null)\d+', k)] + [k.format(i) for i in wanted for k in ['col{}', 'null{}'] if k.format(i) in data.files]
+    arrays = {k: data[k] for k in keys}
+  keep = None
+  if bbox is not None:
+    b = arrays['bounds']
+    keep = np.flatnonzero((b[:, 0] <= bbox[2]) & (b[:, 2] >= bbox[0]) & (b[:, 1] <= bbox[3]) & (b[:, 3] >= bbox[1]))
+  geoms = decode(arrays, keep)
+  data = {}
+  for i in wanted:
+    nulls = arrays.get('null{}'.format(i))
+    values = decodeColumn(arrays['col{}'.format(i)], nulls, arrays['dtypes'][i])
+    data[names[i]] = values if keep is None else values.iloc[keep].reset_index(drop=True)
+  crs = str(arrays['crs']) or None
+  return gpd.GeoDataFrame(data, geometry=geoms, crs=crs).reset_index(drop=True)
+
+def readColumns(path, columns):
+  """
+  Reads attribute columns of a layer written by writeCompact without rebuilding its geometry.
+
+  :param path: Compact .npz file
+  :type path: str
+  :param columns: Attribute columns to read
+  :type columns: list
+  :return: Columns in the requested order
+  :rtype: pandas.DataFrame
+  """
+  with np.load(path) as data:
+    names = data['columns'].tolist()
+    out = {}
+    for i, name in enumerate(names):
+      if name in columns:
+        nulls = data['null{}'.format(i)] if 'null{}'.format(i) in data.files else None
+        out[name] = decodeColumn(data['col{}'.format(i)], nulls, data['dtypes'][i])
+  return pd.DataFrame({c: out[c] for c in columns if c in out})
+
+def report(path):
+  '''Returns the stored area report {area, bound, error} of a compact layer'''
+  with np.load(path) as data:
+    area, bound, error = data['report'].tolist()
+  return {'area': area, 'bound': bound, 'error': error}
@@ -3,8 +3,126 @@ Module Dataset
 ================
 Defines Dataset class which is initialized by supplying habitat and the crosswalk table.  It's used for organizing spatial datasets.
 """
-import os, sys, getopt, datetime, logging, arcpy
+import os, sys, getopt, datetime, logging, itertools, csv, json, arcpy
 from arcpy import env
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import fiona
+
+def gdfToFeatureClass(gdf, outfc, template=None, spatialReference=None):
+  '''Helper function for writing a geodataframe to a feature class.  Appends when the feature class already exists.  The feature class is created with
+  arcpy so it has the template schema, and the rows are appended in one bulk write instead of one insert per feature'''
+  if not arcpy.Exists(outfc):
+    if spatialReference is None:
+      if template:
+        spatialReference = arcpy.Describe(template).spatialReference
+      else:
+        spatialReference = arcpy.SpatialReference()
+        spatialReference.loadFromString(gdf.crs.to_wkt())
+    if template:
+      geomType = arcpy.Describe(template).shapeType.upper()
+    else:
+      geomType = {'Point':'POINT', 'MultiPoint':'MULTIPOINT', 'LineString':'POLYLINE', 'MultiLineString':'POLYLINE'}.get(gdf.geom_type.iloc[0] if len(gdf) else '', 'POLYGON')
+    arcpy.CreateFeatureclass_management(os.path.dirname(outfc), os.path.basename(outfc), geomType, template, spatial_reference=spatialReference)
+    if not template:
+      for col, dtype in gdf.drop(columns='geometry').dtypes.items():
+        if pd.api.types.is_integer_dtype(dtype):
+          arcpy.AddField_management(outfc, col, "LONG")
+        elif pd.api.types.is_float_dtype(dtype):
+          arcpy.AddField_management(outfc, col, "DOUBLE")
+        else:
+          arcpy.AddField_management(outfc, col, "TEXT", field_length=255)
+  fcFields = [f.name for f in arcpy.ListFields(outfc) if f.editable and f.type not in ('OID', 'Geometry')]
+  fields = [c for c in gdf.columns if c in fcFields]
+  out = gdf.loc[~(gdf.geometry.isna() | gdf.geometry.is_empty), fields + [gdf.geometry.name]]
+  if not len(out):
+    return outfc
+  workspace, name = os.path.split(outfc)
+  if os.path.splitext(workspace)[1].lower() == '.gdb':
+    out.to_file(workspace, layer=name, driver='OpenFileGDB', mode='a')
+  else:
+    out.to_file(outfc, mode='a')
+  return outfc
+
+def iterFeatures(inFeature, chunkSize, mask=None, index=None):
+  """
+  Streams a feature class in chunks so a national layer never has to be held in memory at once.
+
+  :param inFeature: Feature class to read
+  :type inFeature: str
+  :param chunkSize: Number of features in each chunk
+  :type chunkSize: int
+  :param mask: Only features within the bounding box of the mask are read.  The mask can be in any coordinate system.
+  :type mask: GeoDataFrame
+  :param index: Packed R-tree of inFeature.  With a mask, the features are picked from the index and read by ID instead of filtering the whole layer.
+  :type index: waterfowlmodel.spatialindex.PackedRTree
+  :return: Generator of GeoDataFrames
+  :rtype: generator
+  """
+  with fiona.open(os.path.dirname(inFeature), layer=os.path.basename(inFeature), driver='FileGDB') as src:
+    crs = src.crs_wkt
+    features = src
+    if mask is not None and index is not None:
+      features = (src[int(fid)] for fid in index.query(tuple(mask.to_crs(crs).total_bounds)))
+    elif mask is not None:
+      features = src.filter(bbox=tuple(mask.to_crs(crs).total_bounds))
+    batch = []
+    for feat in features:
+      batch.append(feat)
+      if len(batch) >= chunkSize:
+        yield gpd.GeoDataFrame.from_features(batch, crs=crs)
+        batch = []
+    if batch:
+      yield gpd.GeoDataFrame.from_features(batch, crs=crs)
+
+# NumPy types for arcpy field types read by iterTable.  Text fields use their field length.
+FIELD_DTYPES = {'OID': 'i4', 'SmallInteger': 'i2', 'Integer': 'i4', 'BigInteger': 'i8', 'Single': 'f4', 'Double': 'f8', 'Date': 'M8[us]', 'GUID': 'U38', 'GlobalID': 'U38'}
+# Values used for nulls by NumPy kind when no null value is given
+NULL_VALUES = {'i': 0, 'f': np.nan, 'U': '', 'M': np.datetime64('NaT')}
+
+def tableDtype(in_table, columns):
+  '''Helper function returning the NumPy dtype for columns of a table or feature class'''
+  fields = {f.name.upper(): f for f in arcpy.ListFields(in_table)}
+  dtype = []
+  for col in columns:
+    field = fields.get(col.upper())
+    if field is None:
+      raise ValueError('Field {} not found in {}'.format(col, in_table))
+    if field.type == 'String':
+      dtype.append((col, 'U{}'.format(max(field.length, 1))))
+    elif field.type in FIELD_DTYPES:
+      dtype.append((col, FIELD_DTYPES[field.type]))
+    else:
+      raise ValueError('Field {} of type {} can\'t be read as a column'.format(col, field.type))
+  return np.dtype(dtype)
+
+def iterTable(in_table, columns, chunkSize=100000, nullValues=None, where=None):
+  """
+  Streams columns of a table or feature class as typed NumPy chunks so only one chunk of rows is held as Python objects at a time.
+
+  :param in_table: Table or feature class to read
+  :type in_table: str
+  :param columns: Fields to read
+  :type columns: list
+  :param chunkSize: Number of rows in each chunk
+  :type chunkSize: int
+  :param nullValues: Values used for nulls by field name.  Defaults to 0 for integers, NaN for floats, NaT for dates and an empty string for text
+  :type nullValues: dict
+  :param where: Where clause limiting the rows read
+  :type where: str
+  :return: Generator of NumPy structured arrays
+  :rtype: generator
+  """
+  dtype = tableDtype(in_table, columns)
+  nulls = [dict(nullValues or {}).get(col, NULL_VALUES[dtype[col].kind]) for col in columns]
+  with arcpy.da.SearchCursor(in_table, columns, where) as cursor:
+    while True:
+      rows = list(itertools.islice(cursor, chunkSize))
+      if not rows:
+        break
+      rows = (tuple(n if v is None else v for v, n in zip(row, nulls)) for row in rows)
+      yield np.fromiter(rows, dtype=dtype)
 
 class Dataset:
   """
@@ -25,3 +143,24 @@ class Dataset:
     self.scratch = scratch
     self.classAttr = classAttr
     env.workspace = scratch
+
+def readCrosswalk(xTable):
+  """
+  Reads a habitat crosswalk from a json file, a csv file with the class in the first column and comma separated habitat types in the second, or an .npz
+  lookup written by mergeNWIDict.
+
+  :param xTable: Crosswalk file
+  :type xTable: str
+  :return: Habitat types by class
+  :rtype: dict
+  """
+  ext = os.path.splitext(xTable)[-1].lower()
+  if ext == '.json':
+    return json.load(open(xTable))
+  if ext == '.npz':
+    with np.load(xTable) as data:
+      classes, codes, classIndex = data['classes'].tolist(), data['codes'], data['classIndex']
+    return {c: codes[classIndex == i].tolist() for i, c in enumerate(classes)}
+  with open(xTable, mode='r') as infile:
+    reader = csv.reader(infile)
+    return {rows[0]: rows[1].split(',') for rows in reader}
@@ -0,0 +1,269 @@
+"""
+Module Fingerprint
+==================
+Content fingerprints for datasets and the small json manifests stored with derived data.  Used to decide if derived data is still current with its sources
+instead of only checking that an output name exists.
+"""
+import os, json, glob, shutil, hashlib, logging, arcpy
+from functools import lru_cache
+import pyogrio
+
+BLOCKSIZE = 1 << 20
+SHAPEFILE_PARTS = ['.shp', '.shx', '.dbf', '.prj']
+
+def fileHash(path):
+  '''Helper function returning the sha1 of a file read in blocks'''
+  h = hashlib.sha1()
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(BLOCKSIZE), b''):
+      h.update(block)
+  return h.hexdigest()
+
+@lru_cache(maxsize=None)
+def codeVersion():
+  '''Helper function returning a hash of the model source code so derived data is rebuilt after the code changes'''
+  h = hashlib.sha1()
+  for path in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '*.py'))):
+    h.update(fileHash(path).encode())
+  return h.hexdigest()
+
+def workspaceOf(inData):
+  '''Helper function returning the geodatabase or folder holding a dataset'''
+  folder = os.path.dirname(inData)
+  while folder and not os.path.splitext(folder)[1].lower() == '.gdb' and not os.path.isdir(folder):
+    folder = os.path.dirname(folder)
+  return folder
+
+@lru_cache(maxsize=None)
+def systemCatalog(gdb, stamp):
+  '''Helper function returning the file number of every table in a file geodatabase.  Cached by the size and time of the catalog file'''
+  catalog = pyogrio.read_dataframe(gdb, layer='GDB_SystemCatalog', read_geometry=False, fid_as_index=True)
+  return {name.lower(): int(fid) for fid, name in zip(catalog.index, catalog['Name'])}
+
+def tableFiles(inData):
+  """
+  Files holding a table or feature class.  A shapefile is its .shp, .shx, .dbf and .prj.  A file geodatabase table is stored in a<file number>.* files
+  where the file number is its row in GDB_SystemCatalog.
+
+  :param inData: Dataset location
+  :type inData: str
+  :return: File locations.  Empty when the files can't be found
+  :rtype: list
+  """
+  root, ext = os.path.splitext(inData)
+  if ext.lower() == '.shp':
+    return [root + p for p in SHAPEFILE_PARTS if os.path.isfile(root + p)]
+  if os.path.isfile(inData):
+    return [inData]
+  gdb = workspaceOf(inData)
+  system = os.path.join(gdb, 'a00000001.gdbtable')
+  if not os.path.splitext(gdb)[1].lower() == '.gdb' or not os.path.isfile(system):
+    return []
+  st = os.stat(system)
+  try:
+    number = systemCatalog(gdb, (st.st_size, st.st_mtime)).get(os.path.basename(inData).lower())
+  except Exception:
+    return []
+  if number is None:
+    return []
+  return sorted(glob.glob(os.path.join(gdb, 'a{:08x}.*'.format(number))))
+
+def datasetKey(inData):
+  """
+  Quick key made from the dataset properties and the size and modification time of the dataset's own files.  Edits to other datasets in the same
+  geodatabase don't change it.  Only used to avoid recomputing the content hash.
+
+  :param inData: Dataset location
+  :type inData: str
+  :return: Dataset key
+  :rtype: str
+  """
+  h = hashlib.sha1(inData.encode())
+  files = tableFiles(inData)
+  for f in files:
+    st = os.stat(f)
+    h.update('{}{}{}'.format(os.path.basename(f), st.st_size, st.st_mtime).encode())
+  if os.path.isfile(inData):
+    return h.hexdigest()
+  desc = arcpy.Describe(inData)
+  h.update(desc.dataType.encode())
+  if hasattr(desc, 'fields'):
+    h.update(';'.join(f.name + f.type for f in desc.fields).encode())
+    h.update(str(arcpy.GetCount_management(inData)[0]).encode())
+  if hasattr(desc, 'extent'):
+    h.update(str(desc.extent).encode())
+  if hasattr(desc, 'spatialReference'):
+    h.update(desc.spatialReference.name.encode())
+  return h.hexdigest()
+
+def contentHash(inData):
+  """
+  Hash of the dataset content.  Files are hashed directly.  Tables and feature classes are hashed from their attributes and the WKB of every geometry.
+
+  :param inData: Dataset location
+  :type inData: str
+  :return: Content hash
+  :rtype: str
+  """
+  h = hashlib.sha1()
+  if os.path.isfile(inData):
+    for p in tableFiles(inData):
+      h.update(fileHash(p).encode())
+    return h.hexdigest()
+  desc = arcpy.Describe(inData)
+  if desc.dataType not in ('FeatureClass', 'Table'):
+    return datasetKey(inData)
+  fields = ['OID@'] + [f.name for f in desc.fields if f.type not in ('OID', 'Geometry', 'Blob', 'Raster') and f.name.lower() not in ('shape_length', 'shape_area')]
+  shape = desc.dataType == 'FeatureClass'
+  if shape:
+    fields += ['SHAPE@WKB']
+    h.update(desc.spatialReference.exportToString().encode())
+  h.update(';'.join(fields).encode())
+  with arcpy.da.SearchCursor(inData, fields) as cursor:
+    for row in cursor:
+      if shape:
+        h.update(repr(row[:-1]).encode())
+        h.update(bytes(row[-1] or b''))
+      else:
+        h.update(repr(row).encode())
+  return h.hexdigest()
+
+def datasetHash(inData):
+  """
+  Content hash of a dataset.  Hashes are memoized on disk next to the manifests by the quick dataset key so unchanged national layers are only read once.
+
+  :param inData: Dataset location
+  :type inData: str
+  :return: Content hash
+  :rtype: str
+  """
+  key = datasetKey(inData)
+  memo = manifestPath(inData, 'hash')
+  known = readJson(memo)
+  if known.get('key') == key:
+    return known['hash']
+  digest = contentHash(inData)
+  try:
+    writeJson(memo, {'source': inData, 'key': key, 'hash': digest})
+  except OSError:
+    logging.info('Unable to store fingerprint for ' + inData)
+  return digest
+
+def manifestPath(outData, kind='manifest'):
+  """
+  Manifest location for a dataset.  Manifests for data in a geodatabase are stored in a folder next to the geodatabase.
+
+  :param outData: Dataset location
+  :type outData: str
+  :param kind: Manifest kind used as the file suffix
+  :type kind: str
+  :return: Manifest location
+  :rtype: str
+  """
+  folder, name = os.path.split(outData)
+  root, ext = os.path.splitext(folder)
+  if ext.lower() == '.gdb':
+    folder = root + '_manifest'
+  else:
+    folder = os.path.join(folder, '_manifest')
+  return os.path.join(folder, '{}.{}.json'.format(os.path.splitext(name)[0], kind))
+
+def readJson(path):
+  '''Helper function returning the json stored at path or an empty dictionary'''
+  if not os.path.isfile(path):
+    return {}
+  try:
+    with open(path) as f:
+      return json.load(f)
+  except ValueError:
+    return {}
+
+def writeJson(path, data):
+  '''Helper function writing json through a temporary file so readers never see a partial file'''
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  tmp = '{}.{}.tmp'.format(path, os.getpid())
+  with open(tmp, 'w') as f:
+    json.dump(data, f, indent=1)
+  os.replace(tmp, path)
+
+def sourceHashes(sources):
+  '''Helper function returning the content hash of every source'''
+  return {s: datasetHash(s) for s in sources}
+
+def isCurrent(outData, sources, params=None):
+  """
+  Checks that a derived dataset exists and was made from the current version of its sources.
+
+  :param outData: Derived dataset location
+  :type outData: str
+  :param sources: Source dataset locations
+  :type sources: list
+  :param params: Parameters used to create outData
+  :type params: dict
+  :return: True if outData can be reused
+  :rtype: bool
+  """
+  if not arcpy.Exists(outData):
+    return False
+  manifest = readJson(manifestPath(outData))
+  if not manifest or manifest.get('params') != (params or {}) or manifest.get('code') != codeVersion():
+    return False
+  return manifest.get('sources') == sourceHashes(sources)
+
+def record(outData, sources, params=None):
+  """
+  Records the source hashes and parameters used to create a derived dataset.
+
+  :param outData: Derived dataset location
+  :type outData: str
+  :param sources: Source dataset locations
+  :type sources: list
+  :param params: Parameters used to create outData
+  :type params: dict
+  """
+  writeJson(manifestPath(outData), {'output': outData, 'sources': sourceHashes(sources), 'params': params or {}, 'code': codeVersion()})
+
+def isApplied(inData, step, sources, params=None):
+  """
+  Checks if an in place update (e.g. adding the habitat CLASS field) was already applied to the current version of a dataset with the current version of
+  its sources.
+
+  :param inData: Updated dataset location
+  :type inData: str
+  :param step: Name of the update, used as the manifest kind
+  :type step: str
+  :param sources: Source dataset locations used by the update (e.g. crosswalk table)
+  :type sources: list
+  :param params: Parameters used by the update
+  :type params: dict
+  :return: True if the update can be skipped
+  :rtype: bool
+  """
+  if not arcpy.Exists(inData):
+    return False
+  manifest = readJson(manifestPath(inData, step))
+  if not manifest or manifest.get('params') != (params or {}) or manifest.get('code') != codeVersion():
+    return False
+  return manifest.get('sources') == sourceHashes(sources) and manifest.get('hash') == datasetHash(inData)
+
+def applied(inData, step, sources, params=None):
+  """
+  Records an in place update along with the dataset hash after the update.
+
+  :param inData: Updated dataset location
+  :type inData: str
+  :param step: Name of the update, used as the manifest kind
+  :type step: str
+  :param sources: Source dataset locations used by the update
+  :type sources: list
+  :param params: Parameters used by the update
+  :type params: dict
+  """
+  writeJson(manifestPath(inData, step), {'source': inData, 'sources': sourceHashes(sources), 'params': params or {}, 'code': codeVersion(), 'hash': datasetHash(inData)})
+
+def clearManifests(workspace):
+  '''Helper function removing every manifest stored for a geodatabase or folder so all of its derived data is rebuilt'''
+  folder = os.path.dirname(manifestPath(os.path.join(workspace, 'x')))
+  if os.path.isdir(folder):
+    logging.info('Clearing manifests in ' + folder)
+    shutil.rmtree(folder)
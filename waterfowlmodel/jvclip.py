@@ -0,0 +1,242 @@
+"""
+Module Joint Venture Clip
+=========================
+Clips every feature class in a workspace to the Joint Ventures (or any other set of areas of interest).  Replaces the ClipLayerToJointVentures and
+"Clip AOCs to Joint Ventures" notebooks that ran Clip_analysis once per layer.
+
+The clip layer is dissolved and cut into grid cells once and the cells are shared with every worker.  A cell completely inside the clip polygon is an
+interior cell.  A feature whose bounding box only covers interior cells is copied as it is, a feature that touches no cell is dropped, and only the
+remaining features are intersected with the few cells they touch.  Layers are clipped at the same time by a pool of workers and an output that was
+made from the current version of its layer and the clip layer is skipped.
+
+Run from the command line::
+
+  python -m waterfowlmodel.jvclip -i Wetlands_WKID102003.gdb -c JointVenture.gdb/JVs -o Wetlands_clipped_to_JV.gdb
+"""
+import os, sys, argparse, logging, arcpy
+from multiprocessing import Pool
+import numpy as np
+import geopandas as gpd
+import shapely
+import waterfowlmodel.dataset as dataset
+import waterfowlmodel.fingerprint as fingerprint
+import waterfowlmodel.partition as partition
+
+# Grid cell size of the clip index in clip layer units (meters for the Albers layers)
+CELL_SIZE = 50000
+SUFFIX = '_clipped'
+
+state = {'index': None}
+
+class ClipIndex:
+  """
+  Dissolved clip polygon cut into grid cells.
+
+  :param polygon: Dissolved clip polygon
+  :type polygon: shapely.geometry.MultiPolygon
+  :param crs: Coordinate system of the polygon
+  :type crs: str
+  :param cellSize: Grid cell size in polygon units
+  :type cellSize: float
+  """
+  def __init__(self, polygon, crs, cellSize=CELL_SIZE):
+    self.polygon = polygon
+    self.crs = crs
+    self.cellSize = cellSize
+    xmin, ymin, xmax, ymax = polygon.bounds
+    self.origin = np.array([xmin, ymin])
+    self.shape = (max(1, int(np.ceil((ymax - ymin) / cellSize))), max(1, int(np.ceil((xmax - xmin) / cellSize))))
+    rows, cols = np.indices(self.shape)
+    boxes = shapely.box(xmin + cols.ravel() * cellSize, ymin + rows.ravel() * cellSize, xmin + (cols.ravel() + 1) * cellSize, ymin + (rows.ravel() + 1) * cellSize)
+    interior = shapely.contains_properly(polygon, boxes)
+    touched = shapely.intersects(polygon, boxes)
+    self.pieces = {int(i): boxes[i] if interior[i] else shapely.intersection(polygon, boxes[i]) for i in np.flatnonzero(touched)}
+    # Summed area tables so the interior and touched cells under any bounding box are counted in constant time
+    self.interiorSum = np.pad(interior.reshape(self.shape).cumsum(0).cumsum(1), ((1, 0), (1, 0)))
+    self.touchedSum = np.pad(touched.reshape(self.shape).cumsum(0).cumsum(1), ((1, 0), (1, 0)))
+    self.local = {}
+    self.projected = {}
+
+  def cellCount(self, table, r0, c0, r1, c1):
+    '''Helper function counting the cells of a summed area table in rows r0 to r1 and columns c0 to c1'''
+    return table[r1 + 1, c1 + 1] - table[r0, c1 + 1] - table[r1 + 1, c0] + table[r0, c0]
+
+  def localPolygon(self, r0, c0, r1, c1):
+    '''Helper function returning the part of the clip polygon in a block of cells'''
+    key = (r0, c0, r1, c1)
+    if key not in self.local:
+      cells = [r * self.shape[1] + c for r in range(r0, r1 + 1) for c in range(c0, c1 + 1)]
+      self.local[key] = shapely.union_all([self.pieces[c] for c in cells if c in self.pieces])
+      shapely.prepare(self.local[key])
+    return self.local[key]
+
+  def clipGeometry(self, geom, local):
+    '''Helper function clipping one geometry to the local clip polygon.  Geometries inside it are returned as they are'''
+    return geom if shapely.covered_by(geom, local) else shapely.intersection(geom, local)
+
+  def clip(self, gdf):
+    """
+    Clips features to the clip polygon.
+
+    :param gdf: Features in the coordinate system of the index
+    :type gdf: GeoDataFrame
+    :return: Clipped features.  Features completely inside keep their geometry
+    :rtype: GeoDataFrame
+    """
+    gdf = gdf[~(gdf.geometry.isna() | gdf.geometry.is_empty)]
+    bounds = gdf.geometry.bounds.values
+    lo = np.floor((bounds[:, :2] - self.origin) / self.cellSize).astype(np.int64)
+    hi = np.floor((bounds[:, 2:] - self.origin) / self.cellSize).astype(np.int64)
+    rows, cols = self.shape
+    inGrid = (lo[:, 0] >= 0) & (lo[:, 1] >= 0) & (hi[:, 0] < cols) & (hi[:, 1] < rows)
+    c0, r0 = np.clip(lo[:, 0], 0, cols - 1), np.clip(lo[:, 1], 0, rows - 1)
+    c1, r1 = np.clip(hi[:, 0], 0, cols - 1), np.clip(hi[:, 1], 0, rows - 1)
+    overlaps = (hi[:, 0] >= 0) & (hi[:, 1] >= 0) & (lo[:, 0] < cols) & (lo[:, 1] < rows)
+    keep = overlaps & (self.cellCount(self.touchedSum, r0, c0, r1, c1) > 0)
+    inside = keep & inGrid & (self.cellCount(self.interiorSum, r0, c0, r1, c1) == (r1 - r0 + 1) * (c1 - c0 + 1))
+    edge = np.flatnonzero(keep & ~inside)
+    out = gdf[keep].copy()
+    if len(edge):
+      geoms = np.asarray(gdf.geometry.values)
+      clipped = np.array([self.clipGeometry(geoms[i], self.localPolygon(r0[i], c0[i], r1[i], c1[i])) for i in edge], dtype=object)
+      clipped = gpd.GeoSeries(clipped, index=gdf.index[edge], crs=gdf.crs)
+      polygons = np.isin(shapely.get_type_id(geoms[edge]), [3, 6])
+      clipped[polygons] = partition.polygonParts(clipped[polygons])
+      out.loc[gdf.index[edge], out.geometry.name] = clipped
+      out = out[~(out.geometry.isna() | out.geometry.is_empty)]
+    logging.info('Clip kept {} of {} features, {} clipped'.format(len(out), len(gdf), len(edge)))
+    return out
+
+  def toCRS(self, crs):
+    '''Returns the index in another coordinate system.  Built once per coordinate system'''
+    if crs is None or gpd.GeoSeries([], crs=self.crs).crs == gpd.GeoSeries([], crs=crs).crs:
+      return self
+    key = str(crs)
+    if key not in self.projected:
+      polygon = gpd.GeoSeries([self.polygon], crs=self.crs).to_crs(crs).iloc[0]
+      self.projected[key] = ClipIndex(polygon, crs, self.cellSize)
+    return self.projected[key]
+
+def buildIndex(clipFeature, cellSize=CELL_SIZE):
+  """
+  Dissolves the clip layer and cuts it into grid cells.
+
+  :param clipFeature: Clip feature class (e.g. the Joint Ventures)
+  :type clipFeature: str
+  :param cellSize: Grid cell size in clip layer units
+  :type cellSize: float
+  :return: Clip index
+  :rtype: ClipIndex
+  """
+  clip = gpd.read_file(os.path.dirname(clipFeature), layer=os.path.basename(clipFeature), columns=[])
+  geoms = np.asarray(clip.geometry.values)
+  geoms = shapely.make_valid(geoms[~(shapely.is_missing(geoms) | shapely.is_empty(geoms))])
+  print('\tIndexing {} clip polygons from {}'.format(len(geoms), clipFeature))
+  return ClipIndex(shapely.union_all(geoms), clip.crs.to_wkt() if clip.crs else None, cellSize)
+
+def initWorker(index):
+  '''Pool initializer that keeps the clip index in the worker'''
+  state['index'] = index
+
+def clipLayer(args):
+  """
+  Clips one feature class with the clip index of the worker.  Run by the pool workers.
+
+  :param args: (input feature class, output feature class, chunk size)
+  :type args: tuple
+  :return: Output feature class and the number of features written
+  :rtype: tuple
+  """
+  inFeature, outFeature, chunkSize = args
+  index = state['index']
+  mask = gpd.GeoDataFrame(geometry=[shapely.box(*index.polygon.bounds)], crs=index.crs)
+  if arcpy.Exists(outFeature):
+    arcpy.Delete_management(outFeature)
+  written = 0
+  for chunk in dataset.iterFeatures(inFeature, chunkSize, mask):
+    out = index.toCRS(chunk.crs).clip(chunk)
+    if len(out):
+      dataset.gdfToFeatureClass(out, outFeature, inFeature)
+      written += len(out)
+  if not arcpy.Exists(outFeature):
+    desc = arcpy.Describe(inFeature)
+    arcpy.CreateFeatureclass_management(os.path.dirname(outFeature), os.path.basename(outFeature), desc.shapeType.upper(), inFeature, spatial_reference=desc.spatialReference)
+  logging.info('Clipped {} to {} with {} features'.format(inFeature, outFeature, written))
+  return outFeature, written
+
+def clipWorkspace(inWorkspace, clipFeature, outWorkspace, wildcard=None, cellSize=CELL_SIZE, workers=8, chunkSize=50000):
+  """
+  Clips every feature class in a workspace to a clip layer.  Outputs are named <feature class>_clipped.  Outputs made from the current version of their
+  feature class and the clip layer are skipped.
+
+  :param inWorkspace: Geodatabase with the feature classes to clip
+  :type inWorkspace: str
+  :param clipFeature: Clip feature class (e.g. the Joint Ventures)
+  :type clipFeature: str
+  :param outWorkspace: Geodatabase for the clipped feature classes
+  :type outWorkspace: str
+  :param wildcard: Only clip feature classes matching the wildcard
+  :type wildcard: str
+  :param cellSize: Grid cell size of the clip index in clip layer units
+  :type cellSize: float
+  :param workers: Number of feature classes clipped at the same time
+  :type workers: int
+  :param chunkSize: Number of features read at a time
+  :type chunkSize: int
+  :return: Output feature classes
+  :rtype: list
+  """
+  arcpy.env.workspace = inWorkspace
+  layers = sorted(arcpy.ListFeatureClasses(wildcard))
+  outputs = [os.path.join(outWorkspace, fc + SUFFIX) for fc in layers]
+  params = {'cellSize': cellSize}
+  jobs = []
+  for fc, outFeature in zip(layers, outputs):
+    inFeature = os.path.join(inWorkspace, fc)
+    if fingerprint.isCurrent(outFeature, [inFeature, clipFeature], params):
+      print(fc + ' already clipped.')
+    else:
+      jobs.append((inFeature, outFeature, chunkSize))
+  if not jobs:
+    return outputs
+  index = buildIndex(clipFeature, cellSize)
+  with Pool(processes=max(1, min(workers, len(jobs))), initializer=initWorker, initargs=(index,)) as pool:
+    for (inFeature, outFeature, chunkSize), (out, written) in zip(jobs, pool.imap(clipLayer, jobs)):
+      fingerprint.record(outFeature, [inFeature, clipFeature], params)
+      print('{} clipped to {} ({} features)'.format(os.path.basename(inFeature), os.path.basename(clipFeature), written))
+  return outputs
+
+def main(argv):
+  """
+  Runs clipWorkspace from the command line.
+
+  :param input: Geodatabase with the feature classes to clip
+  :type input: str
+  :param clip: Clip feature class
+  :type clip: str
+  :param output: Geodatabase for the clipped feature classes
+  :type output: str
+  :param wildcard: Only clip feature classes matching the wildcard
+  :type wildcard: str
+  :param cellSize: Grid cell size of the clip index in clip layer units.  Defaults to 50000
+  :type cellSize: str
+  :param workers: Number of feature classes clipped at the same time.  Defaults to 8
+  :type workers: str
+  """
+  parser = argparse.ArgumentParser(description='Clips every feature class in a geodatabase to the Joint Ventures')
+  parser.add_argument('--input', '-i', required=True, help='Geodatabase with the feature classes to clip')
+  parser.add_argument('--clip', '-c', required=True, help='Clip feature class')
+  parser.add_argument('--output', '-o', required=True, help='Geodatabase for the clipped feature classes')
+  parser.add_argument('--wildcard', '-w', default=None, help='Only clip feature classes matching the wildcard')
+  parser.add_argument('--cellSize', type=float, default=CELL_SIZE, help='Grid cell size of the clip index in clip layer units.  Defaults to 50000')
+  parser.add_argument('--workers', '-j', type=int, default=8, help='Number of feature classes clipped at the same time.  Defaults to 8')
+  args = parser.parse_args(argv)
+  logging.basicConfig(filename=os.path.splitext(args.output)[0] + '_jvclip.log', level=logging.INFO, format='%(asctime)s %(processName)s %(levelname)s %(message)s')
+  arcpy.env.overwriteOutput = True
+  clipWorkspace(args.input, args.clip, args.output, args.wildcard, args.cellSize, args.workers)
+  print('Done')
+
+if __name__ == "__main__":
+  print('\nClipping layers to Joint Ventures')
+  print('#####################################\n')
+  main(sys.argv[1:])
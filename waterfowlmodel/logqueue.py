@@ -0,0 +1,155 @@
+"""
+Module Log Queue
+================
+Multiprocess logging.  Every process (the parent, pool workers and the partition pools) sends its records through a queue to a single writer process so
+lines from different workers never interleave and worker records aren't lost.  The writer keeps the run log and one log file per area of interest.
+
+Records carry the area of interest, the stage and the seconds since the stage started.  The queue is bounded and records are dropped instead of blocking
+when it's full so logging inside a hot loop can never stall a worker.  The number of dropped records is logged when the process stops logging.
+"""
+import os, time, queue, logging, threading, multiprocessing
+import logging.handlers
+
+FORMAT = '%(asctime)s %(processName)s %(aoi)s %(stage)s %(elapsed).3f %(levelname)s %(message)s'
+# Records waiting for the writer before new records are dropped
+QUEUE_SIZE = 100000
+
+context = {'aoi': '', 'queue': None, 'level': logging.INFO, 'dropped': 0}
+local = threading.local()
+
+class ContextFilter(logging.Filter):
+  '''Adds the area of interest, stage and elapsed seconds of the calling thread to every record'''
+  def filter(self, record):
+    record.aoi = context['aoi'] or '-'
+    record.stage = getattr(local, 'stage', '') or '-'
+    record.elapsed = time.time() - getattr(local, 'start', record.created)
+    return True
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+  '''Queue handler that drops records instead of blocking when the writer falls behind'''
+  def enqueue(self, record):
+    try:
+      self.queue.put_nowait(record)
+    except queue.Full:
+      context['dropped'] += 1
+
+def writer(logQueue, logfile, folder, level):
+  """
+  Writes every record from the queue until it receives None.  Runs in its own process.
+
+  :param logQueue: Queue shared with every process
+  :type logQueue: multiprocessing.Queue
+  :param logfile: Run log file
+  :type logfile: str
+  :param folder: Folder for the per area of interest log files
+  :type folder: str
+  :param level: Logging level
+  :type level: int
+  """
+  os.makedirs(folder, exist_ok=True)
+  formatter = logging.Formatter(FORMAT)
+  runHandler = logging.FileHandler(logfile, mode='w')
+  runHandler.setFormatter(formatter)
+  aoiHandlers = {}
+  while True:
+    record = logQueue.get()
+    if record is None:
+      break
+    if record.levelno < level:
+      continue
+    runHandler.handle(record)
+    if getattr(record, 'aoi', '-') != '-':
+      if record.aoi not in aoiHandlers:
+        aoiHandlers[record.aoi] = logging.FileHandler(os.path.join(folder, record.aoi + '.log'), mode='a')
+        aoiHandlers[record.aoi].setFormatter(formatter)
+      aoiHandlers[record.aoi].handle(record)
+  for handler in [runHandler] + list(aoiHandlers.values()):
+    handler.close()
+
+def install(logQueue, level=logging.INFO):
+  """
+  Sends the records of this process to the writer.  Used as the initializer of every pool.
+
+  :param logQueue: Queue shared with every process
+  :type logQueue: multiprocessing.Queue
+  :param level: Logging level
+  :type level: int
+  """
+  root = logging.getLogger()
+  for handler in list(root.handlers):
+    root.removeHandler(handler)
+  handler = DroppingQueueHandler(logQueue)
+  handler.addFilter(ContextFilter())
+  root.addHandler(handler)
+  root.setLevel(level)
+  context.update(queue=logQueue, level=level, dropped=0)
+
+def start(logfile, folder, level=logging.INFO):
+  """
+  Starts the writer process and sends the records of this process to it.
+
+  :param logfile: Run log file
+  :type logfile: str
+  :param folder: Folder for the per area of interest log files
+  :type folder: str
+  :param level: Logging level
+  :type level: int
+  :return: Writer process
+  :rtype: multiprocessing.Process
+  """
+  logQueue = multiprocessing.Queue(QUEUE_SIZE)
+  process = multiprocessing.Process(target=writer, args=(logQueue, logfile, folder, level), name='logwriter', daemon=True)
+  process.start()
+  install(logQueue, level)
+  return process
+
+def stop(process):
+  '''Flushes the records of the parent and waits for the writer to finish'''
+  reportDropped()
+  context['queue'].put(None)
+  process.join()
+  logging.getLogger().handlers.clear()
+
+def poolArgs():
+  """
+  Returns the initializer arguments that send the records of pool workers to the writer.
+
+  :return: Keyword arguments for multiprocessing.Pool, empty when the writer isn't running
+  :rtype: dict
+  """
+  if context['queue'] is None:
+    return {}
+  return {'initializer': install, 'initargs': (context['queue'], context['level'])}
+
+def setAOI(aoi):
+  '''Sets the area of interest recorded with the records of this process'''
+  reportDropped()
+  context['aoi'] = aoi
+  local.start = time.time()
+
+class stage:
+  """
+  Context manager that records the stage and its start time with the records of the calling thread.
+
+  :param name: Stage name
+  :type name: str
+  """
+  def __init__(self, name):
+    self.name = name
+
+  def __enter__(self):
+    self.previous = (getattr(local, 'stage', ''), getattr(local, 'start', None))
+    local.stage, local.start = self.name, time.time()
+    return self
+
+  def __exit__(self, exc_type, exc, tb):
+    local.stage, local.start = self.previous
+    if local.start is None:
+      del local.start
+    return False
+
+def reportDropped():
+  '''Helper function logging the number of records dropped because the queue was full'''
+  if context['dropped']:
+    dropped, context['dropped'] = context['dropped'], 0
+    logging.warning('Dropped {} log records while the log writer was busy'.format(dropped))
@@ -0,0 +1,207 @@
+"""
+Module NWI Overlap Removal
+==========================
+Removes the overlaps left where the Joint Venture NWI wetland layers meet by dissolving every wetland on ATTRIBUTE and WETLAND_TYPE.  Replaces the
+"remove overlaps in NWI" notebook (Dissolve per layer, RepairGeometry, Append and a national PairwiseDissolve).
+
+The extent of the layers is split into square tiles that are dissolved by a pool of workers.  Each tile reads the features whose bounding box
+intersects it, repairs them, dissolves them by the key fields and keeps only what falls inside the tile.  Parts that don't reach the tile edge are final.
+Parts that do are dissolved again with the parts of the neighbouring tiles once every tile is done, one key at a time by the same pool.  Tiles, keys and
+parts are always handled in the same order so the same inputs give the same output.
+
+The packed R-tree of every layer is built once by the parent and opened once by every worker.
+
+Output features are single part.  Run from the command line::
+
+  python -m waterfowlmodel.nwioverlap -w Wetlands_clipped_to_JV.gdb -l "*_Wetlands_clipped" -o Wetlands_Clipped.gdb/Wetlands_merged_dissolved
+"""
+import os, sys, argparse, logging, arcpy
+from multiprocessing import Pool
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import waterfowlmodel.dataset as dataset
+import waterfowlmodel.fingerprint as fingerprint
+import waterfowlmodel.partition as partition
+import waterfowlmodel.spatialindex as spatialindex
+
+KEY_FIELDS = ['ATTRIBUTE', 'WETLAND_TYPE']
+# Tile size in layer units (meters for the Albers layers)
+TILE_SIZE = 100000
+
+# Packed R-trees of the layers by layer location, opened once in every worker
+indexes = {}
+
+def layerExtent(layers):
+  '''Helper function returning the combined extent (xmin, ymin, xmax, ymax) of feature classes'''
+  extents = [arcpy.Describe(fc).extent for fc in layers]
+  return (min(e.XMin for e in extents), min(e.YMin for e in extents), max(e.XMax for e in extents), max(e.YMax for e in extents))
+
+def makeTiles(extent, size=TILE_SIZE):
+  """
+  Splits an extent into square tiles.
+
+  :param extent: Extent (xmin, ymin, xmax, ymax)
+  :type extent: tuple
+  :param size: Tile width and height
+  :type size: float
+  :return: Tile boxes (xmin, ymin, xmax, ymax) row by row from the lower left
+  :rtype: list
+  """
+  xs = np.append(np.arange(extent[0], extent[2], size), extent[2])
+  ys = np.append(np.arange(extent[1], extent[3], size), extent[3])
+  return [(float(xs[i]), float(ys[j]), float(xs[i + 1]), float(ys[j + 1])) for j in range(len(ys) - 1) for i in range(len(xs) - 1)]
+
+def dissolveParts(gdf, fields):
+  '''Helper function dissolving features by the key fields and splitting the result into single part polygons sorted by key and position'''
+  if not len(gdf):
+    return gpd.GeoDataFrame(columns=fields + ['geometry'], geometry='geometry', crs=gdf.crs)
+  keys, geoms = [], []
+  for key, group in gdf.groupby(fields, sort=True, dropna=False):
+    keys.append(key)
+    geoms.append(shapely.union_all(np.asarray(group.geometry.values)))
+  out = gpd.GeoDataFrame(pd.DataFrame(keys, columns=fields), geometry=geoms, crs=gdf.crs)
+  out = out[~(out.geometry.isna() | out.geometry.is_empty)].explode(index_parts=False)
+  out = out[out.geom_type == 'Polygon']
+  point = shapely.get_coordinates(shapely.point_on_surface(np.asarray(out.geometry.values)))
+  out = out.assign(_x=point[:, 0], _y=point[:, 1]).sort_values(fields + ['_x', '_y'], kind='stable')
+  return out.drop(columns=['_x', '_y']).reset_index(drop=True)
+
+def openIndexes(paths):
+  '''Pool initializer opening the packed R-tree of every layer once per worker'''
+  indexes.clear()
+  indexes.update({fc: spatialindex.PackedRTree(path) for fc, path in paths.items()})
+
+def makeValid(geoms):
+  '''Helper function repairing polygons like RepairGeometry.  Points and lines left over from the repair are dropped'''
+  return partition.polygonParts(gpd.GeoSeries(shapely.make_valid(np.asarray(geoms.values)), index=geoms.index, crs=geoms.crs))
+
+def dissolveTile(args):
+  """
+  Dissolves the wetlands of one tile.  Run by the pool workers.
+
+  :param args: (tile box, layers, key fields, layer coordinate system)
+  :type args: tuple
+  :return: Final parts and the parts that reach the tile edge
+  :rtype: tuple
+  """
+  tile, layers, fields, crs = args
+  mask = gpd.GeoDataFrame(geometry=[shapely.box(*tile)], crs=crs)
+  chunks = []
+  for fc in layers:
+    for chunk in dataset.iterFeatures(fc, 50000, mask, indexes.get(fc)):
+      chunks.append(chunk[fields + ['geometry']])
+  if not chunks:
+    return None, None
+  gdf = pd.concat(chunks, ignore_index=True)
+  gdf = gdf[~(gdf.geometry.isna() | gdf.geometry.is_empty)]
+  invalid = ~gdf.geometry.is_valid
+  if invalid.any():
+    gdf.loc[invalid, 'geometry'] = makeValid(gdf.geometry[invalid])
+  gdf = gdf[~(gdf.geometry.isna() | gdf.geometry.is_empty)]
+  parts = dissolveParts(partition.clipToPolygon(dissolveParts(gdf, fields), shapely.box(*tile)), fields)
+  bounds = parts.geometry.bounds.values
+  edge = (bounds[:, 0] <= tile[0]) | (bounds[:, 1] <= tile[1]) | (bounds[:, 2] >= tile[2]) | (bounds[:, 3] >= tile[3])
+  return parts[~edge], parts[edge]
+
+def stitchKey(args):
+  '''Helper function dissolving the edge parts of one key from every tile.  Run by the pool workers'''
+  parts, fields = args
+  return dissolveParts(parts, fields)
+
+def removeOverlaps(layers, outFeature, fields=KEY_FIELDS, tileSize=TILE_SIZE, workers=8):
+  """
+  Dissolves wetland layers into one feature class without overlaps.  Skipped when the output was made from the current version of the layers with the
+  same settings.
+
+  :param layers: Wetland feature classes in one coordinate system
+  :type layers: list
+  :param outFeature: Output feature class
+  :type outFeature: str
+  :param fields: Fields to dissolve on.  Defaults to ATTRIBUTE and WETLAND_TYPE
+  :type fields: list
+  :param tileSize: Tile width and height in layer units
+  :type tileSize: float
+  :param workers: Number of tiles dissolved at the same time
+  :type workers: int
+  :return: outFeature
+  :rtype: str
+  """
+  params = {'fields': list(fields), 'tileSize': tileSize}
+  if fingerprint.isCurrent(outFeature, layers, params):
+    print('\t{} is current'.format(outFeature))
+    return outFeature
+  if arcpy.Exists(outFeature):
+    arcpy.Delete_management(outFeature)
+  paths = {fc: spatialindex.buildIndex(fc).path for fc in layers}
+  spatialReference = arcpy.Describe(layers[0]).spatialReference
+  crs = spatialReference.exportToString()
+  tiles = makeTiles(layerExtent(layers), tileSize)
+  print('\tDissolving {} layers in {} tiles'.format(len(layers), len(tiles)))
+  logging.info('Dissolving {} in {} tiles of {}'.format(', '.join(layers), len(tiles), tileSize))
+  seams, written = [], 0
+  with Pool(processes=max(1, min(workers, len(tiles))), initializer=openIndexes, initargs=(paths,)) as pool:
+    # imap keeps the tile order so the output is the same on every run
+    for i, (final, edge) in enumerate(pool.imap(dissolveTile, [(t, list(layers), list(fields), crs) for t in tiles])):
+      if final is None:
+        continue
+      if len(final):
+        dataset.gdfToFeatureClass(final, outFeature, spatialReference=spatialReference)
+        written += len(final)
+      if len(edge):
+        seams.append(edge)
+      logging.info('Tile {} of {}: {} final parts, {} edge parts'.format(i + 1, len(tiles), len(final), len(edge)))
+    if seams:
+      seams = pd.concat(seams, ignore_index=True)
+      keys = [(group, list(fields)) for key, group in seams.groupby(list(fields), sort=True, dropna=False)]
+      print('\tStitching {} edge parts of {} keys'.format(len(seams), len(keys)))
+      for stitched in pool.imap(stitchKey, keys):
+        dataset.gdfToFeatureClass(stitched, outFeature, spatialReference=spatialReference)
+        written += len(stitched)
+  if not arcpy.Exists(outFeature):
+    arcpy.CreateFeatureclass_management(os.path.dirname(outFeature), os.path.basename(outFeature), 'POLYGON', spatial_reference=spatialReference)
+    for field in fields:
+      arcpy.AddField_management(outFeature, field, "TEXT", field_length=255)
+  fingerprint.record(outFeature, layers, params)
+  print('\tWrote {} wetland features to {}'.format(written, outFeature))
+  logging.info('Wrote {} features to {}'.format(written, outFeature))
+  return outFeature
+
+def main(argv):
+  """
+  Runs removeOverlaps from the command line.
+
+  :param workspace: Geodatabase with the wetland layers
+  :type workspace: str
+  :param layers: Wildcard matching the wetland layers.  Defaults to *_Wetlands_clipped
+  :type layers: str
+  :param output: Output feature class
+  :type output: str
+  :param fields: Fields to dissolve on.  Defaults to ATTRIBUTE WETLAND_TYPE
+  :type fields: str
+  :param tileSize: Tile width and height in layer units.  Defaults to 100000
+  :type tileSize: str
+  :param workers: Number of tiles dissolved at the same time.  Defaults to 8
+  :type workers: str
+  """
+  parser = argparse.ArgumentParser(description='Dissolves NWI wetland layers into one layer without overlaps')
+  parser.add_argument('--workspace', '-w', required=True, help='Geodatabase with the wetland layers')
+  parser.add_argument('--layers', '-l', default='*_Wetlands_clipped', help='Wildcard matching the wetland layers.  Defaults to *_Wetlands_clipped')
+  parser.add_argument('--output', '-o', required=True, help='Output feature class')
+  parser.add_argument('--fields', '-f', nargs='+', default=KEY_FIELDS, help='Fields to dissolve on.  Defaults to ATTRIBUTE WETLAND_TYPE')
+  parser.add_argument('--tileSize', '-t', type=float, default=TILE_SIZE, help='Tile width and height in layer units.  Defaults to 100000')
+  parser.add_argument('--workers', '-j', type=int, default=8, help='Number of tiles dissolved at the same time.  Defaults to 8')
+  args = parser.parse_args(argv)
+  logging.basicConfig(filename=os.path.splitext(os.path.dirname(args.output))[0] + '_nwioverlap.log', level=logging.INFO, format='%(asctime)s %(processName)s %(levelname)s %(message)s')
+  arcpy.env.workspace = args.workspace
+  arcpy.env.overwriteOutput = True
+  layers = [os.path.join(args.workspace, fc) for fc in sorted(arcpy.ListFeatureClasses(args.layers))]
+  print(layers)
+  removeOverlaps(layers, args.output, args.fields, args.tileSize, args.workers)
+  print('Done')
+
+if __name__ == "__main__":
+  print('\nRemoving NWI overlaps')
+  print('#####################################\n')
+  main(sys.argv[1:])
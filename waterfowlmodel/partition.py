@@ -0,0 +1,144 @@
+"""
+Module Partition
+================
+Splits national input layers into per area of interest partitions.  Each national layer is read once and every feature is routed to all of the
+areas of interest it intersects instead of clipping the national layer once per area of interest.
+"""
+import os, logging, arcpy
+from multiprocessing import Pool
+import numpy as np
+import geopandas as gpd
+import waterfowlmodel.dataset as dataset
+import waterfowlmodel.fingerprint as fingerprint
+import waterfowlmodel.logqueue as logqueue
+
+DEMAND_RATIO_FIELDS = ['LTADUD', 'X80DUD', 'LTAPopObj', 'X80PopObj', 'LTADemand', 'X80Demand']
+
+def polygonParts(geoms):
+  '''Helper function that drops the point and line slivers an overlay can leave behind on polygon features'''
+  def keep(geom):
+    if geom is None or geom.is_empty or geom.geom_type in ('Polygon', 'MultiPolygon'):
+      return geom
+    if geom.geom_type == 'GeometryCollection':
+      parts = [g for g in geom.geoms if g.geom_type in ('Polygon', 'MultiPolygon')]
+      if parts:
+        return gpd.GeoSeries(parts).union_all()
+    return None
+  return geoms.apply(keep)
+
+def clipToPolygon(gdf, polygon, ratioFields=None):
+  """
+  Clips features to a polygon.  Features completely inside the polygon are kept as they are and only features crossing the polygon boundary are overlaid.
+
+  :param gdf: Features to clip
+  :type gdf: GeoDataFrame
+  :param polygon: Clipping polygon in the same coordinate system as gdf
+  :type polygon: shapely.geometry.Polygon
+  :param ratioFields: Fields that are scaled by the proportion of area kept after clipping (e.g. duck use days)
+  :type ratioFields: list
+  :return: Clipped features
+  :rtype: GeoDataFrame
+  """
+  inside = gdf.geometry.covered_by(polygon)
+  if inside.all():
+    return gdf
+  out = gdf.copy()
+  edge = ~inside.values
+  original = out.geometry[edge]
+  clipped = original.intersection(polygon)
+  if (original.geom_type.isin(['Polygon', 'MultiPolygon'])).all():
+    clipped = polygonParts(clipped)
+  if ratioFields:
+    ratio = (clipped.area / original.area).fillna(0)
+    for field in ratioFields:
+      if field in out.columns:
+        out.loc[edge, field] = out.loc[edge, field] * ratio
+  out.loc[edge, 'geometry'] = clipped
+  out = out[~(out.geometry.isna() | out.geometry.is_empty)]
+  return out
+
+def writePartition(gdf, outfc, template, sources=None):
+  '''Pool helper that appends a chunk of routed features to an area of interest partition.  With sources the finished partition is fingerprinted'''
+  if gdf is not None and len(gdf):
+    dataset.gdfToFeatureClass(gdf, outfc, template)
+  if sources:
+    if not arcpy.Exists(outfc):
+      arcpy.CreateFeatureclass_management(os.path.dirname(outfc), os.path.basename(outfc), arcpy.Describe(template).shapeType.upper(), template, spatial_reference=arcpy.Describe(template).spatialReference)
+    fingerprint.record(outfc, sources)
+  return outfc
+
+class Partitioner:
+  """
+  Routes features from national layers to every area of interest they intersect.
+
+  :param aoi: Feature class with all areas of interest
+  :type aoi: str
+  :param aoifield: Field that uniquely identifies each area of interest
+  :type aoifield: str
+  :param workers: Number of processes writing partitions
+  :type workers: int
+  :param chunkSize: Number of national features read at a time
+  :type chunkSize: int
+  """
+  def __init__(self, aoi, aoifield, workers=8, chunkSize=50000):
+    self.aoifield = aoifield
+    self.workers = workers
+    self.chunkSize = chunkSize
+    aois = gpd.read_file(os.path.dirname(aoi), layer=os.path.basename(aoi), driver='FileGDB')
+    self.aois = aois[[aoifield, 'geometry']].dissolve(by=aoifield).reset_index()
+
+  def partition(self, inFeature, cat, outputs, ratioFields=None, aoiFeatures=None):
+    """
+    Streams a national layer once and writes one partition per area of interest.  Partitions are named the same as the clipStuff output so
+    Waterfowlmodel.clipProject and PublicLand.clipProject use them instead of clipping.  Each partition is fingerprinted with the national layer and the
+    area of interest feature class it was made for, and those readers only use a partition that is current with both.  Skipped when every partition is
+    current.
+
+    :param inFeature: National feature class
+    :type inFeature: str
+    :param cat: Category name used for unique storage
+    :type cat: str
+    :param outputs: Scratch geodatabase for each area of interest {aoi value: scratch gdb}
+    :type outputs: dict
+    :param ratioFields: Fields scaled by the proportion of area kept for features crossing an area of interest boundary
+    :type ratioFields: list
+    :param aoiFeatures: Area of interest feature class the partitions are fingerprinted with {aoi value: feature class}.  Defaults to stateAOI in each
+      scratch geodatabase
+    :type aoiFeatures: dict
+    :return: Partition location for each area of interest
+    :rtype: dict
+    """
+    outfcs = {k: os.path.join(v, cat + 'clip') for k, v in outputs.items()}
+    aoiFeatures = aoiFeatures or {k: os.path.join(v, 'stateAOI') for k, v in outputs.items()}
+    sources = {k: [inFeature, aoiFeatures[k]] for k in outputs}
+    if all(fingerprint.isCurrent(outfcs[k], sources[k]) for k in outputs):
+      print('\t{} partitions are current'.format(cat))
+      return outfcs
+    print('\tPartitioning {} layer: {}'.format(cat, inFeature))
+    logging.info('Partitioning ' + inFeature)
+    for outfc in outfcs.values():
+      if os.path.isfile(fingerprint.manifestPath(outfc)):
+        os.remove(fingerprint.manifestPath(outfc))
+      if arcpy.Exists(outfc):
+        arcpy.Delete_management(outfc)
+    aois = None
+    routed = 0
+    with Pool(processes=self.workers, **logqueue.poolArgs()) as pool:
+      for chunk in dataset.iterFeatures(inFeature, self.chunkSize):
+        if aois is None:
+          aois = self.aois.to_crs(chunk.crs) if chunk.crs else self.aois
+          aois = aois[aois[self.aoifield].isin(list(outputs.keys()))].reset_index(drop=True)
+        featIdx, aoiIdx = aois.sindex.query(chunk.geometry, predicate='intersects')
+        jobs = []
+        for a in np.unique(aoiIdx):
+          parts = chunk.iloc[featIdx[aoiIdx == a]]
+          parts = clipToPolygon(parts, aois.geometry.iloc[a], ratioFields)
+          if len(parts):
+            jobs.append((parts, outfcs[aois[self.aoifield].iloc[a]], inFeature))
+        routed += len(featIdx)
+        pool.starmap(writePartition, jobs)
+      # Partitions are only fingerprinted once every chunk is written, so an interrupted partition is never reused.  Areas of interest without any
+      # features still get an empty partition.
+      pool.starmap(writePartition, [(None, outfcs[k], inFeature, sources[k]) for k in outputs])
+    logging.info('Routed {} features from {}'.format(routed, inFeature))
+    return outfcs
@@ -0,0 +1,185 @@
+"""
+Module Profiling
+================
+Records wall time, CPU time, peak memory, feature counts and bytes written for every model stage and every Waterfowlmodel method.  Each process appends
+its records to its own file so workers never share a file, and the parent exports all of them as a Chrome trace (chrome://tracing or ui.perfetto.dev)
+and a CSV summary at the end of the run.
+
+Profiling is off unless enable is called so the wrappers only cost one check per call.
+
+CPU time and bytes written are measured for the whole process and scratch geodatabase, so records of calls that ran while another thread of the same
+process was in a profiled call are flagged as overlapped.  Peak memory is the high water mark of the process up to the end of the call.
+"""
+import os, sys, csv, glob, json, time, threading, functools, arcpy
+try:
+  import psutil
+except ImportError:
+  psutil = None
+try:
+  import resource
+except ImportError:
+  resource = None
+
+state = {'folder': None, 'aoi': '', 'workspace': None}
+lock = threading.Lock()
+# Profiled calls currently running in this process
+running = []
+
+def enable(folder, aoi='', workspace=None):
+  """
+  Turns profiling on for this process.
+
+  :param folder: Folder that stores the profile records
+  :type folder: str
+  :param aoi: Area of interest the following records belong to
+  :type aoi: str
+  :param workspace: Scratch geodatabase measured for bytes written
+  :type workspace: str
+  """
+  os.makedirs(folder, exist_ok=True)
+  state.update(folder=folder, aoi=aoi, workspace=workspace)
+
+def enabled():
+  '''Helper function returning True when profiling is on'''
+  return state['folder'] is not None
+
+def peakMemory():
+  '''Helper function returning the peak resident memory of this process in bytes'''
+  if resource is not None:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+  if psutil is not None and os.name == 'nt':
+    return psutil.Process().memory_info().peak_wset
+  return 0
+
+def folderSize(folder):
+  '''Helper function returning the size of the files in a folder (e.g. a file geodatabase)'''
+  if not folder or not os.path.isdir(folder):
+    return 0
+  return sum(entry.stat().st_size for entry in os.scandir(folder) if entry.is_file())
+
+def featureCount(values):
+  '''Helper function returning the number of rows in every table or feature class in values'''
+  count = 0
+  for value in values:
+    if isinstance(value, str) and value and arcpy.Exists(value):
+      try:
+        count += int(arcpy.GetCount_management(value)[0])
+      except Exception:
+        pass
+  return count
+
+def record(event):
+  '''Helper function appending one record to the profile file of this process'''
+  with lock:
+    with open(os.path.join(state['folder'], 'profile_{}.jsonl'.format(os.getpid())), 'a') as f:
+      f.write(json.dumps(event) + '\n')
+
+class span:
+  """
+  Context manager that records one profiled call.
+
+  :param name: Stage or method name
+  :type name: str
+  :param category: Record category (stage or method)
+  :type category: str
+  :param inputs: Datasets read by the call, used for the feature count in
+  :type inputs: list
+  """
+  def __init__(self, name, category, inputs=()):
+    self.name = name
+    self.category = category
+    self.inputs = inputs
+    self.outputs = ()
+    self.overlapped = False
+
+  def __enter__(self):
+    if enabled():
+      self.tid = threading.get_ident()
+      with lock:
+        # Calls on other threads share the CPU time and bytes written of this one
+        for other in running:
+          if other.tid != self.tid:
+            other.overlapped = self.overlapped = True
+        running.append(self)
+      self.featuresIn = featureCount(self.inputs)
+      self.size = folderSize(state['workspace'])
+      self.cpu = time.process_time()
+      self.start = time.time()
+    return self
+
+  def __exit__(self, exc_type, exc, tb):
+    if enabled():
+      with lock:
+        running.remove(self)
+      record({'name': self.name, 'cat': self.category, 'aoi': state['aoi'], 'pid': os.getpid(), 'tid': self.tid, 'overlapped': self.overlapped,
+              'start': self.start, 'wall': time.time() - self.start, 'cpu': time.process_time() - self.cpu, 'peakRSS': peakMemory(),
+              'featuresIn': self.featuresIn, 'featuresOut': featureCount(self.outputs),
+              'bytesWritten': max(folderSize(state['workspace']) - self.size, 0), 'error': exc_type.__name__ if exc_type else ''})
+    return False
+
+def profiled(func):
+  '''Decorator recording a method call with its dataset arguments as inputs and its returned datasets as outputs'''
+  @functools.wraps(func)
+  def wrapper(*args, **kwargs):
+    if not enabled():
+      return func(*args, **kwargs)
+    with span(func.__qualname__, 'method', list(args[1:]) + list(kwargs.values())) as s:
+      result = func(*args, **kwargs)
+      s.outputs = result if isinstance(result, (list, tuple)) else [result]
+      return result
+  return wrapper
+
+def profileMethods(cls):
+  '''Class decorator applying profiled to every method of a class'''
+  for name, value in list(vars(cls).items()):
+    if callable(value) and not name.startswith('__'):
+      setattr(cls, name, profiled(value))
+  return cls
+
+def readRecords(folder):
+  '''Helper function returning every record written by every process'''
+  events = []
+  for path in sorted(glob.glob(os.path.join(folder, 'profile_*.jsonl'))):
+    with open(path) as f:
+      events.extend(json.loads(line) for line in f if line.strip())
+  return events
+
+def export(folder):
+  """
+  Writes the records of every process as a Chrome trace and a CSV summary by area of interest and name.
+
+  :param folder: Folder that stores the profile records
+  :type folder: str
+  :return: Trace and summary locations
+  :rtype: tuple
+  """
+  events = readRecords(folder)
+  start = min([e['start'] for e in events] or [0])
+  trace = [{'name': e['name'], 'cat': e['cat'], 'ph': 'X', 'ts': int((e['start'] - start) * 1e6), 'dur': int(e['wall'] * 1e6), 'pid': e['pid'], 'tid': e['tid'],
+            'args': {k: e.get(k) for k in ['aoi', 'cpu', 'peakRSS', 'featuresIn', 'featuresOut', 'bytesWritten', 'overlapped', 'error']}} for e in events]
+  trace += [{'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': 'worker {}'.format(pid)}} for pid in sorted(set(e['pid'] for e in events))]
+  tracePath = os.path.join(folder, 'trace.json')
+  with open(tracePath, 'w') as f:
+    json.dump({'traceEvents': trace, 'displayTimeUnit': 'ms'}, f)
+  summary = {}
+  for e in events:
+    row = summary.setdefault((e['aoi'], e['cat'], e['name']), {'calls': 0, 'overlapped': 0, 'wall': 0, 'cpu': 0, 'peakRSS': 0, 'featuresIn': 0, 'featuresOut': 0, 'bytesWritten': 0})
+    row['calls'] += 1
+    row['overlapped'] += int(e.get('overlapped', False))
+    for k in ['wall', 'cpu', 'featuresIn', 'featuresOut', 'bytesWritten']:
+      row[k] += e[k]
+    row['peakRSS'] = max(row['peakRSS'], e['peakRSS'])
+  summaryPath = os.path.join(folder, 'summary.csv')
+  with open(summaryPath, 'w', newline='') as f:
+    writer = csv.writer(f)
+    writer.writerow(['aoi', 'category', 'name', 'calls', 'overlapped_calls', 'wall_s', 'cpu_s', 'peak_rss_mb', 'features_in', 'features_out', 'bytes_written'])
+    for (aoi, cat, name), row in sorted(summary.items(), key=lambda r: -r[1]['wall']):
+      writer.writerow([aoi, cat, name, row['calls'], row['overlapped'], round(row['wall'], 3), round(row['cpu'], 3), row['peakRSS'] >> 20, row['featuresIn'], row['featuresOut'], row['bytesWritten']])
+  return tracePath, summaryPath
+
+def reset(folder):
+  '''Removes the records of a previous run'''
+  for path in glob.glob(os.path.join(folder, 'profile_*.jsonl')):
+    os.remove(path)
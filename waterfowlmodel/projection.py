@@ -0,0 +1,171 @@
+"""
+Module Projection
+=================
+Projects spatial data to USA Contiguous Albers Equal Area Conic (ESRI: 102003).  Coordinate systems are compared by definition instead of by name, and
+national inputs are projected once per source version into a cache shared by every area of interest.
+"""
+import os, re, logging, arcpy
+from functools import lru_cache
+import numpy as np
+import geopandas as gpd
+import shapely
+from pyproj import CRS, Transformer
+import waterfowlmodel.dataset as dataset
+import waterfowlmodel.fingerprint as fingerprint
+import waterfowlmodel.partition as partition
+import waterfowlmodel.spatialindex as spatialindex
+import waterfowlmodel.columnstore as columnstore
+
+ALBERS_WKID = 102003
+
+def sameCRS(spatialReference, wkid=ALBERS_WKID):
+  """
+  Checks if a spatial reference is equivalent to a well known coordinate system.
+
+  :param spatialReference: Spatial reference to check
+  :type spatialReference: arcpy.SpatialReference
+  :param wkid: Well known ID of the coordinate system to compare with.  Defaults to 102003
+  :type wkid: int
+  :return: True if equivalent
+  :rtype: bool
+  """
+  if spatialReference.factoryCode == wkid:
+    return True
+  if spatialReference.type == 'Unknown':
+    return False
+  try:
+    crs = CRS.from_wkt(spatialReference.exportToString().split(';')[0])
+    return crs.equals(CRS.from_user_input('ESRI:{}'.format(wkid)), ignore_axis_order=True)
+  except Exception:
+    return spatialReference.name == arcpy.SpatialReference(wkid).name
+
+@lru_cache(maxsize=None)
+def getTransformer(srcWkt, wkid=ALBERS_WKID):
+  '''Helper function returning a cached transformer so pyproj only builds each transformation once per process'''
+  return Transformer.from_crs(CRS.from_wkt(srcWkt), CRS.from_user_input('ESRI:{}'.format(wkid)), always_xy=True)
+
+def toAlbers(gdf, wkid=ALBERS_WKID):
+  """
+  Projects a geodataframe.  All coordinates of all geometries are transformed in one call to the cached transformer.
+
+  :param gdf: Features to project
+  :type gdf: GeoDataFrame
+  :param wkid: Well known ID of the output coordinate system.  Defaults to 102003
+  :type wkid: int
+  :return: Projected features
+  :rtype: GeoDataFrame
+  """
+  transformer = getTransformer(gdf.crs.to_wkt(), wkid)
+  def transform(coords):
+    x, y = transformer.transform(coords[:, 0], coords[:, 1])
+    return np.column_stack([x, y])
+  out = gdf.copy()
+  out['geometry'] = gpd.GeoSeries(shapely.transform(np.asarray(gdf.geometry.values), transform), index=gdf.index)
+  return out.set_crs(CRS.from_user_input('ESRI:{}'.format(wkid)), allow_override=True)
+
+def projectFeature(inFeature, outfc, wkid=ALBERS_WKID):
+  """
+  Projects a feature class with Project_management, so true curves are kept and arcpy picks the datum transformation.  Written under a temporary name and
+  renamed at the end so an interrupted run never leaves a partial output behind.
+
+  :param inFeature: Feature class to project
+  :type inFeature: str
+  :param outfc: Projected feature class location
+  :type outfc: str
+  :param wkid: Well known ID of the output coordinate system.  Defaults to 102003
+  :type wkid: int
+  :return: Projected feature class location
+  :rtype: str
+  """
+  tmp = outfc + 'tmp'
+  for fc in [tmp, outfc]:
+    if arcpy.Exists(fc):
+      arcpy.Delete_management(fc)
+  arcpy.Project_management(inFeature, tmp, arcpy.SpatialReference(wkid))
+  arcpy.Rename_management(tmp, outfc)
+  return outfc
+
+def clipProject(inFeature, aoi, outfc, ratioFields=None, wkid=ALBERS_WKID, chunkSize=50000):
+  """
+  Clips and projects in a single pass.  Only features within the area of interest extent are read, they're clipped in the coordinate system of the data,
+  projected, and written once.  The area of interest can be in a different coordinate system than the data.
+
+  :param inFeature: Feature class to clip and project
+  :type inFeature: str
+  :param aoi: Area of interest feature class
+  :type aoi: str
+  :param outfc: Clipped and projected feature class location
+  :type outfc: str
+  :param ratioFields: Fields scaled by the proportion of area kept for features crossing the area of interest boundary
+  :type ratioFields: list
+  :param wkid: Well known ID of the output coordinate system.  Defaults to 102003
+  :type wkid: int
+  :param chunkSize: Number of features processed at a time
+  :type chunkSize: int
+  :return: Clipped and projected feature class location
+  :rtype: str
+  """
+  aoigdf = gpd.read_file(os.path.dirname(aoi), layer=os.path.basename(aoi), driver='FileGDB')
+  tmp = outfc + 'tmp'
+  for fc in [tmp, outfc]:
+    if arcpy.Exists(fc):
+      arcpy.Delete_management(fc)
+  spr = arcpy.SpatialReference(wkid)
+  arcpy.CreateFeatureclass_management(os.path.dirname(tmp), os.path.basename(tmp), arcpy.Describe(inFeature).shapeType.upper(), inFeature, spatial_reference=spr)
+  polygon = None
+  # National layers in the shared column store are read from its memory mapped columns instead of the geodatabase
+  chunks = columnstore.features(inFeature, chunkSize, aoigdf)
+  if chunks is None:
+    chunks = dataset.iterFeatures(inFeature, chunkSize, mask=aoigdf, index=spatialindex.openIndex(inFeature))
+  for chunk in chunks:
+    if polygon is None:
+      polygon = aoigdf.to_crs(chunk.crs).union_all()
+    chunk = partition.clipToPolygon(chunk[chunk.intersects(polygon)], polygon, ratioFields)
+    if len(chunk):
+      dataset.gdfToFeatureClass(toAlbers(chunk, wkid), tmp)
+  arcpy.Rename_management(tmp, outfc)
+  return outfc
+
+class ProjectionCache:
+  """
+  Projects national inputs once per source version.  Outputs are named by category and source content hash so a changed source is projected again and an
+  unchanged source is reused by every area of interest and every run.
+
+  :param cachegdb: Geodatabase that stores projected national inputs
+  :type cachegdb: str
+  """
+  def __init__(self, cachegdb):
+    self.cachegdb = cachegdb
+    if not arcpy.Exists(cachegdb):
+      print('Creating projection cache: ', cachegdb)
+      arcpy.CreateFileGDB_management(os.path.dirname(cachegdb), os.path.basename(cachegdb))
+
+  def project(self, inFeature, cat):
+    """
+    Returns the input if it's already in Albers, otherwise the cached projection of the current source version.
+
+    :param inFeature: National feature class
+    :type inFeature: str
+    :param cat: Category name used for unique storage
+    :type cat: str
+    :return: Location of feature class in Albers
+    :rtype: str
+    """
+    if sameCRS(arcpy.Describe(inFeature).spatialReference):
+      print('\tSpatial reference good', inFeature)
+      return inFeature
+    digest = fingerprint.datasetHash(inFeature)
+    outfc = os.path.join(self.cachegdb, '{}_{}'.format(cat, digest[:12]))
+    if arcpy.Exists(outfc):
+      logging.info('\tUsing cached projection ' + outfc)
+      return outfc
+    print('\tProjecting {} layer: {} to {}'.format(cat, inFeature, outfc))
+    projectFeature(inFeature, outfc)
+    # Drop projections of older source versions
+    workspace = arcpy.env.workspace
+    arcpy.env.workspace = self.cachegdb
+    for old in arcpy.ListFeatureClasses(cat + '_*'):
+      if re.fullmatch(cat + '_[0-9a-f]{12}', old) and old != os.path.basename(outfc):
+        arcpy.Delete_management(os.path.join(self.cachegdb, old))
+    arcpy.env.workspace = workspace
+    return outfc
@@ -6,6 +6,9 @@ This module defines the public land dataset and is used to organize and handle p
 import os, sys, getopt, datetime, logging, arcpy, json, csv
 from arcpy import env
 import waterfowlmodel.SpatialJoinLargestOverlap as overlap
+import waterfowlmodel.projection as projection
+import waterfowlmodel.fingerprint as fingerprint
+import waterfowlmodel.validity as validity
 
 class PublicLand:
   """
@@ -26,7 +29,7 @@ class PublicLand:
     self.scratch = scratch
     self.aoi = aoi
     self.name = name
-    self.land = self.projAlbers(self.clipStuff(land, name), name)
+    self.land = self.clipProject(land, name)
     self.binIt = binIt
     env.workspace = scratch
 
@@ -41,11 +44,12 @@ class PublicLand:
     :return outfc: Path and name of projected output feature class.
     :rtype outfc: str    
     """
-    if arcpy.Describe(inFeature).SpatialReference.Name != 102003:
+    if not projection.sameCRS(arcpy.Describe(inFeature).spatialReference):
       outfc = os.path.join(self.scratch, cat + 'aoi')
-      if not (arcpy.Exists(outfc)):
+      if not fingerprint.isCurrent(outfc, [inFeature]):
         print('\tProjecting:', inFeature)
-        arcpy.Project_management(inFeature, outfc, arcpy.SpatialReference(102003))
+        projection.projectFeature(inFeature, outfc)
+        fingerprint.record(outfc, [inFeature])
         return outfc
       else:
         return outfc        
@@ -53,6 +57,33 @@ class PublicLand:
       print('\tSpatial reference good')
       return inFeature
 
+  def clipProject(self, inFeature, cat):
+    """
+    Clip and project function.
+
+    Clips a feature dataset to the area of interest and projects it in a single pass.  A partition written by the national partitioner is used when it
+    was made from the current feature dataset and area of interest.
+
+    :param inFeature: Feature to clip to AOI
+    :type inFeature: str
+    :param cat: Feature category
+    :type cat: str
+    :return outfc: Location of clipped and projected feature
+    :rtype outfc: str
+    """
+    if fingerprint.isCurrent(os.path.join(self.scratch, cat + 'clip'), [inFeature, self.aoi]):
+      return self.projAlbers(os.path.join(self.scratch, cat + 'clip'), cat)
+    outfc = os.path.join(self.scratch, cat + 'aoi')
+    if fingerprint.isCurrent(outfc, [inFeature, self.aoi]):
+      print('\tAlready have {} clipped with aoi'.format(cat))
+      return outfc
+    print('\tClipping and projecting:', inFeature)
+    validFeature = validity.ensureValid(inFeature, os.path.join(self.scratch, cat + '_valid'))
+    validAOI = validity.ensureValid(self.aoi, os.path.join(self.scratch, 'aoi_valid'))
+    projection.clipProject(validFeature, validAOI, outfc)
+    fingerprint.record(outfc, [inFeature, self.aoi])
+    return outfc
+
   def clipStuff(self, inFeature, cat):
     """
     Clipping Function.
@@ -67,19 +98,16 @@ class PublicLand:
     :rtype outfc: str
     """
     outfc = os.path.join(self.scratch, cat + 'clip')
-    if arcpy.Exists(outfc):
+    if fingerprint.isCurrent(outfc, [inFeature, self.aoi]):
       print('\tAlready have {} clipped with aoi'.format(cat))
       logging.info('Already have {} clipped with aoi'.format(cat))
     else:
       print('\tClipping:', inFeature)
-      try:
-        logging.info("Clipping features")
-        arcpy.Clip_analysis(inFeature, self.aoi, outfc)
-      except:
-        print('Bad topology. Repairing')
-        arcpy.RepairGeometry_management(inFeature)
-        arcpy.RepairGeometry_management(self.aoi)
-        arcpy.Clip_analysis(inFeature, self.aoi, outfc)
+      logging.info("Clipping features")
+      validFeature = validity.ensureValid(inFeature, os.path.join(self.scratch, cat + '_valid'))
+      validAOI = validity.ensureValid(self.aoi, os.path.join(self.scratch, 'aoi_valid'))
+      arcpy.Clip_analysis(validFeature, validAOI, outfc)
+      fingerprint.record(outfc, [inFeature, self.aoi])
     return outfc  
 
   def bin(self, aggData, bins, cat):
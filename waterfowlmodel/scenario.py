@@ -0,0 +1,208 @@
+"""
+Module Kcal Scenarios
+=====================
+Every energy value of the model is linear in the kcal table.  Available energy is kcal/ha times the hectares of each habitat class, summed by bin.  A
+geometric run keeps a bin by habitat class matrix of total and protected habitat hectares with the demand and available hectares of each bin, and any
+number of alternative kcal tables are then evaluated with matrix products instead of rerunning the overlays.
+
+For hectares H, protected hectares P and kcal/ha k (one column per kcal table):
+
+  THabNrg = H k, ProtHabNrg = P k, wtMeankcal = H k^2 / H k
+
+and the surplus or deficit, energy protection needed and restoration and protection goals follow the same rules as Waterfowlmodel.dstOutput.  Run from
+the command line on the matrices of a finished run::
+
+  python -m waterfowlmodel.scenario -m _scenarios/*/matrix.npz -k kcal_low.csv kcal_high.csv -o _scenarios
+"""
+import os, sys, glob, argparse, logging, arcpy
+import numpy as np
+import pandas as pd
+import shapely
+import waterfowlmodel.columnstore as columnstore
+import waterfowlmodel.fingerprint as fingerprint
+import waterfowlmodel.scratchstore as scratchstore
+
+MATRIX_NAME = 'matrix.npz'
+# Output fields of Waterfowlmodel.dstOutput read as the demand and available hectares of each bin
+BASE_FIELDS = ['demand_lta_kcal', 'demand_80th_kcal', 'available_ha']
+
+def classHectares(layer, bins, binCodes, nBins, classes):
+  '''Helper function returning the hectares of each habitat class of a layer within each bin'''
+  values = layer['CLASS'].astype(str).values
+  known = np.isin(values, classes)
+  layer = layer[known]
+  classCodes = np.searchsorted(classes, values[known])
+  layerIdx, binIdx = bins.sindex.query(layer.geometry, predicate='intersects')
+  area = shapely.area(shapely.intersection(np.asarray(layer.geometry.values)[layerIdx], np.asarray(bins.geometry.values)[binIdx])) / 10000
+  size = nBins * len(classes)
+  return np.bincount(binCodes[binIdx] * len(classes) + classCodes[layerIdx], weights=area, minlength=size).reshape(nBins, len(classes))
+
+def buildMatrix(binIt, binField, mergedenergy, protectedEnergy, outData, folder):
+  """
+  Stores the bin by habitat class hectares of a geometric run.  Rebuilt only when one of the layers changes.
+
+  :param binIt: Bins within the area of interest
+  :type binIt: str
+  :param binField: Bin unique ID field
+  :type binField: str
+  :param mergedenergy: Energy supply layer with a CLASS field
+  :type mergedenergy: str
+  :param protectedEnergy: Energy supply clipped to protected lands
+  :type protectedEnergy: str
+  :param outData: Model output with the demand and available hectares of each bin
+  :type outData: str
+  :param folder: Output folder
+  :type folder: str
+  :return: Matrix location
+  :rtype: str
+  """
+  path = os.path.join(folder, MATRIX_NAME)
+  sources = [binIt, mergedenergy, protectedEnergy, outData]
+  if fingerprint.isCurrent(path, sources, {'binField': binField}):
+    return path
+  print('\tBuilding kcal scenario matrix in', folder)
+  bins = scratchstore.readFrame(binIt, [binField])
+  bins = bins[bins[binField].notnull()].reset_index(drop=True)
+  binIDs = bins[binField].astype(str).values
+  binValues = np.unique(binIDs)
+  binCodes = np.searchsorted(binValues, binIDs)
+  # The scratch layers are projected to the coordinate system of the bins, so only the habitat within their extent is read
+  box = tuple(bins.total_bounds)
+  energy = scratchstore.readFrame(mergedenergy, ['CLASS'], box).to_crs(bins.crs)
+  protected = scratchstore.readFrame(protectedEnergy, ['CLASS'], box).to_crs(bins.crs)
+  classes = np.unique(np.concatenate([energy['CLASS'].dropna().astype(str).values, protected['CLASS'].dropna().astype(str).values]))
+  classes = classes[classes != '']
+  # Bins can have more than one feature, so hectares are summed by bin ID
+  habitat = classHectares(energy, bins, binCodes, len(binValues), classes)
+  protectedHa = classHectares(protected, bins, binCodes, len(binValues), classes)
+  base = np.zeros((len(binValues), len(BASE_FIELDS)))
+  table = arcpy.da.TableToNumPyArray(outData, [binField] + BASE_FIELDS, null_value=0)
+  rows = np.isin(table[binField].astype(str), binValues)
+  for i, field in enumerate(BASE_FIELDS):
+    base[:, i] = np.bincount(np.searchsorted(binValues, table[binField].astype(str)[rows]), weights=table[field][rows], minlength=len(binValues))
+  os.makedirs(folder, exist_ok=True)
+  np.savez_compressed(path, bins=binValues, classes=classes, habitat=habitat, protected=protectedHa, base=base, binField=np.array(binField))
+  fingerprint.record(path, sources, {'binField': binField})
+  logging.info('Scenario matrix {}: {} bins, {} classes, {:.1f} habitat ha, {:.1f} protected habitat ha'.format(path, len(binValues), len(classes), habitat.sum(), protectedHa.sum()))
+  return path
+
+def loadMatrices(paths):
+  '''Helper function stacking the bins of one or more matrices over the union of their habitat classes'''
+  parts = []
+  for path in paths:
+    with np.load(path) as data:
+      parts.append({k: data[k] for k in data.files})
+  classes = np.unique(np.concatenate([p['classes'] for p in parts])) if parts else np.zeros(0, dtype=str)
+  def expand(p, key):
+    out = np.zeros((len(p['bins']), len(classes)))
+    out[:, np.searchsorted(classes, p['classes'])] = p[key]
+    return out
+  return {'bins': np.concatenate([p['bins'] for p in parts]), 'classes': classes, 'habitat': np.concatenate([expand(p, 'habitat') for p in parts]),
+          'protected': np.concatenate([expand(p, 'protected') for p in parts]), 'base': np.concatenate([p['base'] for p in parts]),
+          'binField': str(parts[0]['binField']) if parts else 'bin'}
+
+def kcalVector(kcalTable, classes):
+  """
+  Reads a kcal table in the same format as the model's kcal table, habitat type in the first column and kcal/ha in the second.  Classes missing from the
+  table get 0 like they do in Waterfowlmodel.prepEnergyFast.
+
+  :param kcalTable: Kcal table
+  :type kcalTable: str
+  :param classes: Habitat classes of the matrix
+  :type classes: numpy.ndarray
+  :return: kcal/ha of each class
+  :rtype: numpy.ndarray
+  """
+  kcal = {}
+  for key, value in columnstore.crosswalk(kcalTable).items():
+    try:
+      kcal[key] = float(value[0])
+    except (ValueError, IndexError):
+      continue
+  return np.array([kcal.get(c, 0.0) for c in classes.tolist()])
+
+def evaluate(matrix, K):
+  """
+  Calculates the energy and goals of every bin for one or more kcal vectors.
+
+  :param matrix: Matrix returned by loadMatrices
+  :type matrix: dict
+  :param K: kcal/ha with a row per habitat class and a column per scenario
+  :type K: numpy.ndarray
+  :return: Output field name to a bins by scenarios array
+  :rtype: dict
+  """
+  H, P = matrix['habitat'], matrix['protected']
+  demandLTA, demand80, available = (matrix['base'][:, i:i + 1] for i in range(3))
+  out = {'tothabitat_kcal': H @ K, 'protected_kcal': P @ K}
+  with np.errstate(divide='ignore', invalid='ignore'):
+    # Mean kcal/ha of the classes weighted by their share of the habitat energy
+    out['wtMean_kcal_per_ha'] = np.where(out['tothabitat_kcal'] > 0, (H @ (K * K)) / out['tothabitat_kcal'], 0)
+    for period, demand in [('lta', demandLTA), ('80th', demand80)]:
+      surpdef = out['tothabitat_kcal'] - demand
+      nrgprot = np.maximum(demand - out['protected_kcal'], 0)
+      out['surpdef_{}_kcal'.format(period)] = surpdef
+      out['nrgprot_{}_kcal'.format(period)] = nrgprot
+      # No weighted mean leaves the goal empty, like the field calculation in dstOutput does
+      restore = np.where(surpdef < 0, np.abs(surpdef / out['wtMean_kcal_per_ha']), 0)
+      protect = np.where(nrgprot > 0, nrgprot / out['wtMean_kcal_per_ha'], 0)
+      restore[~np.isfinite(restore)] = np.nan
+      protect[~np.isfinite(protect)] = np.nan
+      out['restoregoal_{}_ha'.format(period)] = np.minimum(restore, available)
+      out['protectgoal_{}_ha'.format(period)] = np.minimum(protect, available)
+  return out
+
+def runScenarios(matrices, kcalTables, outFolder):
+  """
+  Evaluates kcal tables on one or more scenario matrices.  Writes a csv per kcal table with the results of every bin and a summary csv with the totals of
+  every kcal table.
+
+  :param matrices: Matrix files written by buildMatrix
+  :type matrices: list
+  :param kcalTables: Kcal tables
+  :type kcalTables: list
+  :param outFolder: Output folder
+  :type outFolder: str
+  :return: Summary csv location
+  :rtype: str
+  """
+  matrix = loadMatrices(matrices)
+  K = np.column_stack([kcalVector(k, matrix['classes']) for k in kcalTables]) if kcalTables else np.zeros((len(matrix['classes']), 0))
+  results = evaluate(matrix, K)
+  os.makedirs(outFolder, exist_ok=True)
+  names = [os.path.splitext(os.path.basename(k))[0] for k in kcalTables]
+  summary = []
+  for s, name in enumerate(names):
+    df = pd.DataFrame({matrix['binField']: matrix['bins'], **{field: values[:, s] for field, values in results.items()}})
+    df.to_csv(os.path.join(outFolder, name + '.csv'), index=False)
+    summary.append({'scenario': name, 'kcalTable': kcalTables[s], **{field: np.nansum(values[:, s]) for field, values in results.items() if field != 'wtMean_kcal_per_ha'}})
+  summaryPath = os.path.join(outFolder, 'summary.csv')
+  pd.DataFrame(summary).to_csv(summaryPath, index=False)
+  print('\tEvaluated {} kcal tables on {} bins.  Summary in {}'.format(len(kcalTables), len(matrix['bins']), summaryPath))
+  logging.info('Evaluated kcal scenarios {} on {}'.format(', '.join(names), ', '.join(matrices)))
+  return summaryPath
+
+def main(argv):
+  """
+  Runs runScenarios from the command line.
+
+  :param matrices: Matrix files of a finished run.  Bins of every matrix are evaluated together
+  :type matrices: str
+  :param kcal: Kcal tables
+  :type kcal: str
+  :param output: Output folder
+  :type output: str
+  """
+  parser = argparse.ArgumentParser(description='Evaluates alternative kcal tables on the bin by habitat class hectares of a finished run')
+  parser.add_argument('--matrices', '-m', nargs='+', required=True, help='Matrix files of a finished run.  Wildcards are expanded')
+  parser.add_argument('--kcal', '-k', nargs='+', required=True, help='Kcal tables')
+  parser.add_argument('--output', '-o', required=True, help='Output folder')
+  args = parser.parse_args(argv)
+  matrices = sorted(set(p for m in args.matrices for p in (glob.glob(m) or [m])))
+  runScenarios(matrices, args.kcal, args.output)
+  print('Done')
+
+if __name__ == "__main__":
+  print('\nEvaluating kcal scenarios')
+  print('#####################################\n')
+  main(sys.argv[1:])
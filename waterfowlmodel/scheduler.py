@@ -0,0 +1,195 @@
+"""
+Module Scheduler
+================
+Orders areas of interest for the worker pool.  The cost of each area of interest is estimated from the feature and vertex counts of its inputs and the
+most expensive areas of interest are started first so a large state never starts last while the other workers sit idle.
+
+Areas of interest are only started when their estimated peak memory fits the memory budget along with everything already running.  Worker memory is
+measured with psutil when it's installed.
+"""
+import os, logging, itertools, arcpy
+import numpy as np
+import shapely
+import waterfowlmodel.fingerprint as fingerprint
+try:
+  import psutil
+except ImportError:
+  psutil = None
+
+# One feature costs about as much as this many vertices (cursor, union and dissolve overhead per row)
+FEATURE_WEIGHT = 50
+# Rough peak memory of the geopandas stages per feature and per vertex, plus the memory of a worker with arcpy loaded
+FEATURE_BYTES = 2048
+VERTEX_BYTES = 96
+WORKER_BYTES = 1 << 30
+# Peak memory assumed for an area of interest without partitioned inputs
+UNKNOWN_BYTES = 4 << 30
+# Partitions written by waterfowlmodel.partition that drive the cost of an area of interest
+COST_INPUTS = ['wetland', 'demand', 'padus', 'nced', 'bin']
+
+def featureCost(inFeature, chunkSize=100000):
+  """
+  Counts the features and vertices of a feature class.  Counts are memoized next to the manifests by the quick dataset key.
+
+  :param inFeature: Feature class to count
+  :type inFeature: str
+  :param chunkSize: Number of geometries counted at a time
+  :type chunkSize: int
+  :return: Feature count and vertex count
+  :rtype: tuple
+  """
+  key = fingerprint.datasetKey(inFeature)
+  memo = fingerprint.manifestPath(inFeature, 'cost')
+  known = fingerprint.readJson(memo)
+  if known.get('key') == key:
+    return known['features'], known['vertices']
+  features, vertices = 0, 0
+  with arcpy.da.SearchCursor(inFeature, ['SHAPE@WKB']) as cursor:
+    while True:
+      rows = list(itertools.islice(cursor, chunkSize))
+      if not rows:
+        break
+      geoms = shapely.from_wkb(np.array([bytes(r[0]) if r[0] else None for r in rows], dtype=object))
+      features += len(rows)
+      vertices += int(shapely.get_num_coordinates(geoms).sum())
+  fingerprint.writeJson(memo, {'source': inFeature, 'key': key, 'features': features, 'vertices': vertices})
+  return features, vertices
+
+def estimateCost(dstinfo):
+  """
+  Estimates the relative cost of one area of interest.  Uses the partitioned inputs in the scratch geodatabase and falls back to the area of interest
+  area when the national layers weren't partitioned.
+
+  :param dstinfo: Waterfowlmodel parameters for the area of interest as built by runModel.main
+  :type dstinfo: list
+  :return: Relative cost
+  :rtype: float
+  """
+  scratch = dstinfo[11]
+  cost = 0
+  for cat in COST_INPUTS + ['extra' + str(a) for a in range(len(dstinfo[9]))]:
+    fc = os.path.join(scratch, cat + 'clip')
+    if arcpy.Exists(fc):
+      features, vertices = featureCost(fc)
+      cost += features * FEATURE_WEIGHT + vertices
+  if cost:
+    return float(cost)
+  with arcpy.da.SearchCursor(dstinfo[0], ['SHAPE@AREA']) as cursor:
+    return float(sum(row[0] for row in cursor))
+
+def estimateCosts(dstList):
+  """
+  Estimates the relative cost of every area of interest.
+
+  :param dstList: Waterfowlmodel parameters for every area of interest
+  :type dstList: list
+  :return: Relative cost by area of interest name
+  :rtype: dict
+  """
+  costs = {dstinfo[1]: estimateCost(dstinfo) for dstinfo in dstList}
+  for aoi, cost in sorted(costs.items(), key=lambda c: -c[1]):
+    logging.info('Estimated cost for {}: {}'.format(aoi, int(cost)))
+  return costs
+
+def longestFirst(dstList, costs=None):
+  """
+  Sorts areas of interest by estimated cost, most expensive first.
+
+  :param dstList: Waterfowlmodel parameters for every area of interest
+  :type dstList: list
+  :param costs: Relative cost by area of interest name.  Estimated when not given
+  :type costs: dict
+  :return: dstList sorted by descending cost
+  :rtype: list
+  """
+  costs = costs or estimateCosts(dstList)
+  return sorted(dstList, key=lambda dstinfo: (-costs[dstinfo[1]], dstinfo[1]))
+
+def estimateMemory(dstinfo):
+  """
+  Estimates the peak memory of one area of interest from the feature and vertex counts of its partitioned inputs.  The geopandas stages load the
+  largest input (usually wetlands) whole so the largest input drives the estimate.
+
+  :param dstinfo: Waterfowlmodel parameters for the area of interest as built by runModel.main
+  :type dstinfo: list
+  :return: Estimated peak memory in bytes
+  :rtype: int
+  """
+  largest = None
+  for cat in COST_INPUTS + ['extra' + str(a) for a in range(len(dstinfo[9]))]:
+    fc = os.path.join(dstinfo[11], cat + 'clip')
+    if arcpy.Exists(fc):
+      features, vertices = featureCost(fc)
+      largest = max(largest or 0, features * FEATURE_BYTES + vertices * VERTEX_BYTES)
+  if largest is None:
+    return UNKNOWN_BYTES
+  return WORKER_BYTES + 2 * largest
+
+def memoryBudget(gigabytes=None):
+  """
+  Returns the memory budget for the pool.
+
+  :param gigabytes: Budget in gigabytes.  Defaults to 80 percent of physical memory when psutil is installed, otherwise no budget
+  :type gigabytes: float
+  :return: Budget in bytes or None
+  :rtype: int
+  """
+  if gigabytes:
+    return int(gigabytes * (1 << 30))
+  if psutil is not None:
+    return int(psutil.virtual_memory().total * 0.8)
+  return None
+
+def workerMemory():
+  '''Helper function returning the resident memory of every child process or 0 without psutil'''
+  if psutil is None:
+    return 0
+  total = 0
+  for child in psutil.Process().children(recursive=True):
+    try:
+      total += child.memory_info().rss
+    except psutil.Error:
+      pass
+  return total
+
+def runAdmitted(pool, func, jobs, workers, budget=None, poll=1):
+  """
+  Runs jobs on a pool in the given order, starting a job only when a worker is free and its estimated memory fits the budget.  Used memory is the larger
+  of the estimates of running jobs and the measured resident memory of the workers.  Smaller jobs further down the list start when the next job doesn't
+  fit, and a job larger than the budget still runs when nothing else is running.
+
+  :param pool: Process pool
+  :type pool: multiprocessing.Pool
+  :param func: Function called with each job
+  :type func: function
+  :param jobs: Waterfowlmodel parameters for each job, most expensive first
+  :type jobs: list
+  :param workers: Maximum number of jobs running at once
+  :type workers: int
+  :param budget: Memory budget in bytes.  No budget when None
+  :type budget: int
+  :param poll: Seconds between checks of the running jobs
+  :type poll: float
+  :return: Job results in the order they finished
+  :rtype: list
+  """
+  estimates = [estimateMemory(job) for job in jobs]
+  pending = list(range(len(jobs)))
+  running = {}
+  results = []
+  while pending or running:
+    for i in [i for i, r in running.items() if r.ready()]:
+      results.append(running.pop(i).get())
+    used = max(sum(estimates[i] for i in running), workerMemory())
+    for i in list(pending):
+      if len(running) >= workers:
+        break
+      if budget and running and used + estimates[i] > budget:
+        continue
+      pending.remove(i)
+      running[i] = pool.apply_async(func, (jobs[i],))
+      used += estimates[i]
+      logging.info('Started {} with estimated peak memory {} MB, {} MB in use'.format(jobs[i][1], estimates[i] >> 20, used >> 20))
+    if running:
+      next(iter(running.values())).wait(poll)
+  return results
@@ -0,0 +1,209 @@
+"""
+Module Scratch Store
+====================
+Reads and writes scratch layers as GeoDataFrames.  The default backend reads the scratch file geodatabase directly, asking the driver for only the
+columns and the extent a step needs.  The optional parquet backend keeps a GeoParquet copy of each scratch layer in <scratch>_parquet next to the
+geodatabase.  Copies are sorted along a Hilbert curve and written in small row groups with per-row bounding box columns, so a bbox read only
+decompresses the row groups whose statistics overlap the box and a column read only decompresses the requested columns.
+
+The geodatabase stays the layer of record because the arcpy tools can't read parquet.  The geopandas steps of Waterfowlmodel (the energy supply layer,
+the protected lands union, the cleaned urban polygons and the model output) write their layers with writeFrame, which makes the copy at the same time.
+Layers written by arcpy tools are copied with copyLayer where a step knows it reads them (the merged supply and demand union MergeAll and the aggTo bin
+layers), and otherwise when the same process reads them a second time, since a layer read once is read faster from the geodatabase than copied.  readFrame and readTable use a copy whenever it's current.  Each copy records the size and modification time of the layer's geodatabase files,
+so an edit made by an arcpy tool is picked up on the next read without hashing the layer.  The parquet backend needs pyarrow.
+
+The compact backend keeps the copies in <scratch>_compact in the quantized, delta encoded format of waterfowlmodel.compactgeom instead.  Coordinates are
+snapped to a grid (1 cm by default).  The area change and the area error bound of every copy are printed with the layer name and logged.
+"""
+import os, logging
+import pandas as pd
+import geopandas as gpd
+import waterfowlmodel.fingerprint as fingerprint
+import waterfowlmodel.compactgeom as compactgeom
+try:
+  import pyarrow
+except ImportError:
+  pyarrow = None
+
+BACKENDS = ['gdb', 'parquet', 'compact']
+# Rows per parquet row group.  Smaller groups make bbox reads more selective at the cost of more statistics to check.
+ROW_GROUP_SIZE = 20000
+BBOX_COLUMNS = ['bbox_xmin', 'bbox_ymin', 'bbox_xmax', 'bbox_ymax']
+
+state = {'backend': 'gdb', 'grid': compactgeom.GRID}
+# Number of times this process read each layer without a current copy
+reads = {}
+
+def setBackend(backend, grid=None):
+  """
+  Selects the scratch backend for this process.
+
+  :param backend: gdb, parquet or compact.  parquet falls back to gdb when pyarrow isn't installed
+  :type backend: str
+  :param grid: Grid cell size in meters for the compact backend.  Defaults to compactgeom.GRID
+  :type grid: float
+  """
+  if backend not in BACKENDS:
+    raise ValueError('Unknown scratch backend {}.  Use one of {}'.format(backend, ', '.join(BACKENDS)))
+  if backend == 'parquet' and pyarrow is None:
+    logging.warning('pyarrow is not installed.  Using the gdb scratch backend')
+    backend = 'gdb'
+  state['backend'] = backend
+  state['grid'] = grid or compactgeom.GRID
+
+def parquetPath(inData):
+  '''Helper function returning the GeoParquet copy of a geodatabase layer'''
+  folder, name = os.path.split(inData)
+  return os.path.join(os.path.splitext(folder)[0] + '_parquet', name + '.parquet')
+
+def compactPath(inData):
+  '''Helper function returning the compact copy of a geodatabase layer'''
+  folder, name = os.path.split(inData)
+  return os.path.join(os.path.splitext(folder)[0] + '_compact', name + '.npz')
+
+def copyPath(inData):
+  '''Helper function returning the copy of a geodatabase layer for the current backend'''
+  return compactPath(inData) if state['backend'] == 'compact' else parquetPath(inData)
+
+def layerStamp(inData):
+  '''Helper function returning the name, size and modification time of every file of a layer.  Empty when the files can't be found'''
+  stamp = []
+  for path in fingerprint.tableFiles(inData):
+    st = os.stat(path)
+    stamp.append([os.path.basename(path), st.st_size, st.st_mtime_ns])
+  return stamp
+
+def isCopied(inData):
+  '''Helper function returning True when the copy of a layer exists and was made from its current version'''
+  path = copyPath(inData)
+  if not os.path.isfile(path):
+    return False
+  manifest = fingerprint.readJson(fingerprint.manifestPath(path))
+  if state['backend'] == 'compact' and manifest.get('params', {}).get('grid') != state['grid']:
+    return False
+  stamp = layerStamp(inData)
+  return bool(stamp) and manifest.get('code') == fingerprint.codeVersion() and manifest.get('stamp') == stamp
+
+def recordCopy(path, inData, params=None):
+  '''Helper function recording the version of the layer a copy was made from'''
+  fingerprint.writeJson(fingerprint.manifestPath(path), {'source': inData, 'stamp': layerStamp(inData), 'params': params or {}, 'code': fingerprint.codeVersion()})
+
+def writeParquet(gdf, inData):
+  """
+  Writes the GeoParquet copy of a layer sorted along a Hilbert curve with bounding box columns for row group pruning.
+
+  :param gdf: Layer contents
+  :type gdf: GeoDataFrame
+  :param inData: Geodatabase layer the copy belongs to
+  :type inData: str
+  :return: Copy location
+  :rtype: str
+  """
+  path = parquetPath(inData)
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  gdf = gdf.copy()
+  if len(gdf):
+    bounds = gdf.geometry.bounds.values
+    for i, col in enumerate(BBOX_COLUMNS):
+      gdf[col] = bounds[:, i]
+    gdf = gdf.iloc[gdf.geometry.hilbert_distance().argsort()]
+  gdf.reset_index(drop=True).to_parquet(path, index=False, row_group_size=ROW_GROUP_SIZE)
+  recordCopy(path, inData)
+  return path
+
+def writeCompact(gdf, inData):
+  '''Helper function writing the compact copy of a layer, reporting its area error and recording the layer version it was made from'''
+  path = compactPath(inData)
+  report = compactgeom.writeCompact(gdf, path, state['grid'])
+  recordCopy(path, inData, {'grid': state['grid']})
+  print('\tCompact copy of {}: snapping changed the area by {:.3f} m2, bound {:.3f} m2 ({:.2e} of the area)'.format(os.path.basename(inData), report['error'],
+        report['bound'], report['relativeBound']))
+  return path
+
+def writeCopy(gdf, inData):
+  '''Helper function writing the copy of a layer for the current backend'''
+  return writeCompact(gdf, inData) if state['backend'] == 'compact' else writeParquet(gdf, inData)
+
+def hasCopy(inData):
+  '''Helper function returning True when the current backend keeps copies and the copy of a layer is current'''
+  return state['backend'] != 'gdb' and isCopied(inData)
+
+def copyLayer(inData):
+  """
+  Copies a layer written by an arcpy tool for the parquet and compact backends, so the reads that follow use the copy instead of the geodatabase.  Does
+  nothing with the gdb backend or when the copy is current, so a layer kept from an earlier run is only copied once.
+
+  :param inData: Geodatabase layer
+  :type inData: str
+  :return: inData
+  :rtype: str
+  """
+  if state['backend'] != 'gdb' and not isCopied(inData):
+    writeCopy(readGDB(inData), inData)
+  return inData
+
+def readGDB(inData, columns=None, bbox=None):
+  '''Helper function reading a geodatabase layer with only the requested columns and extent'''
+  return gpd.read_file(os.path.dirname(inData), layer=os.path.basename(inData), columns=columns, bbox=bbox)
+
+def readFrame(inData, columns=None, bbox=None):
+  """
+  Reads a scratch layer.  With the parquet and compact backends a layer without a current copy is read from the geodatabase the first time and copied
+  the second time.
+
+  :param inData: Geodatabase layer
+  :type inData: str
+  :param columns: Attribute columns to read.  Geometry is always read.  Reads every column when None
+  :type columns: list
+  :param bbox: Only read features whose bounding box intersects (xmin, ymin, xmax, ymax) in the layer's coordinates
+  :type bbox: tuple
+  :return: Layer contents
+  :rtype: GeoDataFrame
+  """
+  if state['backend'] == 'gdb':
+    return readGDB(inData, columns, bbox)
+  if not isCopied(inData):
+    reads[inData] = reads.get(inData, 0) + 1
+    if reads[inData] == 1:
+      return readGDB(inData, columns, bbox)
+    writeCopy(readGDB(inData), inData)
+  if state['backend'] == 'compact':
+    return compactgeom.readCompact(compactPath(inData), columns, bbox)
+  filters = None
+  if bbox is not None:
+    filters = [('bbox_xmax', '>=', bbox[0]), ('bbox_ymax', '>=', bbox[1]), ('bbox_xmin', '<=', bbox[2]), ('bbox_ymin', '<=', bbox[3])]
+  gdf = gpd.read_parquet(parquetPath(inData), columns=None if columns is None else list(columns) + ['geometry'], filters=filters)
+  return gdf.drop(columns=[c for c in BBOX_COLUMNS if c in gdf.columns])
+
+def readTable(inData, columns):
+  """
+  Reads attribute columns of a scratch layer without its geometry, from the layer's copy when it has a current one.
+
+  :param inData: Geodatabase layer
+  :type inData: str
+  :param columns: Attribute columns to read
+  :type columns: list
+  :return: Columns in the requested order
+  :rtype: pandas.DataFrame
+  """
+  if hasCopy(inData):
+    if state['backend'] == 'compact':
+      return compactgeom.readColumns(compactPath(inData), columns)
+    return pd.read_parquet(parquetPath(inData), columns=list(columns))
+  return pd.DataFrame(gpd.read_file(os.path.dirname(inData), layer=os.path.basename(inData), columns=columns, ignore_geometry=True))[list(columns)]
+
+def writeFrame(gdf, outData):
+  """
+  Writes a scratch layer to the geodatabase, and its copy with the parquet and compact backends.
+
+  :param gdf: Layer contents
+  :type gdf: GeoDataFrame
+  :param outData: Geodatabase layer
+  :type outData: str
+  :return: outData
+  :rtype: str
+  """
+  gdf.to_file(os.path.dirname(outData), layer=os.path.basename(outData), driver='OpenFileGDB')
+  if state['backend'] != 'gdb':
+    writeCopy(gdf, outData)
+  return outData
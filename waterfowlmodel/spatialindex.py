@@ -0,0 +1,184 @@
+"""
+Module Spatial Index
+====================
+Packed Hilbert R-tree for the national source layers.  The tree is built once per source version and stored in a _rtree folder next to the source
+workspace as plain .npy files, so every stage and every worker memory maps the same pages instead of building its own candidate set.
+
+Feature bounding boxes are sorted by the Hilbert value of their centers and packed bottom up into nodes of NODE_SIZE boxes.  All levels are stored in
+one array, leaves first, so a query walks down from the root testing a whole level of candidate nodes at once.
+"""
+import os, json, logging, itertools, arcpy
+import numpy as np
+import shapely
+import waterfowlmodel.fingerprint as fingerprint
+
+NODE_SIZE = 16
+# Bits per axis of the Hilbert grid
+HILBERT_ORDER = 16
+
+def hilbert(x, y, order=HILBERT_ORDER):
+  """
+  Returns the Hilbert curve distance of integer grid coordinates.
+
+  :param x: Grid columns from 0 to 2**order - 1
+  :type x: numpy.ndarray
+  :param y: Grid rows from 0 to 2**order - 1
+  :type y: numpy.ndarray
+  :param order: Bits per axis
+  :type order: int
+  :return: Hilbert distances
+  :rtype: numpy.ndarray
+  """
+  n = 1 << order
+  x, y = x.astype(np.int64), y.astype(np.int64)
+  d = np.zeros(len(x), dtype=np.int64)
+  s = n >> 1
+  while s > 0:
+    rx = (x & s) > 0
+    ry = (y & s) > 0
+    d += s * s * ((3 * rx.astype(np.int64)) ^ ry.astype(np.int64))
+    flip = ~ry & rx
+    x = np.where(flip, n - 1 - x, x)
+    y = np.where(flip, n - 1 - y, y)
+    swap = ~ry
+    x, y = np.where(swap, y, x), np.where(swap, x, y)
+    s >>= 1
+  return d
+
+def indexPath(inFeature):
+  '''Helper function returning the location of the index files of a feature class, without extension'''
+  workspace = fingerprint.workspaceOf(inFeature)
+  folder = os.path.join(os.path.dirname(workspace), os.path.splitext(os.path.basename(workspace))[0] + '_rtree')
+  return os.path.join(folder, os.path.splitext(os.path.basename(inFeature))[0])
+
+def featureBounds(inFeature, chunkSize=100000):
+  '''Helper function returning the object IDs and bounding boxes of every non-empty feature'''
+  oids, boxes = [], []
+  with arcpy.da.SearchCursor(inFeature, ['OID@', 'SHAPE@WKB']) as cursor:
+    while True:
+      rows = list(itertools.islice(cursor, chunkSize))
+      if not rows:
+        break
+      bounds = shapely.bounds(shapely.from_wkb(np.array([bytes(r[1]) if r[1] else None for r in rows], dtype=object)))
+      keep = ~np.isnan(bounds).any(axis=1)
+      oids.append(np.array([r[0] for r in rows], dtype=np.int64)[keep])
+      boxes.append(bounds[keep])
+  if not oids:
+    return np.zeros(0, dtype=np.int64), np.zeros((0, 4))
+  return np.concatenate(oids), np.concatenate(boxes)
+
+def pack(oids, boxes, nodeSize=NODE_SIZE):
+  """
+  Packs bounding boxes into a Hilbert R-tree.
+
+  :param oids: Object ID of each box
+  :type oids: numpy.ndarray
+  :param boxes: Bounding boxes (xmin, ymin, xmax, ymax)
+  :type boxes: numpy.ndarray
+  :param nodeSize: Boxes in each node
+  :type nodeSize: int
+  :return: Object IDs in leaf order, boxes of every level (leaves first), and the start of each level
+  :rtype: tuple
+  """
+  if len(boxes):
+    extent = np.array([boxes[:, 0].min(), boxes[:, 1].min(), boxes[:, 2].max(), boxes[:, 3].max()])
+    size = np.maximum(extent[2:] - extent[:2], 1e-9)
+    scale = (1 << HILBERT_ORDER) - 1
+    cx = ((boxes[:, 0] + boxes[:, 2]) / 2 - extent[0]) / size[0] * scale
+    cy = ((boxes[:, 1] + boxes[:, 3]) / 2 - extent[1]) / size[1] * scale
+    order = np.argsort(hilbert(cx.astype(np.int64), cy.astype(np.int64)), kind='stable')
+    oids, boxes = oids[order], boxes[order]
+  levels = [boxes]
+  while len(levels[-1]) > 1:
+    child = levels[-1]
+    starts = np.arange(0, len(child), nodeSize)
+    levels.append(np.column_stack([np.minimum.reduceat(child[:, 0], starts), np.minimum.reduceat(child[:, 1], starts),
+                                   np.maximum.reduceat(child[:, 2], starts), np.maximum.reduceat(child[:, 3], starts)]))
+  offsets = np.cumsum([0] + [len(level) for level in levels]).tolist()
+  return oids, np.concatenate(levels) if len(boxes) else boxes, offsets
+
+class PackedRTree:
+  """
+  Memory mapped packed R-tree of one feature class.
+
+  :param path: Index location without extension as returned by indexPath
+  :type path: str
+  """
+  def __init__(self, path):
+    self.path = path
+    self.meta = fingerprint.readJson(path + '.json')
+    self.oids = np.load(path + '.oids.npy', mmap_mode='r')
+    self.boxes = np.load(path + '.boxes.npy', mmap_mode='r')
+    self.offsets = self.meta['offsets']
+    self.nodeSize = self.meta['nodeSize']
+
+  def __len__(self):
+    return len(self.oids)
+
+  def query(self, bbox):
+    """
+    Returns the object IDs of features whose bounding box intersects a box.
+
+    :param bbox: Query box (xmin, ymin, xmax, ymax) in the coordinates of the indexed layer
+    :type bbox: tuple
+    :return: Sorted object IDs
+    :rtype: numpy.ndarray
+    """
+    if not len(self.oids):
+      return np.zeros(0, dtype=np.int64)
+    xmin, ymin, xmax, ymax = bbox
+    top = len(self.offsets) - 2
+    nodes = np.arange(self.offsets[top + 1] - self.offsets[top])
+    for level in range(top, -1, -1):
+      boxes = self.boxes[self.offsets[level] + nodes]
+      nodes = nodes[(boxes[:, 0] <= xmax) & (boxes[:, 2] >= xmin) & (boxes[:, 1] <= ymax) & (boxes[:, 3] >= ymin)]
+      if level == 0 or not len(nodes):
+        break
+      # Expand every kept node into the range of its children on the level below
+      count = self.offsets[level] - self.offsets[level - 1]
+      starts = nodes * self.nodeSize
+      lengths = np.minimum(starts + self.nodeSize, count) - starts
+      nodes = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+    return np.sort(self.oids[nodes]) if len(nodes) else np.zeros(0, dtype=np.int64)
+
+  def queryGeometry(self, geometry):
+    '''Returns the object IDs of features whose bounding box intersects the bounding box of a shapely geometry'''
+    return self.query(shapely.bounds(geometry))
+
+def buildIndex(inFeature):
+  """
+  Builds the packed R-tree of a feature class unless the stored tree was built from the current version of the feature class.  Run from the parent
+  before the pool starts so workers never build the same index.
+
+  :param inFeature: Feature class to index
+  :type inFeature: str
+  :return: Index
+  :rtype: PackedRTree
+  """
+  path = indexPath(inFeature)
+  sources = fingerprint.sourceHashes([inFeature])
+  if fingerprint.readJson(path + '.json').get('sources') == sources:
+    return PackedRTree(path)
+  print('\tBuilding spatial index for {}'.format(inFeature))
+  oids, boxes, offsets = pack(*featureBounds(inFeature))
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  np.save(path + '.oids.npy', oids)
+  np.save(path + '.boxes.npy', boxes)
+  fingerprint.writeJson(path + '.json', {'source': inFeature, 'sources': sources, 'offsets': offsets, 'nodeSize': NODE_SIZE, 'count': len(oids)})
+  logging.info('Indexed {} features of {}'.format(len(oids), inFeature))
+  return PackedRTree(path)
+
+def openIndex(inFeature):
+  """
+  Opens the stored packed R-tree of a feature class without building it.
+
+  :param inFeature: Indexed feature class
+  :type inFeature: str
+  :return: Index, or None when there's no index for the current version of the feature class
+  :rtype: PackedRTree
+  """
+  path = indexPath(inFeature)
+  meta = fingerprint.readJson(path + '.json')
+  if not meta or meta.get('sources') != fingerprint.sourceHashes([inFeature]):
+    return None
+  return PackedRTree(path)
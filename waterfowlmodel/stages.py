@@ -0,0 +1,193 @@
+"""
+Module Stages
+=============
+Stage graph used to run the model for an area of interest.  Each stage lists the values it needs and the values it makes, so selecting a stage pulls in
+the stages it depends on.  Stages run one at a time by default.  arcpy isn't thread safe and the stages share the Waterfowlmodel object and arcpy.env, so
+stages never run on threads.  With more than one worker, stages marked separate run in their own processes next to the other stages instead.
+"""
+import logging, time, multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+import waterfowlmodel.profiling as profiling
+import waterfowlmodel.logqueue as logqueue
+
+class Stage:
+  """
+  One step of the model.
+
+  :param name: Stage name used for selection
+  :type name: str
+  :param func: Function called with the shared context dictionary.  Returns a dictionary with a value for every output.
+  :type func: function
+  :param inputs: Context values the stage reads
+  :type inputs: list
+  :param outputs: Context values the stage makes
+  :type outputs: list
+  :param separate: The stage only passes values to later stages through its outputs, so it can run in its own process next to other stages
+  :type separate: bool
+  """
+  def __init__(self, name, func, inputs=(), outputs=(), separate=False):
+    self.name = name
+    self.func = func
+    self.inputs = list(inputs)
+    self.outputs = list(outputs)
+    self.separate = separate
+
+class HostProcess(multiprocessing.get_context().Process):
+  '''Pool worker process that isn't a daemon, so the stages of the area of interest it runs can start processes of their own'''
+  @property
+  def daemon(self):
+    return False
+
+  @daemon.setter
+  def daemon(self, value):
+    pass
+
+class HostContext(type(multiprocessing.get_context())):
+  '''Multiprocessing context of pools whose workers run stages in separate processes'''
+  Process = HostProcess
+
+class StageGraph:
+  """Stores model stages and runs them in dependency order."""
+  def __init__(self):
+    self.stages = {}
+
+  def add(self, name, func, inputs=(), outputs=(), separate=False):
+    """
+    Adds a stage to the graph.
+
+    :param name: Stage name used for selection
+    :type name: str
+    :param func: Function called with the shared context dictionary
+    :type func: function
+    :param inputs: Context values the stage reads
+    :type inputs: list
+    :param outputs: Context values the stage makes
+    :type outputs: list
+    :param separate: The stage only passes values to later stages through its outputs, so it can run in its own process next to other stages
+    :type separate: bool
+    """
+    for out in outputs:
+      for stage in self.stages.values():
+        if out in stage.outputs:
+          raise ValueError('{} is made by both {} and {}'.format(out, stage.name, name))
+    self.stages[name] = Stage(name, func, inputs, outputs, separate)
+
+  def producer(self, value):
+    '''Returns the name of the stage that makes a context value or None if it has to be supplied'''
+    for stage in self.stages.values():
+      if value in stage.outputs:
+        return stage.name
+    return None
+
+  def dependencies(self, name, provided=()):
+    '''Returns the names of the stages a stage directly depends on for values that aren't already provided'''
+    return set(p for p in (self.producer(i) for i in self.stages[name].inputs if i not in provided) if p)
+
+  def resolve(self, selected=None, provided=()):
+    """
+    Returns the selected stages and everything they depend on in the order they were added.
+
+    :param selected: Stage names.  Defaults to every stage
+    :type selected: list
+    :param provided: Context values that are already available.  Stages are not pulled in to make them.
+    :type provided: list
+    :return: Stage names to run
+    :rtype: list
+    """
+    if selected is None:
+      return list(self.stages)
+    unknown = [s for s in selected if s not in self.stages]
+    if unknown:
+      raise ValueError('Unknown stage(s): {}.  Choose from {}'.format(', '.join(unknown), ', '.join(self.stages)))
+    needed = set()
+    todo = list(selected)
+    while todo:
+      name = todo.pop()
+      if name not in needed:
+        needed.add(name)
+        todo.extend(self.dependencies(name, provided))
+    return [s for s in self.stages if s in needed]
+
+  def run(self, context, selected=None, workers=1, callback=None, initializer=None, initargs=()):
+    """
+    Runs stages in dependency order.  With more than one worker, separate stages start in their own process as soon as the stages they depend on finish,
+    and every other stage runs in this process while they work.  A separate stage gets a copy of the context, so changes it makes to context objects
+    (e.g. the Waterfowlmodel object) don't reach later stages.  Only its outputs do.
+
+    :param context: Shared values.  Updated with the outputs of every stage.  Must be picklable when separate stages run in their own process
+    :type context: dict
+    :param selected: Stage names to run along with their dependencies.  Defaults to every stage
+    :type selected: list
+    :param workers: Maximum number of separate stages running at once.  Defaults to 1, running every stage in this process
+    :type workers: int
+    :param callback: Called with the stage name and its outputs after every stage finishes
+    :type callback: function
+    :param initializer: Called with initargs when a stage process starts, to set up logging and the scratch store like the calling process
+    :type initializer: function
+    :param initargs: Arguments of initializer
+    :type initargs: tuple
+    :return: context
+    :rtype: dict
+    """
+    order = self.resolve(selected, list(context))
+    for name in order:
+      missing = [i for i in self.stages[name].inputs if self.producer(i) is None and i not in context]
+      if missing:
+        raise ValueError('Stage {} needs {}'.format(name, ', '.join(missing)))
+    def finish(name, result):
+      context.update(result)
+      done.add(name)
+      if callback:
+        callback(name, result)
+    done = set()
+    if workers <= 1 or not any(self.stages[name].separate for name in order):
+      for name in order:
+        logging.info('Starting stage ' + name)
+        finish(name, self.runStage(name, context))
+      return context
+    waiting = {name: self.dependencies(name, list(context)) & set(order) for name in order}
+    running = {}
+    error = None
+    with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as executor:
+      while waiting or running:
+        if error is None:
+          ready = [n for n in order if n in waiting and waiting[n] <= done]
+          for name in [n for n in ready if self.stages[n].separate]:
+            del waiting[name]
+            logging.info('Starting stage {} in its own process'.format(name))
+            running[executor.submit(self.runStage, name, context)] = name
+          local = [n for n in ready if not self.stages[n].separate]
+          if local:
+            # Finished separate stages are collected once this stage is done
+            del waiting[local[0]]
+            logging.info('Starting stage ' + local[0])
+            try:
+              finish(local[0], self.runStage(local[0], context))
+            except Exception as e:
+              error = e
+            continue
+        if not running:
+          break
+        finished, _ = wait(running, return_when=FIRST_COMPLETED)
+        for future in finished:
+          name = running.pop(future)
+          try:
+            finish(name, future.result())
+          except Exception as e:
+            error = error or e
+    if error is not None:
+      raise error
+    return context
+
+  def runStage(self, name, context):
+    '''Runs one stage and checks it returned all of its outputs'''
+    stage = self.stages[name]
+    start = time.time()
+    with logqueue.stage(name), profiling.span(name, 'stage', [context.get(i) for i in stage.inputs]) as s:
+      result = stage.func(context) or {}
+      s.outputs = list(result.values())
+    missing = [o for o in stage.outputs if o not in result]
+    if missing:
+      raise ValueError('Stage {} did not return {}'.format(name, ', '.join(missing)))
+    logging.info('Finished stage {} in {}'.format(name, round(time.time() - start, 3)))
+    return result
@@ -0,0 +1,201 @@
+"""
+Module Supply Table
+===================
+Memory mapped columnar copy of the attributes of the merged energy supply and demand layer (MergeAll).  Every column is stored as its own .npy file in a
+<scratch>_supply folder next to the scratch geodatabase.  CLASS and the bin columns are dictionary encoded: the file holds an integer code per row and a
+sorted array of the distinct values, so the weighted mean and habitat proportions are computed with np.bincount over the codes instead of grouping
+strings in pandas.
+
+Tables are opened lazily and read without copying, so the operating system can keep the supply tables of several areas of interest resident and drop
+their pages under memory pressure instead of swapping.
+"""
+import os, logging, arcpy
+import numpy as np
+import waterfowlmodel.dataset as dataset
+import waterfowlmodel.fingerprint as fingerprint
+import waterfowlmodel.scratchstore as scratchstore
+
+VALUE_COLUMNS = ['avalNrgy', 'CalcHA', 'kcal']
+CODED_COLUMNS = ['CLASS']
+
+cache = {}
+
+def tablePath(scratch, name):
+  '''Helper function returning the folder of a stored supply table'''
+  return os.path.join(os.path.splitext(scratch)[0] + '_supply', name)
+
+def codeType(count):
+  '''Helper function returning the smallest unsigned integer type for dictionary codes'''
+  for dtype in [np.uint8, np.uint16, np.uint32]:
+    if count <= np.iinfo(dtype).max + 1:
+      return dtype
+  return np.uint64
+
+def readChunks(inTable, columns, chunkSize):
+  '''Helper function returning the supply columns of a layer in chunks, from its scratch store copy when it has a current one.  Nulls are 0 or empty strings'''
+  if not scratchstore.hasCopy(inTable):
+    return dataset.iterTable(inTable, columns, chunkSize, {col: 0 for col in VALUE_COLUMNS})
+  table = scratchstore.readTable(inTable, columns)
+  for col in columns:
+    table[col] = table[col].fillna(0 if col in VALUE_COLUMNS else '')
+  return (table.iloc[start:start + chunkSize] for start in range(0, len(table), chunkSize))
+
+def write(inTable, folder, binFields, chunkSize=100000):
+  """
+  Writes the supply attributes of a layer as memory mappable columns.  Rows are streamed so the layer is never held in memory as one structured array.
+  A layer with a current scratch store copy is read from the copy, which holds the attributes apart from the geometry.
+
+  :param inTable: Merged energy supply and demand layer
+  :type inTable: str
+  :param folder: Output folder
+  :type folder: str
+  :param binFields: Bin ID fields.  Stored dictionary encoded like CLASS
+  :type binFields: list
+  :param chunkSize: Number of rows read at a time
+  :type chunkSize: int
+  :return: folder
+  :rtype: str
+  """
+  coded = CODED_COLUMNS + [b for b in binFields if b not in CODED_COLUMNS]
+  columns = VALUE_COLUMNS + coded
+  os.makedirs(folder, exist_ok=True)
+  count = int(arcpy.GetCount_management(inTable)[0])
+  values = {col: np.lib.format.open_memmap(os.path.join(folder, col + '.npy'), mode='w+', dtype=np.float64, shape=(count,)) for col in VALUE_COLUMNS}
+  codes = {col: np.empty(count, dtype=np.int64) for col in coded}
+  lookup = {col: {} for col in coded}
+  start = 0
+  for chunk in readChunks(inTable, columns, chunkSize):
+    end = start + len(chunk)
+    for col in VALUE_COLUMNS:
+      values[col][start:end] = np.asarray(chunk[col])
+    for col in coded:
+      distinct, inverse = np.unique(np.asarray(chunk[col]), return_inverse=True)
+      known = lookup[col]
+      codes[col][start:end] = np.array([known.setdefault(v, len(known)) for v in distinct.tolist()], dtype=np.int64)[inverse]
+    start = end
+  for col in VALUE_COLUMNS:
+    values[col].flush()
+  # Renumber the codes so the dictionary is sorted like a pandas group by
+  for col in coded:
+    distinct = np.array(list(lookup[col]))
+    order = np.argsort(distinct, kind='stable')
+    rank = np.empty(len(order), dtype=np.int64)
+    rank[order] = np.arange(len(order))
+    np.save(os.path.join(folder, col + '.values.npy'), distinct[order])
+    np.save(os.path.join(folder, col + '.codes.npy'), (rank[codes[col][:start]] if len(rank) else codes[col][:start]).astype(codeType(len(order))))
+  fingerprint.writeJson(os.path.join(folder, 'columns.json'), {'source': inTable, 'rows': start, 'values': VALUE_COLUMNS, 'coded': coded})
+  logging.info('Stored {} supply rows of {} in {}'.format(start, inTable, folder))
+  return folder
+
+def build(inTable, scratch, binFields):
+  """
+  Stores the supply table of a layer unless the stored copy was made from the current version of the layer.
+
+  :param inTable: Merged energy supply and demand layer
+  :type inTable: str
+  :param scratch: Scratch geodatabase location
+  :type scratch: str
+  :param binFields: Bin ID fields
+  :type binFields: list
+  :return: Supply table folder
+  :rtype: str
+  """
+  folder = tablePath(scratch, os.path.basename(inTable))
+  params = {'bins': list(binFields)}
+  manifest = fingerprint.readJson(fingerprint.manifestPath(folder))
+  if os.path.isfile(os.path.join(folder, 'columns.json')) and manifest.get('params') == params and manifest.get('code') == fingerprint.codeVersion() \
+      and manifest.get('sources') == fingerprint.sourceHashes([inTable]):
+    return folder
+  cache.pop(folder, None)
+  write(inTable, folder, binFields)
+  fingerprint.record(folder, [inTable], params)
+  return folder
+
+class SupplyTable:
+  """
+  Lazily opened, memory mapped supply table.
+
+  :param folder: Folder written by write
+  :type folder: str
+  """
+  def __init__(self, folder):
+    self.folder = folder
+    self.info = fingerprint.readJson(os.path.join(folder, 'columns.json'))
+    self.arrays = {}
+
+  def __len__(self):
+    return self.info['rows']
+
+  def load(self, name):
+    '''Helper function memory mapping one stored array'''
+    if name not in self.arrays:
+      self.arrays[name] = np.load(os.path.join(self.folder, name + '.npy'), mmap_mode='r')
+    return self.arrays[name]
+
+  def __getitem__(self, col):
+    '''Returns a value column, or the decoded values of a coded column'''
+    if col in self.info['coded']:
+      return self.values(col)[self.codes(col)]
+    return self.load(col)
+
+  def codes(self, col):
+    '''Returns the dictionary codes of a coded column'''
+    return self.load(col + '.codes')
+
+  def values(self, col):
+    '''Returns the sorted distinct values of a coded column'''
+    return self.load(col + '.values')
+
+  def groupSums(self, binField, col):
+    """
+    Sums a value column by bin and habitat class.
+
+    :param binField: Bin ID field
+    :type binField: str
+    :param col: Value column
+    :type col: str
+    :return: Sums with a row per bin and a column per class, and the number of rows in every group
+    :rtype: tuple
+    """
+    nBins, nClasses = len(self.values(binField)), len(self.values('CLASS'))
+    group = self.codes(binField).astype(np.int64) * nClasses + self.codes('CLASS')
+    sums = np.bincount(group, weights=self.load(col), minlength=nBins * nClasses).reshape(nBins, nClasses)
+    counts = np.bincount(group, minlength=nBins * nClasses).reshape(nBins, nClasses)
+    return sums, counts
+
+  def habitatPercent(self, binField):
+    """
+    Percent of the habitat hectares of every bin in each habitat class.
+
+    :param binField: Bin ID field
+    :type binField: str
+    :return: Percents with a row per bin and a column per class, and a mask of the bins with at least one row
+    :rtype: tuple
+    """
+    hectares, counts = self.groupSums(binField, 'CalcHA')
+    binHectares = hectares.sum(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+      pct = np.where(binHectares > 0, hectares / binHectares * 100, 0)
+    return pct, counts.sum(axis=1) > 0
+
+  def weightedMean(self, binField):
+    """
+    Mean kcal of each habitat class in a bin weighted by the share of the bin's available energy in the class.
+
+    :param binField: Bin ID field
+    :type binField: str
+    :return: Weighted mean kcal of every bin, and a mask of the bins with at least one row
+    :rtype: tuple
+    """
+    energy, counts = self.groupSums(binField, 'avalNrgy')
+    kcal, _ = self.groupSums(binField, 'kcal')
+    with np.errstate(divide='ignore', invalid='ignore'):
+      share = energy / energy.sum(axis=1, keepdims=True)
+      weighted = np.where(counts > 0, kcal / counts * share, 0)
+    return np.nansum(weighted, axis=1), counts.sum(axis=1) > 0
+
+def openTable(folder):
+  '''Returns the supply table stored in a folder.  Opened once per process.'''
+  if folder not in cache:
+    cache[folder] = SupplyTable(folder)
+  return cache[folder]
@@ -0,0 +1,160 @@
+"""
+Module Tiling
+=============
+Splits a large area of interest into tiles along bin boundaries so one state can be processed by several workers.  Bins are grouped by the leading digits
+of their ID (e.g. HUC8 for HUC12 bins) so no bin is ever cut, and the per-bin results of the tiles are concatenated without any geometric reconciliation.
+
+Demand is proportioned by the share of county energy within each bin.  Counties can cross tile boundaries so tiles get the unscaled county demand and the
+county energy totals of the whole area of interest.
+"""
+import os, logging, arcpy
+import numpy as np
+import pandas as pd
+import waterfowlmodel.base as waterfowl
+import waterfowlmodel.fingerprint as fingerprint
+import waterfowlmodel.projection as projection
+
+# Stages run by each tile.  Species and the web merge need the whole area of interest and run after the tiles are merged.  Each tile keeps its own
+# kcal scenario matrix since the tiles split the bins.
+TILE_STAGES = ['supply', 'merge', 'demand', 'public', 'protected', 'habitat', 'urban', 'unavailable', 'model', 'scenario']
+
+def tileName(aoiname, i):
+  '''Helper function returning the name of tile i of an area of interest'''
+  return '{}_t{}'.format(aoiname, i)
+
+def binGroups(binIt, binField, ntiles, prefix=8):
+  """
+  Groups bins into tiles of about equal area.  Bins sharing the first prefix characters of their ID stay in the same tile.
+
+  :param binIt: Bins within the area of interest
+  :type binIt: str
+  :param binField: Bin unique ID field
+  :type binField: str
+  :param ntiles: Maximum number of tiles
+  :type ntiles: int
+  :param prefix: Number of leading ID characters that define a group.  Defaults to 8 (HUC8 for HUC12 bins)
+  :type prefix: int
+  :return: Bin IDs in each tile
+  :rtype: list
+  """
+  groups = {}
+  with arcpy.da.SearchCursor(binIt, [binField, 'SHAPE@AREA']) as cursor:
+    for row in cursor:
+      if row[0]:
+        group = groups.setdefault(str(row[0])[:prefix], [0, set()])
+        group[0] += row[1]
+        group[1].add(row[0])
+  # Largest group first into the smallest tile
+  tiles = [[0, []] for i in range(min(ntiles, len(groups)))]
+  for key in sorted(groups, key=lambda k: (-groups[k][0], k)):
+    tile = min(tiles, key=lambda t: t[0])
+    tile[0] += groups[key][0]
+    tile[1].extend(sorted(groups[key][1]))
+  return [sorted(t[1]) for t in tiles if t[1]]
+
+def prepareTiles(dstinfo, ntiles, cleanRun=0):
+  """
+  Clips and projects the inputs of an area of interest once and splits it into tiles.  Each tile gets its own scratch geodatabase with its bins, its
+  outline as the area of interest, and the unscaled county demand.
+
+  :param dstinfo: Waterfowlmodel parameters for the area of interest as built by runModel.main
+  :type dstinfo: list
+  :param ntiles: Maximum number of tiles
+  :type ntiles: int
+  :param cleanRun: Rebuild all intermediate data
+  :type cleanRun: int
+  :return: Area of interest name and Waterfowlmodel parameters for every tile
+  :rtype: tuple
+  """
+  if cleanRun:
+    fingerprint.clearManifests(dstinfo[11])
+  dst = waterfowl.Waterfowlmodel(*dstinfo[:13])
+  groups = binGroups(dst.binIt, dst.binUnique[0], ntiles)
+  print('\tSplitting {} into {} tiles'.format(dst.aoiname, len(groups)))
+  folder = os.path.dirname(dstinfo[11])
+  field = arcpy.AddFieldDelimiters(dst.binIt, dst.binUnique[0])
+  tiles = []
+  for i, ids in enumerate(groups):
+    name = tileName(dst.aoiname, i)
+    scratch = os.path.join(folder, name + '_scratch.gdb')
+    if not arcpy.Exists(scratch):
+      arcpy.CreateFileGDB_management(folder, name + '_scratch.gdb')
+    if cleanRun:
+      fingerprint.clearManifests(scratch)
+    binclip = os.path.join(scratch, 'binclip')
+    if not fingerprint.isCurrent(binclip, [dst.binIt], {'bins': ids}):
+      where = '{} IN ({})'.format(field, ','.join("'{}'".format(b) for b in ids))
+      arcpy.FeatureClassToFeatureClass_conversion(dst.binIt, scratch, 'binclip', where)
+      fingerprint.record(binclip, [dst.binIt], {'bins': ids})
+    tileaoi = os.path.join(scratch, 'stateAOI')
+    if not fingerprint.isCurrent(tileaoi, [binclip]):
+      arcpy.Dissolve_management(binclip, tileaoi)
+      fingerprint.record(tileaoi, [binclip])
+    # County demand isn't scaled by area at tile boundaries, it's proportioned by the energy totals of the whole area of interest
+    demandclip = os.path.join(scratch, 'demandclip')
+    if not fingerprint.isCurrent(demandclip, [dst.demand, tileaoi]):
+      projection.clipProject(dst.demand, tileaoi, demandclip)
+      fingerprint.record(demandclip, [dst.demand, tileaoi])
+    extra = {k: list(v) for k, v in dst.extra.items()}
+    tiles.append([tileaoi, name, dst.wetland, dstinfo[3], dstinfo[4], dst.demand, dstinfo[6], dst.binIt, dstinfo[8], extra, dstinfo[10], scratch, dstinfo[12]])
+  return dst.aoiname, tiles
+
+def fipsTotals(tiles, outTable):
+  """
+  Sums available energy by county over every tile of an area of interest.
+
+  :param tiles: Waterfowlmodel parameters for every tile
+  :type tiles: list
+  :param outTable: Output table with fips and SUM_SUM_avalNrgy fields, the same layout Waterfowlmodel.aggByField builds
+  :type outTable: str
+  :return: outTable
+  :rtype: str
+  """
+  frames = []
+  for tile in tiles:
+    mergeAll = os.path.join(tile[11], 'MergeAll')
+    if arcpy.Exists(mergeAll):
+      frames.append(pd.DataFrame(arcpy.da.TableToNumPyArray(mergeAll, ['fips', 'avalNrgy'], null_value={'fips': '', 'avalNrgy': 0})))
+  totals = pd.concat(frames).groupby('fips')['avalNrgy'].sum().reset_index()
+  fips = totals['fips'].values
+  if fips.dtype == object:
+    fips = fips.astype(str)
+  outnp = np.rec.fromarrays([fips, totals['avalNrgy'].values.astype(float)], names=['fips', 'SUM_SUM_avalNrgy'])
+  if arcpy.Exists(outTable):
+    arcpy.Delete_management(outTable)
+  arcpy.da.NumPyArrayToTable(outnp, outTable)
+  logging.info('County energy totals for {} tiles written to {}'.format(len(frames), outTable))
+  return outTable
+
+def mergeTiles(dstinfo, tiles, outputgdb):
+  """
+  Concatenates the per-bin results of every tile into the area of interest outputs.
+
+  :param dstinfo: Waterfowlmodel parameters for the area of interest
+  :type dstinfo: list
+  :param tiles: Waterfowlmodel parameters for every tile
+  :type tiles: list
+  :param outputgdb: Output geodatabase
+  :type outputgdb: str
+  :return: Context values for the stages run on the whole area of interest {outData, mergedAll, habitat}
+  :rtype: dict
+  """
+  aoiname, scratch = dstinfo[1], dstinfo[11]
+  outData = os.path.join(scratch, aoiname + '_Output')
+  merged = {'outData': outData, 'mergedAll': os.path.join(scratch, 'MergeAll'), 'habitat': os.path.join(scratch, 'HabitatProportion')}
+  parts = {'outData': [os.path.join(t[11], t[1] + '_Output') for t in tiles],
+           'mergedAll': [os.path.join(t[11], 'MergeAll') for t in tiles],
+           'habitat': [os.path.join(t[11], 'HabitatProportion') for t in tiles]}
+  for key, out in merged.items():
+    if arcpy.Exists(out):
+      arcpy.Delete_management(out)
+    arcpy.Merge_management([p for p in parts[key] if arcpy.Exists(p)], out)
+  arcpy.CalculateField_management(in_table=outData, field='state_abbrev', expression="'{}'".format(aoiname), expression_type="PYTHON3")
+  if arcpy.Exists(os.path.join(outputgdb, aoiname + '_Output')):
+    arcpy.Delete_management(os.path.join(outputgdb, aoiname + '_Output'))
+  arcpy.Copy_management(outData, os.path.join(outputgdb, aoiname + '_Output'))
+  for t in tiles:
+    if arcpy.Exists(os.path.join(outputgdb, t[1] + '_Output')):
+      arcpy.Delete_management(os.path.join(outputgdb, t[1] + '_Output'))
+  print('\tMerged {} tiles for {}'.format(len(tiles), aoiname))
+  return merged
@@ -0,0 +1,131 @@
+"""
+Module Validity
+===============
+Geometry validity pre-pass run before overlays.  Validity is checked for every geometry at once and only invalid geometries are repaired.  Repairs are made
+in a copy so source data is never changed, and a fingerprint of the checked dataset is stored so unchanged inputs are never checked again.
+"""
+import os, logging, arcpy, multiprocessing, itertools
+from multiprocessing import Pool
+import numpy as np
+import geopandas as gpd
+import shapely
+import waterfowlmodel.fingerprint as fingerprint
+import waterfowlmodel.partition as partition
+import waterfowlmodel.logqueue as logqueue
+
+# Field of a repaired copy holding the object ID of the source row
+ORIG_FIELD = 'ORIG_FID'
+
+def mapChunks(func, chunks, workers):
+  '''Helper function mapping over chunks with a process pool.  Pool workers and stage processes run the chunks serially instead of starting pools of their own'''
+  if workers > 1 and len(chunks) > 1 and multiprocessing.parent_process() is None:
+    with Pool(processes=min(workers, len(chunks)), **logqueue.poolArgs()) as pool:
+      return pool.map(func, chunks)
+  return [func(c) for c in chunks]
+
+def repairChunk(wkbs):
+  """
+  Repairs a chunk of geometries with make_valid.  Polygons stay polygons, any points or lines left over from the repair are dropped.
+
+  :param wkbs: Invalid geometries as WKB
+  :type wkbs: list
+  :return: Repaired geometries as WKB
+  :rtype: list
+  """
+  geoms = shapely.from_wkb(np.array(wkbs, dtype=object))
+  polygons = np.isin(shapely.get_type_id(geoms), [3, 6])
+  fixed = gpd.GeoSeries(shapely.make_valid(geoms))
+  fixed[polygons] = partition.polygonParts(fixed[polygons])
+  return [None if g is None or g.is_empty else shapely.to_wkb(g) for g in fixed]
+
+def findInvalid(inFeature, chunkSize=100000):
+  """
+  Checks the validity of every geometry in a feature class.
+
+  :param inFeature: Feature class to check
+  :type inFeature: str
+  :param chunkSize: Number of geometries checked at a time
+  :type chunkSize: int
+  :return: Object IDs and WKB of invalid geometries
+  :rtype: tuple
+  """
+  oids, wkbs = [], []
+  with arcpy.da.SearchCursor(inFeature, ['OID@', 'SHAPE@WKB']) as cursor:
+    while True:
+      rows = list(itertools.islice(cursor, chunkSize))
+      if not rows:
+        break
+      chunk = np.array([bytes(r[1]) if r[1] else None for r in rows], dtype=object)
+      geoms = shapely.from_wkb(chunk)
+      bad = ~shapely.is_valid(geoms) & ~shapely.is_missing(geoms)
+      for i in np.flatnonzero(bad):
+        oids.append(rows[i][0])
+        wkbs.append(chunk[i])
+  return oids, wkbs
+
+def writeRepaired(inFeature, outfc, repaired):
+  """
+  Copies a dataset with repaired geometries.  The object ID of each source row is kept in ORIG_FID, and repairs are matched to rows by that ID.
+
+  :param inFeature: Feature class or shapefile to copy
+  :type inFeature: str
+  :param outfc: Copy location in a geodatabase
+  :type outfc: str
+  :param repaired: Repaired geometry as WKB for each invalid object ID.  Rows repaired to nothing are left out
+  :type repaired: dict
+  """
+  desc = arcpy.Describe(inFeature)
+  arcpy.CreateFeatureclass_management(os.path.dirname(outfc), os.path.basename(outfc), desc.shapeType.upper(), inFeature, 'SAME_AS_TEMPLATE', 'SAME_AS_TEMPLATE', desc.spatialReference)
+  sourceFields = [f.name for f in arcpy.ListFields(inFeature)]
+  fields = [f.name for f in arcpy.ListFields(outfc) if f.editable and f.type not in ('OID', 'Geometry') and f.name in sourceFields and f.name != ORIG_FIELD]
+  if ORIG_FIELD not in [f.name for f in arcpy.ListFields(outfc)]:
+    arcpy.AddField_management(outfc, ORIG_FIELD, 'LONG')
+  with arcpy.da.SearchCursor(inFeature, ['OID@', 'SHAPE@'] + fields) as rows, arcpy.da.InsertCursor(outfc, [ORIG_FIELD, 'SHAPE@'] + fields) as cursor:
+    for row in rows:
+      if row[0] in repaired:
+        if repaired[row[0]] is None:
+          continue
+        row = (row[0], arcpy.FromWKB(bytearray(repaired[row[0]]), desc.spatialReference)) + tuple(row[2:])
+      cursor.insertRow(row)
+
+def ensureValid(inFeature, outfc, workers=4, chunkSize=5000):
+  """
+  Returns a version of a dataset without invalid geometries.  The dataset is never changed.  When it has invalid geometries they're repaired in a copy,
+  and repairs that leave nothing behind are dropped from the copy.  The check is skipped when the dataset hasn't changed since it was last checked.
+
+  :param inFeature: Feature class or shapefile to check
+  :type inFeature: str
+  :param outfc: Repaired copy location in a geodatabase.  Only written when inFeature has invalid geometries
+  :type outfc: str
+  :param workers: Number of processes used for the repair
+  :type workers: int
+  :param chunkSize: Number of invalid geometries repaired by each task
+  :type chunkSize: int
+  :return: inFeature when every geometry is valid, otherwise outfc
+  :rtype: str
+  """
+  manifest = fingerprint.manifestPath(outfc, 'validity')
+  digest = fingerprint.datasetHash(inFeature)
+  known = fingerprint.readJson(manifest)
+  if known.get('source') == inFeature and known.get('hash') == digest:
+    if not known.get('repaired'):
+      logging.info('\tGeometry already validated for ' + inFeature)
+      return inFeature
+    if fingerprint.isCurrent(outfc, [inFeature]):
+      logging.info('\tUsing repaired copy ' + outfc)
+      return outfc
+  oids, wkbs = findInvalid(inFeature)
+  print('\t{} invalid geometries in {}'.format(len(oids), inFeature))
+  logging.info('{} invalid geometries in {}'.format(len(oids), inFeature))
+  if oids:
+    chunks = [wkbs[i:i + chunkSize] for i in range(0, len(wkbs), chunkSize)]
+    repaired = dict(zip(oids, [w for chunk in mapChunks(repairChunk, chunks, workers) for w in chunk]))
+    tmp = outfc + 'tmp'
+    for fc in [tmp, outfc]:
+      if arcpy.Exists(fc):
+        arcpy.Delete_management(fc)
+    writeRepaired(inFeature, tmp, repaired)
+    arcpy.Rename_management(tmp, outfc)
+    fingerprint.record(outfc, [inFeature])
+  fingerprint.writeJson(manifest, {'source': inFeature, 'hash': digest, 'repaired': len(oids)})
+  return outfc if oids else inFeature
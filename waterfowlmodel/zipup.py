@@ -5,15 +5,48 @@ Add the HUC names and zip the geodatabase.
 """
 # FUNCTION TO Add the HUC names and ZIP UP THE GEODATABASE. Might need to be massaged. Jes Skillman 12/14/2020, Python 3.x
 # import modules
-import shutil, os, arcpy
+import os, time, json, zlib, shutil, struct, hashlib, logging, tempfile, threading, arcpy
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from arcgis.gis import GIS
+import numpy as np
 import pandas as pd
+import waterfowlmodel.fingerprint as fingerprint
+
+def hucNameIndex(hucFC, hucID_field_name='huc12', hucName_field_name='name'):
+    """
+    Returns the watershed ID to name index of a HUC layer.  The index reads only the two attribute columns and is saved as an .npz file in a _hucindex
+    folder next to the HUC layer's workspace, so it's only rebuilt when the HUC layer changes.
+
+    :param hucFC: The path to the feature class or shapefile containing the watershed IDs and names.
+    :type hucFC: str
+    :param hucID_field_name: The fieldname in hucFC for the watershed ID numbers. Defaults to 'huc12'.
+    :type hucID_field_name: str
+    :param hucName_field_name: The fieldname in hucFC for the watershed names. Defaults to 'name'.
+    :type hucName_field_name: str
+    :return: Sorted watershed IDs and their names
+    :rtype: tuple
+    """
+    workspace = fingerprint.workspaceOf(hucFC)
+    folder = os.path.join(os.path.dirname(workspace), os.path.splitext(os.path.basename(workspace))[0] + '_hucindex')
+    indexPath = os.path.join(folder, '{}_{}_{}.npz'.format(os.path.splitext(os.path.basename(hucFC))[0], hucID_field_name, hucName_field_name))
+    key = fingerprint.datasetKey(hucFC)
+    if os.path.isfile(indexPath):
+        with np.load(indexPath) as index:
+            if str(index['key']) == key:
+                return index['ids'], index['names']
+    hucs = arcpy.da.TableToNumPyArray(hucFC, [hucID_field_name, hucName_field_name], null_value={hucID_field_name: '', hucName_field_name: ''})
+    ids, first = np.unique(hucs[hucID_field_name].astype(str), return_index=True)
+    names = hucs[hucName_field_name].astype(str)[first]
+    os.makedirs(folder, exist_ok=True)
+    np.savez(indexPath, ids=ids, names=names, key=np.array(key))
+    return ids, names
 
 def AddHUCNames(outputfc, hucFC, output_hucID_field_name = 'HUC12', hucID_field_name = 'huc12', hucName_field_name='name'):
 
     """
-    Adds a label field to the model output so that the sub-watersheds can be labelled by name. 
+    Adds a label field to the model output so that the sub-watersheds can be labelled by name.  Missing labels are filled in bulk from the HUC name
+    index, and watersheds without a name are labelled with their ID.
 
     :param outputfc: The path to the model output feature class
     :type outputfc: str
@@ -28,36 +61,176 @@ def AddHUCNames(outputfc, hucFC, output_hucID_field_name = 'HUC12', hucID_field_
 
     """
 
-    # create dictionary of huc IDs, assumes the huc 12 layer is shapefile or a feature class in a geodatabase.
-    sdf = pd.DataFrame.spatial.from_featureclass(hucFC)
-    sdfDict = dict(zip(sdf[hucID_field_name], sdf[hucName_field_name]))
-
-    # Add the Map Label Field to the output
+    ids, names = hucNameIndex(hucFC, hucID_field_name, hucName_field_name)
+    oidField = arcpy.Describe(outputfc).OIDFieldName
     fds = [f.name for f in arcpy.ListFields(outputfc)]
-    if 'label' not in fds:
-        arcpy.AddField_management(outputfc, "label", "TEXT", "", "", "", "Map Label")
+    hasLabel = 'label' in fds
+    fields = [oidField, output_hucID_field_name] + (['label'] if hasLabel else [])
+    rows = arcpy.da.TableToNumPyArray(outputfc, fields, null_value={output_hucID_field_name: '', 'label': ''})
+    rowIds = rows[output_hucID_field_name].astype(str)
+
+    # Look up every ID at once.  IDs that aren't in the index or have no name keep the ID as their label.
+    labels = rowIds.astype(object)
+    if len(ids):
+        pos = np.clip(np.searchsorted(ids, rowIds), 0, len(ids) - 1)
+        found = (ids[pos] == rowIds) & (names[pos] != '')
+        labels[found] = names[pos[found]]
+    missing = rowIds != ''
+    if hasLabel:
+        missing &= rows['label'] == ''
+    print('\tLabelling {} watersheds'.format(int(missing.sum())))
+    if not missing.any():
+        return
+    labels = labels[missing].astype(str)
 
     # Add HUC Name
-    with arcpy.da.UpdateCursor(outputfc, [output_hucID_field_name, 'label']) as cursor:
-        for row in cursor:
-            if not row[1] and row[0] in sdfDict:
-                row[1] = sdfDict[row[0]]
-                #print(row[1])
-            elif not row[1] and row[0] not in sdfDict:
-                row[1] = row[0]
-            cursor.updateRow(row)
-    del cursor, row
+    if not hasLabel:
+        # The label field is added first so it gets a fixed width instead of the width of the longest name.  Labels are joined to a temporary field in one
+        # pass and copied over.  Rows without an ID are left null.
+        arcpy.AddField_management(outputfc, 'label', 'TEXT', field_length=255, field_alias='Map Label')
+        arcpy.da.ExtendTable(outputfc, oidField, np.rec.fromarrays([rows[oidField][missing], labels], names=['labeloid', 'labeljoin']), 'labeloid')
+        arcpy.CalculateField_management(outputfc, 'label', '!labeljoin!', 'PYTHON3')
+        arcpy.DeleteField_management(outputfc, [f for f in ['labeloid', 'labeljoin'] if arcpy.ListFields(outputfc, f)])
+    else:
+        update = dict(zip(rows[oidField][missing].tolist(), labels.tolist()))
+        with arcpy.da.UpdateCursor(outputfc, [oidField, 'label'], "label IS NULL OR label = ''") as cursor:
+            for row in cursor:
+                if row[0] in update:
+                    row[1] = update[row[0]]
+                    cursor.updateRow(row)
 
+# Bytes read and compressed at a time so large geodatabase files are never held in memory
+BLOCKSIZE = 1 << 20
+# Sizes and offsets at or above this need zip64 records
+ZIP64_LIMIT = 0xFFFFFFFF
+ARCHIVE_NAME = 'ABDU_DST_output'
 
+def dosTime(mtime):
+    '''Helper function returning the zip (DOS) time and date of a modification time'''
+    t = time.localtime(max(mtime, 315532800))
+    return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
 
-def zipUp(base, fldr):
+def contentHash(path):
+    '''Helper function returning the sha256 of a file read in blocks'''
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCKSIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def compressMember(path, arcname, cacheFolder, known, level=6):
+    """
+    Compresses one file to a raw deflate stream in the cache.  Files with the same size and modification time as the last run, or the same content hash,
+    reuse the cached stream instead of being compressed again.
+
+    :param path: File to compress
+    :type path: str
+    :param arcname: Name of the file in the archive
+    :type arcname: str
+    :param cacheFolder: Folder holding the compressed streams by content hash
+    :type cacheFolder: str
+    :param known: Manifest entry for this file from the last run
+    :type known: dict
+    :param level: zlib compression level
+    :type level: int
+    :return: Manifest entry {name, size, mtime, sha256, crc, compressed}
+    :rtype: dict
     """
-    Zips up the geodatabase for upload.
+    st = os.stat(path)
+    if known and known['size'] == st.st_size and known['mtime'] == st.st_mtime and os.path.isfile(os.path.join(cacheFolder, known['sha256'])):
+        return dict(known, name=arcname, reused=True)
+    digest = contentHash(path)
+    if known and known['sha256'] == digest and os.path.isfile(os.path.join(cacheFolder, digest)):
+        return dict(known, name=arcname, mtime=st.st_mtime, reused=True)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    crc, compressed = 0, 0
+    tmp = os.path.join(cacheFolder, '{}.{}.tmp'.format(digest, threading.get_ident()))
+    with open(path, 'rb') as src, open(tmp, 'wb') as dst:
+        for block in iter(lambda: src.read(BLOCKSIZE), b''):
+            crc = zlib.crc32(block, crc)
+            out = compressor.compress(block)
+            compressed += len(out)
+            dst.write(out)
+        out = compressor.flush()
+        compressed += len(out)
+        dst.write(out)
+    os.replace(tmp, os.path.join(cacheFolder, digest))
+    return {'name': arcname, 'size': st.st_size, 'mtime': st.st_mtime, 'sha256': digest, 'crc': crc, 'compressed': compressed, 'reused': False}
+
+def writeArchive(zipPath, entries, folders, cacheFolder):
+    """
+    Writes a zip archive from compressed streams in the cache, copying each stream in blocks.  Uses zip64 records when the archive or a member is larger
+    than 4 GB.
+
+    :param zipPath: Archive to write
+    :type zipPath: str
+    :param entries: Manifest entries of the files in archive order
+    :type entries: list
+    :param folders: Folder names to add as directory entries
+    :type folders: list
+    :param cacheFolder: Folder holding the compressed streams by content hash
+    :type cacheFolder: str
+    :return: sha256 of the archive
+    :rtype: str
+    """
+    archiveHash = hashlib.sha256()
+    central = []
+    offset = 0
+    with open(zipPath, 'wb') as out:
+        def write(data):
+            archiveHash.update(data)
+            out.write(data)
+        members = [{'name': f.rstrip('/') + '/', 'size': 0, 'mtime': time.time(), 'crc': 0, 'compressed': 0, 'folder': True} for f in folders] + entries
+        for entry in members:
+            name = entry['name'].replace(os.sep, '/').encode('utf-8')
+            method = 0 if entry.get('folder') else 8
+            mtime, mdate = dosTime(entry['mtime'])
+            big = entry['size'] >= ZIP64_LIMIT or entry['compressed'] >= ZIP64_LIMIT
+            extra = struct.pack('<HHQQ', 1, 16, entry['size'], entry['compressed']) if big else b''
+            sizes = (0xFFFFFFFF, 0xFFFFFFFF) if big else (entry['compressed'], entry['size'])
+            write(struct.pack('<IHHHHHIIIHH', 0x04034b50, 45 if big else 20, 0x800, method, mtime, mdate, entry['crc'], sizes[0], sizes[1], len(name), len(extra)) + name + extra)
+            if not entry.get('folder'):
+                with open(os.path.join(cacheFolder, entry['sha256']), 'rb') as src:
+                    for block in iter(lambda: src.read(BLOCKSIZE), b''):
+                        write(block)
+            central.append((name, method, mtime, mdate, entry, offset, entry.get('folder', False)))
+            offset = out.tell()
+        cdStart = offset
+        for name, method, mtime, mdate, entry, headerOffset, folder in central:
+            fields = []
+            for value in [entry['size'], entry['compressed'], headerOffset]:
+                if value >= ZIP64_LIMIT:
+                    fields.append(value)
+            extra = struct.pack('<HH', 1, 8 * len(fields)) + struct.pack('<' + 'Q' * len(fields), *fields) if fields else b''
+            clamp = lambda v: 0xFFFFFFFF if v >= ZIP64_LIMIT else v
+            attributes = (0o40755 << 16) | 0x10 if folder else 0o100644 << 16
+            write(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | 45, 45 if fields else 20, 0x800, method, mtime, mdate, entry['crc'],
+                              clamp(entry['compressed']), clamp(entry['size']), len(name), len(extra), 0, 0, 0, attributes, clamp(headerOffset)) + name + extra)
+        cdEnd = out.tell()
+        count = len(central)
+        clamp = lambda v: 0xFFFFFFFF if v >= ZIP64_LIMIT else v
+        if count >= 0xFFFF or cdStart >= ZIP64_LIMIT or cdEnd - cdStart >= ZIP64_LIMIT:
+            write(struct.pack('<IQHHIIQQQQ', 0x06064b50, 44, (3 << 8) | 45, 45, 0, 0, count, count, cdEnd - cdStart, cdStart))
+            write(struct.pack('<IIQI', 0x07064b50, 0, cdEnd, 1))
+        write(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF), clamp(cdEnd - cdStart), clamp(cdStart), 0))
+    return archiveHash.hexdigest()
+
+def zipUp(base, fldr, workers=None, keepCache=False):
+    """
+    Zips up the geodatabase for upload.  Files are compressed in parallel.  With keepCache the compressed streams are kept in the _zipcache folder and
+    files that didn't change since the last run reuse their stream.  A checksum manifest with the sha256 and crc of every member and of the archive is
+    written next to the archive.
 
     :param base: The path to the base folder in which all output db are held. 
     :type table: str
     :param fldr: The folder that contains the geodatabase to zip up. Will zip up all items in that folder, so make sure only the gdb is there.
     :type fldr: str
+    :param workers: Number of files compressed at the same time.  Defaults to the number of processors
+    :type workers: int
+    :param keepCache: Keep the compressed streams for the next run.  The cache is about as large as the archive
+    :type keepCache: bool
+    :return: Archive location
+    :rtype: str
     """
     
     # make new output folder in the GIS output folder
@@ -67,7 +240,49 @@ def zipUp(base, fldr):
     if not os.path.exists(newpath):
         os.makedirs(newpath)
 
+    if keepCache:
+        cacheFolder = os.path.join(base, '_zipcache')
+        os.makedirs(cacheFolder, exist_ok=True)
+    else:
+        cacheFolder = tempfile.mkdtemp(prefix='_zipcache', dir=newpath)
+    manifestPath = os.path.join(cacheFolder, 'manifest.json')
+    known = {}
+    if os.path.isfile(manifestPath):
+        with open(manifestPath) as f:
+            known = json.load(f)
+
     # name of new zipfile
-    myzipfile = os.path.join(newpath, 'ABDU_DST_output')
-    # zip it.
-    shutil.make_archive(myzipfile, 'zip', fldr)
+    myzipfile = os.path.join(newpath, ARCHIVE_NAME + '.zip')
+    folders, files = [], []
+    for root, dirs, names in os.walk(fldr):
+        dirs.sort()
+        rel = os.path.relpath(root, fldr)
+        if rel != '.':
+            folders.append(rel)
+        files += [(os.path.join(root, n), os.path.normpath(os.path.join(rel, n))) for n in sorted(names)]
+    # Largest files first so one big file doesn't start last
+    files.sort(key=lambda f: -os.path.getsize(f[0]))
+    try:
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as pool:
+            entries = list(pool.map(lambda f: compressMember(f[0], f[1], cacheFolder, known.get(f[1])), files))
+        entries.sort(key=lambda e: e['name'])
+        reused = sum(1 for e in entries if e.pop('reused'))
+        print('\tCompressed {} files, reused {} unchanged files'.format(len(entries) - reused, reused))
+        archiveHash = writeArchive(myzipfile, entries, folders, cacheFolder)
+    finally:
+        if not keepCache:
+            shutil.rmtree(cacheFolder, ignore_errors=True)
+
+    if keepCache:
+        # Keep only the streams of the current files in the cache
+        current = set(e['sha256'] for e in entries)
+        for name in os.listdir(cacheFolder):
+            if name != 'manifest.json' and name not in current:
+                os.remove(os.path.join(cacheFolder, name))
+        with open(manifestPath, 'w') as f:
+            json.dump({e['name']: e for e in entries}, f, indent=1)
+    with open(os.path.join(newpath, ARCHIVE_NAME + '.checksums.json'), 'w') as f:
+        json.dump({'archive': os.path.basename(myzipfile), 'sha256': archiveHash, 'size': os.path.getsize(myzipfile),
+                   'members': [{'name': e['name'].replace(os.sep, '/'), 'size': e['size'], 'crc32': '{:08x}'.format(e['crc']), 'sha256': e['sha256']} for e in entries]}, f, indent=1)
+    logging.info('Zipped {} to {} sha256 {}'.format(fldr, myzipfile, archiveHash))
+    return myzipfile